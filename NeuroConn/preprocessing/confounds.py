@@ -0,0 +1,147 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# hidden, and outside the sub-XX directories, so that neither the BIDS validator nor the derivatives index sees it
+CONFOUNDS_CACHE_NAME = '.neuroconn_confounds'
+
+
+def confounds_cache_path(confounds_path, cache_dir):
+    """
+    Returns the path of the columnar copy of a confounds file: Parquet if `pyarrow` is installed, `.npz` otherwise.
+    """
+    name = os.path.basename(confounds_path)
+    if name.endswith('.tsv'):
+        name = name[:-4]
+    return os.path.join(cache_dir, name + ('.parquet' if pyarrow is not None else '.npz'))
+
+def default_cache_dir(confounds_path):
+    """
+    Returns the default cache directory of a confounds file: `.neuroconn_confounds` in the derivatives directory,
+    i.e. the parent of its `sub-XX` directory (next to the TSV if it is not under a `sub-XX` directory).
+    """
+    directory = os.path.dirname(os.path.abspath(confounds_path))
+    while os.path.dirname(directory) != directory:
+        if os.path.basename(directory).startswith('sub-'):
+            return os.path.join(os.path.dirname(directory), CONFOUNDS_CACHE_NAME)
+        directory = os.path.dirname(directory)
+    return os.path.join(os.path.dirname(confounds_path), CONFOUNDS_CACHE_NAME)
+
+def _write_cache(table, cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+    # written under a unique temporary name, so that a reader never sees half a file and concurrent writers do not collide
+    fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(cache_path), suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            if pyarrow is not None:
+                table.to_parquet(file, index = False)
+            else:
+                # one array per column, so that np.load only reads the columns asked for
+                np.savez(file, __columns__ = np.array(table.columns, dtype = str), **{f'c{i}': table[column].to_numpy() for i, column in enumerate(table.columns)})
+        # mkstemp creates files only readable by their owner
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def _check_columns(cache_path, columns, all_columns):
+    missing = [column for column in columns if column not in all_columns]
+    if missing:
+        raise KeyError(f"Confounds not found in {cache_path}: {', '.join(missing)}.")
+
+def _read_cache(cache_path, columns = None):
+    if cache_path.endswith('.parquet'):
+        if columns is not None:
+            _check_columns(cache_path, columns, pyarrow.parquet.read_schema(cache_path).names)
+        return pd.read_parquet(cache_path, columns = columns)
+    with np.load(cache_path) as arrays:
+        all_columns = list(arrays['__columns__'])
+        if columns is None:
+            columns = all_columns
+        _check_columns(cache_path, columns, all_columns)
+        return pd.DataFrame({column: arrays[f'c{all_columns.index(column)}'] for column in columns})
+
+def read_confounds(confounds_path, columns = None, cache_dir = None, use_cache = True):
+    """
+    Reads the columns of an fMRIprep confounds file.
+
+    The TSV is parsed once and stored in a columnar cache (Parquet with `pyarrow`, `.npz` otherwise) in `cache_dir`;
+    later reads load only the requested columns from the cache, as long as the TSV is not modified.
+
+    Parameters
+    ----------
+    confounds_path : str
+        The path to the `desc-confounds_timeseries.tsv` file.
+    columns : list or numpy.ndarray, optional
+        The confounds to read. If None, all the confounds are read. Default is None.
+    cache_dir : str, optional
+        The directory of the cache. If None, `.neuroconn_confounds` in the derivatives directory (see `default_cache_dir`). Default is None.
+    use_cache : bool, optional
+        Whether to read and write the cache. Default is True.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The confounds, with the types read from the TSV and NaN for 'n/a'.
+    """
+    columns = None if columns is None else list(columns)
+    if not use_cache:
+        table = pd.read_csv(confounds_path, sep = '\t', usecols = columns)
+        return table[columns] if columns is not None else table
+    if cache_dir is None:
+        cache_dir = default_cache_dir(confounds_path)
+    cache_path = confounds_cache_path(confounds_path, cache_dir)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(confounds_path):
+        return _read_cache(cache_path, columns)
+    table = pd.read_csv(confounds_path, sep = '\t')
+    try:
+        _write_cache(table, cache_path)
+    except OSError:
+        pass
+    return table[columns] if columns is not None else table
+
+def impute_confounds(tables):
+    """
+    Replaces the NaNs of confounds tables by the mean of their column in the same table.
+
+    All the tables are stacked into one array and imputed at once, e.g. all the runs of a subject. The first rows of the
+    derivative columns, which fMRIprep leaves empty, are filled like any other NaN; a column without any value is filled with 0.
+
+    Parameters
+    ----------
+    tables : list of pandas.DataFrame
+        The confounds of each run, all with the same columns.
+
+    Returns
+    -------
+    list of pandas.DataFrame
+        The confounds without NaNs, in the same order.
+    """
+    if not tables:
+        return []
+    columns = tables[0].columns
+    for table in tables[1:]:
+        if not table.columns.equals(columns):
+            raise ValueError("All the confounds tables must have the same columns.")
+    lengths = np.array([len(table) for table in tables])
+    data = np.concatenate([table.to_numpy(dtype = float) for table in tables])
+    missing = np.isnan(data)
+    if missing.any():
+        # one row of sums and counts per run; empty runs have no segment, as reduceat cannot express one
+        filled = lengths > 0
+        starts = np.cumsum(lengths)[filled] - lengths[filled]
+        counts = np.add.reduceat(~missing, starts, axis = 0)
+        sums = np.add.reduceat(np.where(missing, 0, data), starts, axis = 0)
+        means = np.divide(sums, counts, out = np.zeros_like(sums), where = counts > 0)
+        rows, cols = np.nonzero(missing)
+        run_of_row = np.repeat(np.arange(len(starts)), lengths[filled])
+        data[rows, cols] = means[run_of_row[rows], cols]
+    return [pd.DataFrame(part, columns = columns) for part in np.split(data, np.cumsum(lengths)[:-1])]
@@ -0,0 +1,725 @@
+import functools
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+import pandas as pd
+
+# BIDS entities recorded in the index, in the order they appear in BIDS file names
+ENTITIES = ('sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'echo', 'space', 'cohort', 'res', 'den', 'label', 'desc')
+
+# bumped whenever the tables change, the index is then rebuilt from scratch
+INDEX_VERSION = 3
+
+INDEX_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    {', '.join(f'"{entity}" TEXT' for entity in ENTITIES)},
+    suffix TEXT,
+    extension TEXT
+);
+CREATE INDEX IF NOT EXISTS files_sub ON files ("sub", suffix);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    "sub" TEXT,
+    "ses" TEXT,
+    PRIMARY KEY ("sub", "ses")
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    repetition_time REAL,
+    slice_timing TEXT,
+    n_volumes INTEGER,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def parse_bids_entities(filename):
+    """
+    Splits a BIDS file name into its entities, suffix and extension.
+
+    Parameters
+    ----------
+    filename : str
+        The file name or path, e.g. 'sub-01_ses-1_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz'.
+
+    Returns
+    -------
+    dict
+        The entities by key (e.g. {'sub': '01', 'ses': '1', ...}), with the 'suffix' (e.g. 'bold')
+        and the 'extension' (e.g. '.nii.gz'). Parts that are not key-value pairs are ignored, except the last one (the suffix).
+    """
+    name = os.path.basename(filename)
+    stem, dot, extension = name.partition('.')
+    entities = {}
+    parts = stem.split('_')
+    for part in parts[:-1]:
+        key, sep, value = part.partition('-')
+        if sep:
+            entities[key] = value
+    key, sep, value = parts[-1].partition('-')
+    if sep:
+        entities[key] = value
+        entities['suffix'] = None
+    else:
+        entities['suffix'] = parts[-1]
+    entities['extension'] = dot + extension
+    return entities
+
+def filter_runs(runs, **entities):
+    """
+    Selects the rows of a run table (see `DerivativesIndex.table`) with exactly the given entities.
+
+    Parameters
+    ----------
+    runs : pandas.DataFrame
+        The run table, with one column per BIDS entity.
+    **entities
+        The value of each entity. A list selects any of its values, None selects the rows without the entity.
+        E.g. `task = 'rest'` does not select `task-restpre`, and `res = None` only selects outputs without a `res` entity.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The selected rows.
+    """
+    mask = pd.Series(True, index = runs.index)
+    for key, value in entities.items():
+        if key not in runs.columns:
+            raise ValueError(f"Unknown BIDS entity: {key}.")
+        if value is None:
+            mask &= runs[key].isna()
+        elif isinstance(value, (list, tuple, set)):
+            mask &= runs[key].isin(list(value))
+        else:
+            mask &= runs[key] == value
+    return runs[mask]
+
+# entities shared by the preprocessed BOLD series of a run and its confounds
+RUN_ENTITIES = ['sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'echo']
+
+def pair_runs(runs):
+    """
+    Pairs every preprocessed BOLD series of a run table with the confounds of the same run.
+
+    Parameters
+    ----------
+    runs : pandas.DataFrame
+        The run table (see `DerivativesIndex.table`).
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per preprocessed BOLD series that has confounds, with the run entities, `space`, `res`,
+        `bold_path` and `confounds_path`, sorted by BOLD path.
+    """
+    bold = filter_runs(runs, desc = 'preproc', suffix = 'bold', extension = '.nii.gz')
+    confounds = filter_runs(runs, desc = 'confounds', suffix = 'timeseries', extension = '.tsv')
+    bold = bold[RUN_ENTITIES + ['space', 'res', 'path']].rename(columns = {'path': 'bold_path'})
+    confounds = confounds[RUN_ENTITIES + ['path']].rename(columns = {'path': 'confounds_path'})
+    # missing entities are compared as empty strings, so that runs without a session still match
+    pairs = bold.fillna({key: '' for key in RUN_ENTITIES}).merge(confounds.fillna({key: '' for key in RUN_ENTITIES}), on = RUN_ENTITIES)
+    pairs[RUN_ENTITIES] = pairs[RUN_ENTITIES].mask(pairs[RUN_ENTITIES] == '')
+    return pairs.sort_values('bold_path').reset_index(drop = True)
+
+def read_sidecar(bold_path, root = None):
+    """
+    Reads the JSON sidecar metadata of a BOLD series, following the BIDS inheritance principle.
+
+    The sidecars of the BOLD directory and of its parents up to `root` apply if their entities are a subset of those of the BOLD series
+    (e.g. `task-rest_bold.json` at the top of a raw dataset). More specific sidecars override less specific ones.
+
+    Parameters
+    ----------
+    bold_path : str
+        The path to the BOLD series.
+    root : str, optional
+        The top directory searched for sidecars. Default is None (only the directory of the BOLD series).
+
+    Returns
+    -------
+    dict
+        The merged metadata (empty if there is no sidecar).
+    """
+    entities = parse_bids_entities(bold_path)
+    directory = os.path.dirname(os.path.abspath(bold_path))
+    directories = [directory]
+    root = os.path.abspath(root) if root is not None else directory
+    while directory != root and directory.startswith(root + os.sep):
+        directory = os.path.dirname(directory)
+        directories.append(directory)
+    metadata = {}
+    for directory in reversed(directories):
+        sidecars = []
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            sidecar = parse_bids_entities(name)
+            keys = set(sidecar) - {'suffix', 'extension'}
+            if sidecar['suffix'] == entities['suffix'] and all(entities.get(key) == sidecar[key] for key in keys):
+                sidecars.append((len(keys), os.path.join(directory, name)))
+        for _, path in sorted(sidecars):
+            with open(path, 'r') as file:
+                metadata.update(json.load(file))
+    return metadata
+
+def read_bold_metadata(bold_path, root = None, n_volumes = True):
+    """
+    Returns the acquisition metadata of a BOLD series: repetition time, slice timing and number of volumes.
+
+    The repetition time and slice timing come from the JSON sidecars (see `read_sidecar`). The NIfTI header is only read
+    if no sidecar has the repetition time, or for the number of volumes, which BIDS sidecars do not record.
+
+    Parameters
+    ----------
+    bold_path : str
+        The path to the BOLD series.
+    root : str, optional
+        The top directory searched for sidecars. Default is None.
+    n_volumes : bool, optional
+        Whether to read the number of volumes from the header. If False, `n_volumes` is None unless the header
+        was read for the repetition time. Default is True.
+
+    Returns
+    -------
+    dict
+        `repetition_time` (in seconds), `slice_timing` (list or None), `n_volumes` and `source` ('sidecar' or 'header', for the repetition time).
+    """
+    sidecar = read_sidecar(bold_path, root)
+    repetition_time = sidecar.get('RepetitionTime')
+    header = nib.load(bold_path).header if repetition_time is None or n_volumes else None
+    source = 'sidecar'
+    if repetition_time is None:
+        repetition_time = float(header.get_zooms()[-1])
+        if header.get_xyzt_units()[1] == 'msec':
+            repetition_time /= 1000
+        source = 'header'
+    shape = header.get_data_shape() if header is not None else None
+    return {
+        'repetition_time': float(repetition_time),
+        'slice_timing': sidecar.get('SliceTiming'),
+        'n_volumes': None if shape is None else int(shape[3]) if len(shape) > 3 else 1,
+        'source': source,
+    }
+
+def _entity_key(row, entities):
+    # missing entities are compared as empty strings, as in `pair_runs`
+    return tuple('' if pd.isna(row[entity]) else row[entity] for entity in entities)
+
+RunFiles = namedtuple('RunFiles', ['subject', 'session', 'task', 'run', 'space', 'res', 'bold_path', 'confounds_path', 'mask_path', 'sidecar_path', 'repetition_time'])
+RunFiles.__doc__ = """
+The files of one preprocessed run: BOLD series, confounds, brain mask and JSON sidecar (None if missing), with the repetition time of the run.
+"""
+
+
+class RunManifest():
+    """
+    The runs of a subject with all their files, resolved in one pass over the derivatives index.
+
+    Each BOLD series is matched with the confounds of the same run (same subject, session, task, acquisition, run and echo),
+    and with the brain mask of the same run and space, so that pairing does not depend on the order of directory listings.
+
+    Parameters
+    ----------
+    subject : str
+        The label of the participant.
+    runs : list of RunFiles
+        The runs, sorted by session and run.
+    """
+
+    def __init__(self, subject, runs):
+        self.subject = subject
+        self.runs = list(runs)
+
+    @classmethod
+    def from_table(cls, subject, table, bold, repetition_times = None):
+        """
+        Builds the manifest of the BOLD series `bold` (rows of the run table `table`, see `DerivativesIndex.table`).
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        table : pandas.DataFrame
+            The run table of the subject.
+        bold : pandas.DataFrame
+            The rows of `table` with the preprocessed BOLD series of the manifest.
+        repetition_times : list of float, optional
+            The repetition time of each BOLD series. Default is None.
+
+        Returns
+        -------
+        RunManifest
+            The manifest.
+        """
+        confounds = {_entity_key(row, RUN_ENTITIES): row['path'] for _, row in filter_runs(table, desc = 'confounds', suffix = 'timeseries', extension = '.tsv').iterrows()}
+        masks = {_entity_key(row, RUN_ENTITIES + ['space', 'res']): row['path'] for _, row in filter_runs(table, desc = 'brain', suffix = 'mask', extension = '.nii.gz').iterrows()}
+        paths = set(table['path'])
+        if repetition_times is None:
+            repetition_times = [None] * len(bold)
+        runs = []
+        for (_, row), repetition_time in zip(bold.iterrows(), repetition_times):
+            sidecar_path = row['path'][:-len('.nii.gz')] + '.json'
+            entities = [None if pd.isna(row[entity]) else row[entity] for entity in ('sub', 'ses', 'task', 'run', 'space', 'res')]
+            runs.append(RunFiles(*entities, row['path'], confounds.get(_entity_key(row, RUN_ENTITIES)), masks.get(_entity_key(row, RUN_ENTITIES + ['space', 'res'])),
+                                 sidecar_path if sidecar_path in paths else None, repetition_time))
+        return cls(subject, runs)
+
+    @property
+    def bold_paths(self):
+        return [run.bold_path for run in self.runs]
+
+    @property
+    def confounds_paths(self):
+        return [run.confounds_path for run in self.runs]
+
+    @property
+    def mask_paths(self):
+        return [run.mask_path for run in self.runs]
+
+    @property
+    def repetition_times(self):
+        return [run.repetition_time for run in self.runs]
+
+    def __iter__(self):
+        return iter(self.runs)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __repr__(self):
+        return f'RunManifest(subject={self.subject}, runs={len(self.runs)})'
+
+
+# file in the derivatives directory that remembers where the fMRIprep outputs are
+ROOT_CACHE_NAME = '.neuroconn_root'
+
+def _generated_by_fmriprep(directory):
+    try:
+        with open(os.path.join(directory, 'dataset_description.json'), 'r') as file:
+            description = json.load(file)
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return False
+    # GeneratedBy since BIDS 1.4, PipelineDescription in older fMRIprep versions
+    pipelines = description.get('GeneratedBy') or [description.get('PipelineDescription') or {}]
+    if isinstance(pipelines, dict):
+        pipelines = [pipelines]
+    return any(str(pipeline.get('Name', '')).lower() == 'fmriprep' for pipeline in pipelines if isinstance(pipeline, dict))
+
+def find_fmriprep_root(derivatives_path, max_depth = 3, use_cache = True):
+    """
+    Finds the directory of the fMRIprep outputs under a derivatives directory.
+
+    Directories are searched breadth-first, in sorted order and at most `max_depth` levels deep. The first directory whose
+    `dataset_description.json` says it was generated by fMRIprep is returned; if there is none, the first directory
+    containing `sub-XX` directories. The result is remembered in `.neuroconn_root` in `derivatives_path`, so that later calls skip the search.
+
+    Parameters
+    ----------
+    derivatives_path : str
+        The derivatives directory of the dataset.
+    max_depth : int, optional
+        The maximum number of levels below `derivatives_path` that are searched. Default is 3.
+    use_cache : bool, optional
+        Whether to read and write the `.neuroconn_root` cache. Default is True.
+
+    Returns
+    -------
+    str
+        The path to the fMRIprep outputs.
+
+    Raises
+    ------
+    FileNotFoundError
+        If `derivatives_path` does not exist or contains no fMRIprep outputs.
+    """
+    if not os.path.isdir(derivatives_path):
+        raise FileNotFoundError("The data have not been preprocessed with fmriprep: no 'derivatives' directory found.")
+    cache_path = os.path.join(derivatives_path, ROOT_CACHE_NAME)
+    if use_cache:
+        try:
+            with open(cache_path, 'r') as file:
+                root = os.path.join(derivatives_path, file.read().strip())
+            if os.path.isdir(root):
+                return os.path.normpath(root)
+        except FileNotFoundError:
+            pass
+    root = None
+    candidate = None
+    level = [derivatives_path]
+    for depth in range(max_depth + 1):
+        next_level = []
+        for directory in level:
+            if _generated_by_fmriprep(directory):
+                root = directory
+                break
+            try:
+                with os.scandir(directory) as entries:
+                    subdirs = sorted(entry.name for entry in entries if entry.is_dir() and not entry.name.startswith('.'))
+            except (FileNotFoundError, PermissionError):
+                continue
+            if any(subdir.startswith('sub-') for subdir in subdirs):
+                candidate = candidate or directory
+            else:
+                next_level.extend(os.path.join(directory, subdir) for subdir in subdirs)
+        if root is not None or not next_level:
+            break
+        level = next_level
+    root = root or candidate
+    if root is None:
+        raise FileNotFoundError(f"No fMRIprep outputs found in {derivatives_path} (searched {max_depth} levels deep).")
+    if use_cache:
+        try:
+            with open(cache_path, 'w') as file:
+                file.write(os.path.relpath(root, derivatives_path))
+        except OSError:
+            pass
+    return os.path.normpath(root)
+
+def _dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def _scan_files(directory):
+    """
+    Lists the files of a directory. `os.scandir` tells files from directories without a `stat` call, and files are not stat'ed:
+    changes are detected from the modification time of the directory.
+    """
+    with os.scandir(directory) as entries:
+        return [(entry.name, entry.path) for entry in entries if entry.is_file()]
+
+def _list_subjects(root):
+    with os.scandir(root) as entries:
+        return sorted(entry.name[4:] for entry in entries if entry.name.startswith('sub-') and entry.is_dir())
+
+def crawl_subject(root, subject, known_mtimes = None):
+    """
+    Lists the functional derivatives of one subject.
+
+    Parameters
+    ----------
+    root : str
+        The fMRIprep derivatives directory.
+    subject : str
+        The label of the participant.
+    known_mtimes : dict, optional
+        The modification time (in ns) of `func` directories listed before. A directory whose modification time
+        has not changed is not listed again. Default is None.
+
+    Returns
+    -------
+    dict
+        The session labels (`sessions`) and, for every `func` directory (`func_dirs`), a tuple (session, mtime, files).
+        `files` is a list of (name, path) tuples, or None if the directory did not change; `mtime` is None
+        if the directory does not exist.
+    """
+    known_mtimes = known_mtimes or {}
+    subject_dir = os.path.join(root, f'sub-{subject}')
+    try:
+        with os.scandir(subject_dir) as entries:
+            sessions = sorted(entry.name[4:] for entry in entries if entry.name.startswith('ses-') and entry.is_dir())
+    except (FileNotFoundError, NotADirectoryError):
+        return {'sessions': [], 'func_dirs': {}}
+    func_dirs = {}
+    for session in [None] + sessions:
+        func_dir = os.path.join(subject_dir, 'func') if session is None else os.path.join(subject_dir, f'ses-{session}', 'func')
+        mtime = _dir_mtime(func_dir)
+        if func_dir in known_mtimes and known_mtimes[func_dir] == mtime:
+            files = None
+        else:
+            files = _scan_files(func_dir) if mtime is not None else []
+        func_dirs[func_dir] = (session, mtime, files)
+    return {'sessions': sessions, 'func_dirs': func_dirs}
+
+def crawl_derivatives(root, subjects = None, known_mtimes = None, max_workers = 8):
+    """
+    Lists the functional derivatives of many subjects at once, with a pool of threads.
+
+    On network file systems every directory listing is a round trip to the server; the threads keep many of them in flight.
+
+    Parameters
+    ----------
+    root : str
+        The fMRIprep derivatives directory.
+    subjects : list of str, optional
+        The labels of the participants. If None, all `sub-XX` directories of `root` are crawled. Default is None.
+    known_mtimes : dict, optional
+        The modification times of `func` directories listed before, see `crawl_subject`. Default is None.
+    max_workers : int, optional
+        The number of threads. Default is 8.
+
+    Returns
+    -------
+    dict
+        The result of `crawl_subject` for each subject.
+    """
+    if subjects is None:
+        subjects = _list_subjects(root)
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        return dict(zip(subjects, pool.map(lambda subject: crawl_subject(root, subject, known_mtimes), subjects)))
+
+def _locked(method):
+    # the connection is shared by the threads using a dataset (e.g. a watcher callback), one at a time
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class DerivativesIndex():
+    """
+    Persistent SQLite index of the functional derivatives of fMRIprep (BOLD series, confounds, masks, JSON sidecars).
+
+    Every file of the `func` directories is recorded with its BIDS entities; files themselves are not stat'ed.
+    The index is refreshed one subject at a time, or for all subjects with a parallel crawl (`refresh_all`):
+    only directories whose modification time changed since the last refresh are listed again.
+    The index can be used from several threads; queries are serialized.
+
+    Parameters
+    ----------
+    root : str
+        The fMRIprep derivatives directory, containing the `sub-XX` directories.
+    index_path : str, optional
+        The path to the SQLite file. If the file cannot be created (e.g. on a read-only dataset), an in-memory index is used.
+        Default is `root/.neuroconn_index.sqlite`.
+    max_workers : int, optional
+        The number of threads of `refresh_all`. Default is 8.
+    """
+
+    def __init__(self, root, index_path = None, max_workers = 8):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path if index_path is not None else os.path.join(self.root, '.neuroconn_index.sqlite')
+        self.max_workers = max_workers
+        self._lock = threading.RLock()
+        try:
+            self._connection = sqlite3.connect(self.index_path, timeout = 30, check_same_thread = False)
+            self._setup()
+        except sqlite3.OperationalError as e:
+            print(f"Cannot use the derivatives index {self.index_path} ({e}), keeping the index in memory.")
+            self.index_path = ':memory:'
+            self._connection = sqlite3.connect(self.index_path, check_same_thread = False)
+            self._setup()
+
+    def _setup(self):
+        connection = self._connection
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        stored_root = None
+        if version == INDEX_VERSION:
+            connection.executescript(INDEX_SCHEMA)
+            stored_root = connection.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if version != INDEX_VERSION or stored_root is None or stored_root[0] != self.root:
+            for table in ('files', 'dirs', 'sessions', 'metadata', 'meta'):
+                connection.execute(f'DROP TABLE IF EXISTS {table}')
+            connection.executescript(INDEX_SCHEMA)
+            connection.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+            connection.execute("INSERT INTO meta VALUES ('root', ?)", (self.root,))
+            connection.commit()
+
+    def _known_mtimes(self, subject = None):
+        if subject is None:
+            return dict(self._connection.execute('SELECT path, mtime FROM dirs'))
+        prefix = os.path.join(self.root, f'sub-{subject}') + os.sep
+        return dict(self._connection.execute('SELECT path, mtime FROM dirs WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)))
+
+    def _store(self, subject, crawl):
+        """
+        Writes the result of `crawl_subject` to the index. Nothing is written if nothing changed, so that reads stay read-only.
+        """
+        changed = {func_dir: entry for func_dir, entry in crawl['func_dirs'].items() if entry[2] is not None}
+        # the files of sessions that were removed
+        stale = [(path,) for path, in self._connection.execute('SELECT DISTINCT directory FROM files WHERE "sub" = ?', (subject,))
+                 if path not in crawl['func_dirs']]
+        sessions = [session for session, in self._connection.execute('SELECT "ses" FROM sessions WHERE "sub" = ? ORDER BY "ses"', (subject,))]
+        if not changed and not stale and sessions == crawl['sessions']:
+            return
+        with self._connection:
+            if sessions != crawl['sessions']:
+                self._connection.execute('DELETE FROM sessions WHERE "sub" = ?', (subject,))
+                self._connection.executemany('INSERT INTO sessions VALUES (?, ?)', [(subject, session) for session in crawl['sessions']])
+            for func_dir, (session, mtime, files) in changed.items():
+                rows = []
+                for name, path in files:
+                    entities = parse_bids_entities(name)
+                    entities.setdefault('sub', subject)
+                    entities.setdefault('ses', session)
+                    rows.append((path, func_dir, *[entities.get(entity) for entity in ENTITIES], entities['suffix'], entities['extension']))
+                self._connection.execute('DELETE FROM files WHERE directory = ?', (func_dir,))
+                self._connection.executemany(f'INSERT OR REPLACE INTO files VALUES ({", ".join("?" * (len(ENTITIES) + 4))})', rows)
+                self._connection.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (func_dir, mtime))
+            self._connection.executemany('DELETE FROM files WHERE directory = ?', stale)
+            self._connection.executemany('DELETE FROM dirs WHERE path = ?', stale)
+
+    @_locked
+    def refresh(self, subject):
+        """
+        Updates the index of a subject, listing only the directories that changed.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        """
+        self._store(subject, crawl_subject(self.root, subject, self._known_mtimes(subject)))
+
+    @_locked
+    def refresh_all(self, subjects = None):
+        """
+        Updates the index of many subjects with a parallel crawl (see `crawl_derivatives`).
+
+        Parameters
+        ----------
+        subjects : list of str, optional
+            The labels of the participants. If None, all subjects of the derivatives are refreshed, and the subjects
+            whose directory was removed are dropped from the index. Default is None.
+        """
+        crawls = crawl_derivatives(self.root, subjects, self._known_mtimes(), self.max_workers)
+        for subject, crawl in crawls.items():
+            self._store(subject, crawl)
+        if subjects is None:
+            indexed = self._connection.execute('SELECT "sub" FROM sessions UNION SELECT "sub" FROM files').fetchall()
+            for subject, in indexed:
+                if subject not in crawls:
+                    self._store(subject, {'sessions': [], 'func_dirs': {}})
+
+    @_locked
+    def sessions(self, subject, refresh = True):
+        """
+        Returns the session labels of a subject, sorted (an empty list if the subject has no sessions).
+        """
+        if refresh:
+            self.refresh(subject)
+        return [session for session, in self._connection.execute('SELECT "ses" FROM sessions WHERE "sub" = ? ORDER BY "ses"', (subject,))]
+
+    @_locked
+    def files(self, subject, refresh = True, **entities):
+        """
+        Returns the paths of the indexed files of a subject with the given entities.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        refresh : bool, optional
+            Whether to refresh the index of the subject first. Default is True.
+        **entities
+            Exact values of BIDS entities, `suffix` or `extension` (e.g. `desc = 'preproc', suffix = 'bold', extension = '.nii.gz'`).
+
+        Returns
+        -------
+        list of str
+            The paths, sorted.
+        """
+        if refresh:
+            self.refresh(subject)
+        unknown = set(entities) - set(ENTITIES) - {'suffix', 'extension'}
+        if unknown:
+            raise ValueError(f"Unknown BIDS entities: {', '.join(sorted(unknown))}.")
+        conditions = ['"sub" = ?'] + [f'"{key}" = ?' for key in entities]
+        query = f'SELECT path FROM files WHERE {" AND ".join(conditions)} ORDER BY path'
+        return [path for path, in self._connection.execute(query, (subject, *entities.values()))]
+
+    @_locked
+    def metadata(self, bold_paths = None, root = None, n_volumes = True):
+        """
+        Returns the acquisition metadata of many BOLD series at once, from the cache or from their sidecars.
+
+        Metadata are cached in the index with the modification time of the BOLD series, and read again only if the file changed
+        (or if the number of volumes is asked for and was not read before).
+
+        Parameters
+        ----------
+        bold_paths : list of str, optional
+            The paths to the BOLD series. If None, all the preprocessed BOLD series in the index. Default is None.
+        root : str, optional
+            The top directory searched for sidecars (see `read_sidecar`). Default is the derivatives directory.
+        n_volumes : bool, optional
+            Whether to read the number of volumes from the NIfTI headers (see `read_bold_metadata`). If False, the headers are only read
+            for the series whose sidecars lack the repetition time, and `n_volumes` may be missing. Default is True.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per BOLD series, in the order of `bold_paths`, with `path`, `repetition_time`, `slice_timing`, `n_volumes` and `source`.
+        """
+        if bold_paths is None:
+            bold_paths = [path for path, in self._connection.execute(
+                """SELECT path FROM files WHERE "desc" = 'preproc' AND suffix = 'bold' AND extension = '.nii.gz' ORDER BY path""")]
+        root = self.root if root is None else root
+        cached = {}
+        # SQLite limits the number of parameters of a query
+        for start in range(0, len(bold_paths), 500):
+            chunk = list(bold_paths[start:start + 500])
+            query = f'SELECT * FROM metadata WHERE path IN ({", ".join("?" * len(chunk))})'
+            cached.update({row[0]: row[1:] for row in self._connection.execute(query, chunk)})
+        rows = []
+        new_rows = []
+        for path in bold_paths:
+            mtime = os.stat(path).st_mtime
+            row = cached.get(path)
+            if row is None or row[0] != mtime or (n_volumes and row[3] is None):
+                metadata = read_bold_metadata(path, root, n_volumes)
+                row = (mtime, metadata['repetition_time'], json.dumps(metadata['slice_timing']), metadata['n_volumes'], metadata['source'])
+                new_rows.append((path, *row))
+            rows.append((path, row[1], json.loads(row[2]), row[3], row[4]))
+        if new_rows:
+            with self._connection:
+                self._connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)', new_rows)
+        return pd.DataFrame(rows, columns = ['path', 'repetition_time', 'slice_timing', 'n_volumes', 'source'])
+
+    def subjects(self):
+        """
+        Returns the labels of the subjects with a `sub-XX` directory in the derivatives, sorted.
+        """
+        return _list_subjects(self.root)
+
+    @_locked
+    def table(self, subject = None, refresh = True):
+        """
+        Returns the indexed files as a table, with one row per file and one column per BIDS entity.
+
+        Parameters
+        ----------
+        subject : str, optional
+            The label of the participant. If None, the files of all subjects are returned. Default is None.
+        refresh : bool, optional
+            Whether to refresh the index first (of all subjects if `subject` is None). Default is True.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The columns are the BIDS entities (`sub`, `ses`, `task`, `run`, `space`, `res`, `desc`, ...), `suffix`, `extension`
+            and `path`, sorted by path. Entities a file name does not have are missing values.
+        """
+        columns = ', '.join(f'"{entity}"' for entity in ENTITIES) + ', suffix, extension, path'
+        if subject is None:
+            if refresh:
+                self.refresh_all()
+            return pd.read_sql_query(f'SELECT {columns} FROM files ORDER BY path', self._connection)
+        if refresh:
+            self.refresh(subject)
+        return pd.read_sql_query(f'SELECT {columns} FROM files WHERE "sub" = ? ORDER BY path', self._connection, params = (subject,))
+
+    @_locked
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,147 @@
+import os
+import re
+import subprocess as sp
+import time
+
+SCHEDULERS = {
+    'slurm': {
+        'header': """#SBATCH --job-name={job_name}
+#SBATCH --array=1-{n_tasks}{throttle}
+#SBATCH --cpus-per-task={nthreads}
+#SBATCH --mem={scheduler_mem_mb}M
+#SBATCH --time={walltime}
+#SBATCH --output={log_dir}/{job_name}_%A_%a.out""",
+        'throttle': '%{max_parallel}',
+        'array_range': re.compile(r'^#SBATCH --array=1-(\d+)', re.MULTILINE),
+        'task_id': 'SLURM_ARRAY_TASK_ID',
+    },
+    'pbs': {
+        'header': """#PBS -N {job_name}
+#PBS -J 1-{n_tasks}{throttle}
+#PBS -l select=1:ncpus={nthreads}:mem={scheduler_mem_mb}mb
+#PBS -l walltime={walltime}
+#PBS -j oe
+#PBS -o {log_dir}""",
+        # max_run_subjobs, PBS Professional 2020.1 / OpenPBS 20.0 and later
+        'throttle': '%{max_parallel}',
+        'array_range': re.compile(r'^#PBS -J 1-(\d+)', re.MULTILINE),
+        'task_id': 'PBS_ARRAY_INDEX',
+    },
+}
+
+# memory requested from the scheduler on top of fMRIprep's --mem_mb, for Python and the container runtime
+SCHEDULER_MEM_OVERHEAD = 1.1
+
+def write_job_array_script(command, subjects, script_dir, log_dir, scheduler = 'slurm', nthreads = 8, mem_mb = 5000, walltime = '24:00:00', job_name = 'fmriprep', max_parallel = None, setup = '', work_path = None):
+    """
+    Writes a job-array script for a cluster scheduler, with one array task per subject.
+
+    The subject of each task is read from a subject list written next to the script. In `command`,
+    `$SUBJECT` is replaced by the subject label of the task.
+
+    Parameters
+    ----------
+    command : str
+        The command run by every task, as returned by `parse_fmriprep_command` with `participant_label = '$SUBJECT'`.
+    subjects : list of str
+        The labels of the participants, one per array task.
+    script_dir : str
+        The directory in which the script and the subject list are written.
+    log_dir : str
+        The directory of the per-subject logs (`fmriprep_logs_sub-XX.txt`) and of the scheduler output.
+    scheduler : str, optional
+        'slurm' or 'pbs' (PBS Pro). Default is 'slurm'.
+    nthreads : int, optional
+        The number of CPUs of each task. Default is 8.
+    mem_mb : int, optional
+        The memory given to fMRIprep in each task, in MB; 10% more is requested from the scheduler. Default is 5000.
+    walltime : str, optional
+        The maximum run time of each task (HH:MM:SS). Default is '24:00:00'.
+    job_name : str, optional
+        The name of the job array. Default is 'fmriprep'.
+    max_parallel : int, optional
+        The maximum number of tasks running at the same time (`--array=1-N%M` with SLURM, `-J 1-N%M` with PBS,
+        which requires PBS Professional 2020.1 or later). If None, the scheduler decides. Default is None.
+    setup : str, optional
+        Shell lines run before the command in every task (e.g. 'module load apptainer'). Default is ''.
+    work_path : str, optional
+        A work directory created by every task before running the command (may contain `$SUBJECT`). Default is None.
+
+    Returns
+    -------
+    str
+        The path to the script, to submit with `sbatch` or `qsub`.
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"scheduler must be one of {list(SCHEDULERS)}.")
+    template = SCHEDULERS[scheduler]
+    os.makedirs(script_dir, exist_ok = True)
+    os.makedirs(log_dir, exist_ok = True)
+    subjects_file = os.path.join(script_dir, f'{job_name}_subjects.txt')
+    with open(subjects_file, 'w') as file:
+        file.write('\n'.join(subjects) + '\n')
+
+    throttle = template['throttle'].format(max_parallel = max_parallel) if max_parallel is not None else ''
+    header = template['header'].format(job_name = job_name, n_tasks = len(subjects), throttle = throttle, nthreads = nthreads,
+                                       scheduler_mem_mb = int(mem_mb * SCHEDULER_MEM_OVERHEAD), walltime = walltime, log_dir = log_dir)
+    mkdir_work = f'mkdir -p "{work_path}"' if work_path is not None else ''
+    command = ' '.join(command.split())
+    script = f"""#!/bin/bash
+{header}
+
+set -e
+SUBJECT=$(sed -n "${{{template['task_id']}}}p" "{subjects_file}")
+{setup}
+{mkdir_work}
+{command} > "{log_dir}/fmriprep_logs_sub-$SUBJECT.txt" 2>&1
+"""
+    script_path = os.path.join(script_dir, f'{job_name}_{scheduler}.sh')
+    with open(script_path, 'w') as file:
+        file.write(script)
+    os.chmod(script_path, 0o755)
+    return script_path
+
+def run_job_array_locally(script_path, max_parallel = 1, poll_interval = 0.5):
+    """
+    Runs a job-array script written by `write_job_array_script` on the local machine, as a fake scheduler would.
+
+    Every array task is started with `bash`, with the task index in the environment variable the scheduler would set.
+    Useful to test the scripts without a cluster.
+
+    Parameters
+    ----------
+    script_path : str
+        The path to the script.
+    max_parallel : int, optional
+        The number of tasks running at the same time. Default is 1.
+    poll_interval : float, optional
+        The number of seconds between two checks of the running tasks. Default is 0.5.
+
+    Returns
+    -------
+    dict
+        The exit code of each array task, by task index (starting at 1).
+    """
+    with open(script_path, 'r') as file:
+        script = file.read()
+    for template in SCHEDULERS.values():
+        match = template['array_range'].search(script)
+        if match is not None:
+            break
+    else:
+        raise ValueError(f"{script_path} is not a job-array script.")
+    pending = list(range(1, int(match.group(1)) + 1))
+    running = {}
+    returncodes = {}
+    while pending or running:
+        while pending and len(running) < max_parallel:
+            index = pending.pop(0)
+            env = dict(os.environ, **{template['task_id']: str(index)})
+            running[index] = sp.Popen(['bash', script_path], env = env)
+        for index, process in list(running.items()):
+            if process.poll() is not None:
+                returncodes[index] = process.returncode
+                del running[index]
+        if running:
+            time.sleep(poll_interval)
+    return returncodes
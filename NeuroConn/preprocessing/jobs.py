@@ -0,0 +1,450 @@
+import asyncio
+import datetime
+import json
+import os
+import platform
+import re
+import signal
+import subprocess as sp
+import time
+from collections import namedtuple
+
+# Nipype node messages, e.g.
+# [Node] Setting-up "fmriprep_23_1_wf.single_subject_01_wf.anat_preproc_wf.n4" in "/work/...".
+# [Node] Executing "n4" <niworkflows.interfaces...>
+# [Node] Finished "n4", elapsed time 12.5s.
+# Setting-up gives the full name of the node, the other messages only its last part.
+NIPYPE_NODE_PATTERN = re.compile(r'\[Node\] (Setting-up|Executing|Running|Finished|Cached) "([^"]+)"(?:.*elapsed time ([\d.]+)s)?')
+NIPYPE_NODE_STATUS = {
+    'Setting-up': 'setup',
+    'Executing': 'started',
+    'Running': 'started',
+    'Finished': 'finished',
+    'Cached': 'finished',
+}
+
+# fMRIprep names the workflow of each participant single_subject_<label>_wf (sub_<label>_wf since 23.2),
+# and crash reports live under sub-<label>/log
+SUBJECT_PATTERN = re.compile(r'single_subject_([a-zA-Z0-9]+)_wf|sub_([a-zA-Z0-9]+)_wf|sub-([a-zA-Z0-9]+)')
+
+# fMRIprep announces the identifier of each invocation (e.g. 20230524-130209_4f5ba6e2-...), which names the directory of its crash reports
+RUN_UUID_PATTERN = re.compile(r'Run identifier: ([\w-]+)')
+
+ProgressEvent = namedtuple('ProgressEvent', ['subject', 'node', 'status', 'elapsed', 'time', 'n_finished'])
+ProgressEvent.__doc__ = """
+A Nipype node that started or finished during an fMRIprep run.
+
+Fields are the participant label, the node name (without its workflow path), the status ('setup', 'started' or 'finished'),
+the run time of the node in seconds as reported by Nipype (None for started nodes),
+the number of seconds since the container was started and the number of nodes finished so far.
+"""
+
+
+def parse_progress_event(line):
+    """
+    Parses a Nipype node start/finish line of an fMRIprep log.
+
+    Parameters
+    ----------
+    line : str
+        A line of the fMRIprep log.
+
+    Returns
+    -------
+    tuple or None
+        The (node, status, elapsed) of the node message, or None if the line is not a node message.
+        The node name is the last part of the Nipype name, e.g. 'n4', whatever the message.
+    """
+    match = NIPYPE_NODE_PATTERN.search(line)
+    if match is None:
+        return None
+    action, node, elapsed = match.groups()
+    return node.rsplit('.', 1)[-1], NIPYPE_NODE_STATUS[action], float(elapsed) if elapsed is not None else None
+
+def parse_log_subject(line):
+    """
+    Finds the participant a line of an fMRIprep log refers to.
+
+    Parameters
+    ----------
+    line : str
+        A line of the fMRIprep log.
+
+    Returns
+    -------
+    str or None
+        The participant label, or None if the line does not mention a participant.
+    """
+    match = SUBJECT_PATTERN.search(line)
+    if match is None:
+        return None
+    return next(label for label in match.groups() if label is not None)
+
+def find_crash_files(fmriprep_path, subject, since = None, run_uuid = None):
+    """
+    Lists the Nipype crash reports fMRIprep wrote for a participant (`sub-XX/log/<run_uuid>/crash-*.txt`).
+
+    Parameters
+    ----------
+    fmriprep_path : str
+        The fMRIprep derivatives directory.
+    subject : str
+        The participant label.
+    since : float, optional
+        Only the crash reports modified after this time (in seconds since the epoch) are returned. Default is None (all).
+    run_uuid : str, optional
+        Only the crash reports of this fMRIprep invocation are returned (see `FmriprepJob.run_uuid`). Default is None (all).
+
+    Returns
+    -------
+    list of str
+        The paths to the crash reports.
+    """
+    log_dir = os.path.join(fmriprep_path, f'sub-{subject}', 'log')
+    if run_uuid is not None:
+        log_dir = os.path.join(log_dir, run_uuid)
+    crash_files = []
+    for root, _, files in os.walk(log_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.startswith('crash-') and (since is None or os.path.getmtime(path) >= since):
+                crash_files.append(path)
+    return sorted(crash_files)
+
+
+class LogTailer():
+    """
+    Reads a growing log file incrementally, one complete line at a time.
+
+    Only the lines written since the previous call are read, so memory use does not grow with the size of the log.
+
+    Parameters
+    ----------
+    log_path : str
+        The path to the log file.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self._file = None
+        self._partial = ''
+        self.closed = False
+
+    def lines(self):
+        """
+        Yields the lines completed since the previous call. A trailing line without newline is kept for later.
+        """
+        if self.closed:
+            return
+        if self._file is None:
+            if not os.path.exists(self.log_path):
+                return
+            self._file = open(self.log_path, "r", errors = "replace")
+        while True:
+            line = self._file.readline()
+            if not line:
+                return
+            if not line.endswith('\n'):
+                self._partial += line
+                return
+            line, self._partial = self._partial + line, ''
+            yield line
+
+    def close(self):
+        """
+        Closes the log file and returns the last line if it had no trailing newline.
+        """
+        rest = list(self.lines())
+        if self._file is not None:
+            self._file.close()
+        self.closed = True
+        rest, self._partial = rest + ([self._partial] if self._partial else []), ''
+        return rest
+
+
+def _popen_kwargs():
+    if platform.system() == "Windows":
+        return {'creationflags': sp.CREATE_NEW_PROCESS_GROUP}
+    # own process group, so that cancelling also stops docker / fmriprep-docker started by bash
+    return {'start_new_session': True}
+
+def _shell_args(command):
+    if platform.system() == "Windows":
+        return command
+    return ["bash", "-c", command]
+
+def _terminate(process):
+    if platform.system() == "Windows":
+        process.terminate()
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class FmriprepJob():
+    """
+    Handle on a running fMRIprep container, as returned by `RawDataset.submit_fmriprep`.
+
+    The job does not block: use `done()` to check whether the container has exited,
+    `wait()` to block until it does and `cancel()` to stop it. While the log is read, the identifier
+    fMRIprep gives to the invocation is kept in `run_uuid` (None until fMRIprep has printed it).
+
+    Parameters
+    ----------
+    command : str
+        The fMRIprep command, as returned by `parse_fmriprep_command`.
+    log_path : str
+        The path to the file that receives stdout and stderr of the command.
+    subject : str or list of str, optional
+        The label(s) of the participant(s) being processed.
+    subject_log_paths : dict, optional
+        For a container processing several participants, the path of a separate log for each participant.
+        Lines that can be attributed to a participant (see `parse_log_subject`) are copied to its log as they are read. Default is None.
+    manifest_path : str, optional
+        The path of a JSON manifest written when the container exits, with the exit code, the wall time and,
+        if a `monitor` is given, the peak memory, CPU time and bytes written. Default is None (no manifest).
+    monitor : ResourceMonitor, optional
+        Samples the resource usage of the container from a background thread while it runs. Default is None.
+    metadata : dict, optional
+        Additional entries of the manifest (e.g. the requested `nthreads` and `mem_mb`). Default is None.
+    work_path : str, optional
+        The work directory of the container, which identifies it among the running containers (see `telemetry.DockerStatsSampler`). Default is None.
+    """
+
+    def __init__(self, command, log_path, subject = None, subject_log_paths = None, manifest_path = None, monitor = None, metadata = None, work_path = None):
+        self.command = command
+        self.log_path = log_path
+        self.subject = subject
+        self.work_path = work_path
+        self.manifest_path = manifest_path
+        self.monitor = monitor
+        self.metadata = metadata or {}
+        self.ended_at = None
+        self._subject_logs = {label: open(path, "w") for label, path in (subject_log_paths or {}).items()}
+        self._log_file = open(log_path, "w")
+        self.started_at = time.time()
+        self.process = sp.Popen(_shell_args(command), shell = platform.system() == "Windows", stdout=self._log_file, stderr=self._log_file, universal_newlines=True, **_popen_kwargs())
+        self.cancelled = False
+        self.n_finished_nodes = 0
+        self._tailer = LogTailer(log_path)
+        self._node_subjects = {}
+        self.run_uuid = None
+        if self.monitor is not None:
+            self.monitor.start(self)
+
+    @property
+    def returncode(self):
+        """
+        The exit code of the container, or None while it is still running.
+        """
+        self.done()
+        return self.process.returncode
+
+    def done(self):
+        """
+        Checks whether the container has exited.
+
+        Returns
+        -------
+        bool
+            True if the container has exited.
+        """
+        if self.process.poll() is None:
+            return False
+        self._finish()
+        return True
+
+    def wait(self, timeout = None):
+        """
+        Blocks until the container has exited.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum number of seconds to wait. If None, waits until the container exits. Default is None.
+
+        Returns
+        -------
+        int
+            The exit code of the container.
+
+        Raises
+        ------
+        subprocess.TimeoutExpired
+            If the container is still running after `timeout` seconds.
+        """
+        self.process.wait(timeout = timeout)
+        self._finish()
+        if self._subject_logs:
+            for _ in self._read_lines():
+                pass
+        return self.process.returncode
+
+    def cancel(self):
+        """
+        Stops the container. Does nothing if it has already exited.
+        """
+        if not self.done():
+            self.cancelled = True
+            _terminate(self.process)
+            self.wait()
+
+    def new_log_lines(self, on_progress = None):
+        """
+        Returns the log lines written since the previous call, without blocking.
+
+        Parameters
+        ----------
+        on_progress : callable, optional
+            Called with a `ProgressEvent` for every Nipype node that was set up, started or finished. Default is None.
+
+        Returns
+        -------
+        list of str
+            The new lines of the log.
+        """
+        return list(self._read_lines(on_progress))
+
+    def follow(self, on_progress = None, poll_interval = 0.5):
+        """
+        Yields the lines of the log as they are written, until the container exits.
+
+        Parameters
+        ----------
+        on_progress : callable, optional
+            Called with a `ProgressEvent` for every Nipype node that was set up, started or finished. Default is None.
+        poll_interval : float, optional
+            The number of seconds to wait for new lines. Default is 0.5.
+
+        Yields
+        ------
+        str
+            The lines of the log.
+        """
+        while True:
+            finished = self.done()
+            yield from self._read_lines(on_progress)
+            if finished:
+                break
+            time.sleep(poll_interval)
+
+    def _read_lines(self, on_progress = None):
+        finished = self.done()
+        lines = self._tailer.lines()
+        for line in lines:
+            self._handle_line(line, on_progress)
+            yield line
+        if finished and not self._tailer.closed:
+            for line in self._tailer.close():
+                self._handle_line(line, on_progress)
+                yield line
+            for log in self._subject_logs.values():
+                log.close()
+
+    def _handle_line(self, line, on_progress):
+        if self.run_uuid is None:
+            match = RUN_UUID_PATTERN.search(line)
+            if match is not None:
+                self.run_uuid = match.group(1)
+        subject = parse_log_subject(line) if self._subject_logs else None
+        parsed = parse_progress_event(line)
+        if parsed is not None and self._subject_logs:
+            subject = self._node_subject(parsed[0], parsed[1], subject)
+        if subject in self._subject_logs:
+            self._subject_logs[subject].write(line)
+        if parsed is None:
+            return
+        node, status, elapsed = parsed
+        if status == 'finished':
+            self.n_finished_nodes += 1
+        if on_progress is not None:
+            on_progress(ProgressEvent(subject or self.subject, node, status, elapsed, time.time() - self.started_at, self.n_finished_nodes))
+
+    def _node_subject(self, node, status, subject):
+        # only the Setting-up message of a node names the participant; the later messages of the node
+        # are attributed to the participant that set it up, unless several participants are running a node of that name
+        subjects = self._node_subjects.setdefault(node, [])
+        if subject is not None:
+            if status == 'setup':
+                subjects.append(subject)
+        elif len(set(subjects)) == 1:
+            subject = subjects[0]
+        if status == 'finished' and subject in subjects:
+            subjects.remove(subject)
+        return subject
+
+    @property
+    def wall_time(self):
+        """
+        The number of seconds the container has been running (until it exited).
+        """
+        return (self.ended_at or time.time()) - self.started_at
+
+    def _finish(self):
+        if self.ended_at is not None:
+            return
+        self.ended_at = time.time()
+        if not self._log_file.closed:
+            self._log_file.close()
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self.manifest_path is not None:
+            self.write_manifest()
+
+    def write_manifest(self):
+        """
+        Writes the run manifest (exit code, wall time, resources) to `manifest_path`.
+        """
+        manifest = {
+            'subject': self.subject,
+            'command': ' '.join(self.command.split()),
+            'log_path': self.log_path,
+            'returncode': self.process.returncode,
+            'cancelled': self.cancelled,
+            'started_at': datetime.datetime.fromtimestamp(self.started_at).isoformat(),
+            'wall_time': round(self.wall_time, 1),
+        }
+        manifest.update(self.metadata)
+        if self.monitor is not None:
+            manifest.update(self.monitor.summary())
+        with open(self.manifest_path, "w") as file:
+            json.dump(manifest, file, indent = 4)
+
+    def __repr__(self):
+        status = 'running' if self.process.returncode is None else f'exited with {self.process.returncode}'
+        return f'FmriprepJob(subject={self.subject}, {status})'
+
+
+async def run_command_async(command, log_path):
+    """
+    Runs an fMRIprep command as an asyncio subprocess, writing its output to a log file.
+
+    Many of these coroutines can run concurrently in a single event loop. If the coroutine is
+    cancelled, the container is stopped before the cancellation is propagated.
+
+    Parameters
+    ----------
+    command : str
+        The fMRIprep command, as returned by `parse_fmriprep_command`.
+    log_path : str
+        The path to the file that receives stdout and stderr of the command.
+
+    Returns
+    -------
+    int
+        The exit code of the command.
+    """
+    with open(log_path, "w") as log_file:
+        if platform.system() == "Windows":
+            process = await asyncio.create_subprocess_shell(command, stdout=log_file, stderr=log_file, **_popen_kwargs())
+        else:
+            process = await asyncio.create_subprocess_exec(*_shell_args(command), stdout=log_file, stderr=log_file, **_popen_kwargs())
+        try:
+            return await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                _terminate(process)
+                await process.wait()
+            raise
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# pandas < 2.0 has no dtype_backend, and then uses its own nullable types
+PANDAS_DTYPE_BACKEND = int(pd.__version__.split('.')[0]) >= 2
+
+# hidden, so that the BIDS validator ignores it
+PARTICIPANTS_CACHE_NAME = '.neuroconn_participants.parquet'
+
+LOOKUPS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'gt': lambda column, value: column > value,
+    'ge': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'le': lambda column, value: column <= value,
+    'in': lambda column, value: column.isin(list(value)),
+    'isna': lambda column, value: column.isna() == bool(value),
+    'contains': lambda column, value: column.str.contains(value, regex = False),
+}
+
+
+def read_participants(participants_path, use_cache = True):
+    """
+    Reads a BIDS `participants.tsv` into a typed, columnar table.
+
+    Columns get nullable types ('n/a' is a missing value) backed by Arrow if `pyarrow` and pandas 2.0 or later are installed. The table is then cached
+    as Parquet next to the TSV (`.neuroconn_participants.parquet`), and read from the cache as long as the TSV is not modified.
+
+    Parameters
+    ----------
+    participants_path : str
+        The path to `participants.tsv`.
+    use_cache : bool, optional
+        Whether to read and write the Parquet cache (only with `pyarrow`). Default is True.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The participant table, with `participant_id` as strings.
+    """
+    cache_path = os.path.join(os.path.dirname(participants_path), PARTICIPANTS_CACHE_NAME)
+    use_cache = use_cache and pyarrow is not None
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(participants_path):
+        return pd.read_parquet(cache_path, dtype_backend = 'pyarrow') if PANDAS_DTYPE_BACKEND else pd.read_parquet(cache_path).convert_dtypes()
+    table = pd.read_csv(participants_path, sep = '\t', na_values = ['n/a'], dtype = {'participant_id': str})
+    if PANDAS_DTYPE_BACKEND:
+        table = table.convert_dtypes(dtype_backend = 'pyarrow' if pyarrow is not None else 'numpy_nullable')
+    else:
+        table = table.convert_dtypes()
+    if use_cache:
+        try:
+            table.to_parquet(cache_path, index = False)
+        except OSError:
+            pass
+    return table
+
+def filter_participants(table, **conditions):
+    """
+    Selects the rows of a participant table that meet all the conditions.
+
+    Conditions are written `column = value` for equality, or `column__lookup = value` with the lookups
+    `eq`, `ne`, `gt`, `ge`, `lt`, `le`, `in` (a list of values), `isna` (True or False) and `contains` (a substring),
+    e.g. `age__gt = 60, group = 'patient'`.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The participant table.
+    **conditions
+        The conditions.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The selected rows.
+    """
+    mask = np.ones(len(table), dtype = bool)
+    for condition, value in conditions.items():
+        column, _, lookup = condition.partition('__')
+        lookup = lookup or 'eq'
+        if column not in table.columns:
+            raise ValueError(f"Unknown participant column: {column}.")
+        if lookup not in LOOKUPS:
+            raise ValueError(f"Unknown lookup '{lookup}', use one of {', '.join(LOOKUPS)}.")
+        # missing values never meet a condition, except isna
+        mask &= LOOKUPS[lookup](table[column], value).fillna(False).to_numpy(dtype = bool)
+    return table[mask]
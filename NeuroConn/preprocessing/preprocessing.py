@@ -8,9 +8,17 @@ from nilearn import datasets
 import time
 from nilearn.maskers import NiftiLabelsMasker
 from nilearn import signal
-from sklearn.impute import SimpleImputer
-import subprocess as sp
 import platform
+import re
+from concurrent.futures import ProcessPoolExecutor
+from .jobs import FmriprepJob, find_crash_files, run_command_async
+from .hpc import write_job_array_script
+from .derivatives import DerivativesIndex, RunManifest, RUN_ENTITIES, filter_runs, find_fmriprep_root
+from .watcher import DerivativesWatcher
+from .participants import read_participants, filter_participants
+from .confounds import impute_confounds, read_confounds, CONFOUNDS_CACHE_NAME
+from .telemetry import DockerStatsSampler, ResourceMonitor, read_manifest
+from .scheduler import FmriprepShard, FmriprepScheduler, ResourceBudget, WorkDirManager, unit_label, host_cpu_count, host_memory_mb, estimate_fmriprep_resources, estimate_work_dir_mb, combine_costs, HOST_MEMORY_FRACTION
 
 output_spaces = {
     "anat": "T1w",
@@ -24,6 +32,27 @@ output_spaces = {
     "MNI152NLin2009cAsym:res-2":"MNI152NLin2009cAsym_res-2"
 }
 
+def get_space_labels(spaces):
+    """
+    Converts fMRIprep output spaces to the `space-` labels of the volumetric output files.
+
+    Parameters
+    ----------
+    spaces : str
+        The output spaces, as passed to `--output-spaces` (e.g. 'MNI152NLin2009cAsym:res-2 anat').
+
+    Returns
+    -------
+    list of str
+        The space labels (e.g. ['MNI152NLin2009cAsym_res-2', 'T1w']). Surface and native BOLD spaces are left out.
+    """
+    labels = []
+    for space in spaces.split():
+        if space.startswith(('fsaverage', 'fsnative', 'fsLR')) or space in ('func', 'run', 'boldref', 'sbref'):
+            continue
+        labels.append(output_spaces.get(space, space.replace(':', '_')))
+    return labels
+
 def parse_path_windows_docker(path):
     r"""
     Parses a path in Windows format to a path in Docker format.
@@ -55,7 +84,7 @@ def parse_path_windows_docker(path):
         path = '/' + path[0].lower() + '/' + path[2:]
     return path
 
-def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path, participant_label, nthreads, output_spaces, fs_recon_all, task, nipreps_wrapper,mem_mb,skip_bids_validation = True, sloppy = False, system = platform.system()):
+def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path, participant_label, nthreads, output_spaces, fs_recon_all, task, nipreps_wrapper,mem_mb,skip_bids_validation = True, sloppy = False, system = platform.system(), omp_nthreads = None, bids_filter_file = None, apptainer_image = None, anat_only = False, reuse_anat = False):
     r"""
     Parses the arguments for the fmriprep docker command.
 
@@ -73,8 +102,8 @@ def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path,
     work_path : str
         The path to the working directory. By default, it is home directory (usually the user directory).
         On Windows, use a raw string literal (e.g. r'C:\path\to\file').
-    participant_label : str
-        The subject ID.
+    participant_label : str or list of str
+        The subject ID. If a list is given, all subjects are processed by a single fMRIprep invocation.
     skip_bids_validation : bool, optional
         Whether to perform BIDS validation. Default is True.
     nthreads : int
@@ -93,6 +122,17 @@ def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path,
         Whether to use a lower rendering power. Default is True.
     system : str
         The operating system system. By default, determined automatically with `platform.system()`.
+    omp_nthreads : int, optional
+        The maximum number of threads per process (`--omp-nthreads`). If None, fMRIprep decides. Default is None.
+    bids_filter_file : str, optional
+        The path to a JSON file with BIDS filters (`--bids-filter-file`), e.g. to process a single session. Default is None.
+    apptainer_image : str, optional
+        The path to an fMRIprep Apptainer (Singularity) image. If given, the command runs fMRIprep with Apptainer instead of Docker
+        (e.g. on a cluster), and `nipreps_wrapper` and `system` are ignored. Default is None.
+    anat_only : bool, optional
+        Whether to run the anatomical workflow only (`--anat-only`). Default is False.
+    reuse_anat : bool, optional
+        Whether to reuse the anatomical outputs already in `fmriprep_path` (`--derivatives`), e.g. from an `anat_only` run. Default is False.
 
     Returns
     -------
@@ -104,8 +144,46 @@ def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path,
     skip_bids_validation = '--skip-bids-validation' if skip_bids_validation else ''
     task = '' if task == None else f'--task-id {task}'
     sloppy = '--sloppy' if sloppy else ''
+    omp_nthreads = '' if omp_nthreads is None else f'--omp-nthreads {omp_nthreads}'
+    anat_only = '--anat-only' if anat_only else ''
+    # fMRIprep reuses the precomputed anatomical derivatives it finds there; the wrapper mounts the host path itself
+    if not reuse_anat:
+        derivatives = ''
+    elif nipreps_wrapper and apptainer_image is None:
+        derivatives = f'--derivatives {fmriprep_path}'
+    else:
+        derivatives = '--derivatives /out'
+    if not isinstance(participant_label, str):
+        participant_label = ' '.join(participant_label)
+    filter_mount = ''
+    if bids_filter_file is None:
+        bids_filter = ''
+    elif nipreps_wrapper and apptainer_image is None:
+        bids_filter = f'--bids-filter-file {bids_filter_file}'
+    else:
+        filter_mount = f'{parse_path_windows_docker(bids_filter_file) if system == "Windows" and apptainer_image is None else bids_filter_file}:/bids_filter.json:ro'
+        filter_mount = ('-B ' if apptainer_image is not None else '-v ') + filter_mount
+        bids_filter = '--bids-filter-file /bids_filter.json'
 
-    if not nipreps_wrapper:
+    if apptainer_image is not None:
+        fmriprep_command = f"""
+            apptainer run --cleanenv -B {data_path}:/data:ro \
+                -B {fmriprep_path}:/out \
+                -B {work_path}:/work \
+                -B {fs_license_path}:/license {filter_mount} \
+                {apptainer_image} /data /out \
+                participant --participant-label {participant_label} \
+                -w /work \
+                {skip_bids_validation} \
+                {fs_recon_all} \
+                --fs-license-file /license \
+                --mem_mb {mem_mb} \
+                --output-spaces {output_spaces} \
+                {sloppy} \
+                {task} {bids_filter} {anat_only} {derivatives} --stop-on-first-crash \
+                --nthreads {nthreads} {omp_nthreads}
+            """
+    elif not nipreps_wrapper:
         if system == 'Windows':
             data_path = parse_path_windows_docker(data_path)
             fmriprep_path = parse_path_windows_docker(fmriprep_path)
@@ -115,7 +193,7 @@ def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path,
             docker run -ti --rm -v {data_path}:/data:ro \
                 -v {fmriprep_path}:/out \
                 -v {work_path}:/work \
-                -v {fs_license_path}:/license \
+                -v {fs_license_path}:/license {filter_mount} \
                 nipreps/fmriprep /data /out \
                 participant --participant-label {participant_label} \
                 -w /work \
@@ -125,13 +203,14 @@ def parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path,
                 --mem_mb {mem_mb} \
                 --output-spaces {output_spaces} \
                 {sloppy} \
-                --nthreads {nthreads}
+                {task} {bids_filter} {anat_only} {derivatives} \
+                --nthreads {nthreads} {omp_nthreads}
             """
     else:
         export_fmriprep_path = '' if system == 'Windows' else 'export PATH=$HOME/.local/bin:$PATH'
         fmriprep_command = f"""
         {export_fmriprep_path}
-        fmriprep-docker {data_path} {fmriprep_path} participant --participant-label {participant_label} {skip_bids_validation} --fs-license-file {fs_license_path} {fs_recon_all} {task} --stop-on-first-crash --mem_mb {mem_mb} --output-spaces {output_spaces} -w {work_path} --nthreads {nthreads} {sloppy}
+        fmriprep-docker {data_path} {fmriprep_path} participant --participant-label {participant_label} {skip_bids_validation} --fs-license-file {fs_license_path} {fs_recon_all} {task} {bids_filter} {anat_only} {derivatives} --stop-on-first-crash --mem_mb {mem_mb} --output-spaces {output_spaces} -w {work_path} --nthreads {nthreads} {omp_nthreads} {sloppy}
         """
     print('Running fmriprep command: ', fmriprep_command)
     return fmriprep_command
@@ -170,23 +249,144 @@ class RawDataset():
             raise ValueError("The path to the dataset in BIDS format must be specified (BIDS_path).")
         self.data_description_path = self.BIDS_path + '/dataset_description.json'
         self.participant_data_path = self.BIDS_path + '/participants.tsv'
-        self._participant_data = pd.read_csv(self.participant_data_path, sep = '\t')
+        self._participant_data = None
+        self.fmriprep_path = os.path.join(self.BIDS_path, 'derivatives', 'fmriprep')
         self._name = None
         self._data_description = None
         self._subjects = None
     
-    def _bold_tr(self, subject, task):
-        bold_file_path = os.path.join(self.BIDS_path, f'sub-{subject}', 'func', f'sub-{subject}_task-{task}_bold.nii.gz')
-        img = nib.load(bold_file_path)
-        bold_tr = img.header.get_zooms()[-1]
-        return bold_tr
+    def _bold_shape(self, bold_file_path):
+        # only the header is read, the data are not loaded
+        return nib.load(bold_file_path).shape
+
+    def _unit_bold_paths(self, unit, task = 'rest'):
+        """
+        Lists the raw BOLD runs processed by a unit of work: a subject label or an `FmriprepShard`.
+        """
+        if not isinstance(unit, FmriprepShard):
+            unit = FmriprepShard(unit, None, None)
+        if unit.anat_only:
+            return []
+        bold_paths = self._raw_bold_paths(unit.subject, task)
+        paths = [path for session, session_paths in bold_paths.items() if unit.session is None or session == unit.session for path in session_paths]
+        if unit.run is not None:
+            paths = [path for path in paths if f'_run-{unit.run}_' in os.path.basename(path)]
+        return paths
+
+    def estimate_fmriprep_resources(self, subject, task = 'rest'):
+        """
+        Picks the number of threads and the memory for preprocessing a subject, from the headers of its raw BOLD runs.
+
+        Parameters
+        ----------
+        subject : str or FmriprepShard
+            The label of the participant, or a session/run shard of a participant.
+        task : str, optional
+            The name of the task to preprocess. If None, all tasks are counted. Default is 'rest'.
+
+        Returns
+        -------
+        tuple of int
+            The (nthreads, mem_mb) to pass to `docker_fmriprep`.
+        """
+        bold_shapes = [self._bold_shape(path) for path in self._unit_bold_paths(subject, task)]
+        return estimate_fmriprep_resources(bold_shapes)
+
+    def estimate_fmriprep_work_mb(self, subject, task = 'rest'):
+        """
+        Estimates the largest size of the fMRIprep work directory of a subject, from the headers of its raw BOLD runs (see `scheduler.estimate_work_dir_mb`).
+
+        Parameters
+        ----------
+        subject : str or FmriprepShard
+            The label of the participant, or a shard of a participant.
+        task : str, optional
+            The name of the task to preprocess. If None, all tasks are counted. Default is 'rest'.
+
+        Returns
+        -------
+        int
+            The size in MB.
+        """
+        return estimate_work_dir_mb([self._bold_shape(path) for path in self._unit_bold_paths(subject, task)])
+
+    def estimate_fmriprep_costs(self, subjects, task = 'rest'):
+        """
+        Estimates how long fMRIprep takes for each subject, to start the longest subjects first.
+
+        The cost of a subject is the number of voxels times the number of volumes, summed over its raw BOLD runs
+        (read from the headers only). When `run_fmriprep` recorded run times of earlier containers for the same task
+        (see `fmriprep_runtimes`), they are used for the subjects that have one, and the header costs of the other subjects
+        are converted to seconds with the median ratio of the recorded runs.
+
+        Parameters
+        ----------
+        subjects : list
+            The labels of the participants, or session/run shards (`FmriprepShard`).
+        task : str, optional
+            The name of the task to preprocess. If None, all tasks are counted. Default is 'rest'.
+
+        Returns
+        -------
+        dict
+            The estimated cost of each subject or shard.
+        """
+        costs = _estimate_fmriprep_costs({None: self}, [(None, unit) for unit in subjects], task)
+        return {unit: cost for (name, unit), cost in costs.items()}
+
+    def _header_cost(self, unit, task = 'rest'):
+        return sum(float(np.prod(self._bold_shape(path))) for path in self._unit_bold_paths(unit, task))
+
+    def _fmriprep_runtimes_path(self):
+        return os.path.join(self.BIDS_path, 'fmriprep_logs', 'fmriprep_runtimes.json')
+
+    def fmriprep_runtimes(self):
+        """
+        Returns the run times of the fMRIprep containers that succeeded at their first attempt in `run_fmriprep`.
+
+        Returns
+        -------
+        dict
+            For each subject or shard label (e.g. 'sub-01', 'sub-01_ses-2'), the task, the wall time in seconds and the header cost
+            (see `estimate_fmriprep_costs`) of its last run. A subject processed in a batch container gets the wall time of the container.
+        """
+        path = self._fmriprep_runtimes_path()
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as file:
+            return json.load(file)
 
+    def _record_fmriprep_runtime(self, units, wall_time, task = 'rest'):
+        runtimes = self.fmriprep_runtimes()
+        for unit in units:
+            runtimes[unit_label(unit)] = {'task': task, 'wall_time': round(wall_time, 1), 'cost': self._header_cost(unit, task)}
+        os.makedirs(os.path.dirname(self._fmriprep_runtimes_path()), exist_ok = True)
+        with open(self._fmriprep_runtimes_path(), 'w') as file:
+            json.dump(runtimes, file, indent = 4)
 
-    def docker_fmriprep(self, subject, fs_license_path, nthreads, fs_recon_all = False, mem_mb = 5000, task = 'rest', nipreps_wrapper = True, output_spaces = 'MNI152NLin2009cAsym:res-2', skip_bids_validation = True, work_path = os.path.expanduser('~'), sloppy = False):
+    def _resolve_resources(self, subject, nthreads, mem_mb, task = 'rest'):
+        """
+        Replaces 'auto' thread and memory settings by estimates for a subject or a list of subjects.
+        """
+        if nthreads != 'auto' and mem_mb != 'auto':
+            return nthreads, mem_mb
+        subjects = [subject] if isinstance(subject, (str, FmriprepShard)) else subject
+        estimates = [self.estimate_fmriprep_resources(i, task) for i in subjects]
+        if nthreads == 'auto':
+            nthreads = min(host_cpu_count(), sum(i[0] for i in estimates))
+        if mem_mb == 'auto':
+            mem_mb = sum(i[1] for i in estimates)
+        return nthreads, mem_mb
+
+
+    def docker_fmriprep(self, subject, fs_license_path, nthreads, fs_recon_all = False, mem_mb = 5000, task = 'rest', nipreps_wrapper = True, output_spaces = 'MNI152NLin2009cAsym:res-2', skip_bids_validation = True, work_path = os.path.expanduser('~'), sloppy = False, on_progress = None, force = False, stats_sampler = None):
 
         r"""
         Runs the fMRIprep pipeline in a Docker container for a given subject.
 
+        The log is printed line by line while fMRIprep is running. Subjects whose outputs
+        are already complete for `task` and `output_spaces` are skipped, unless `force` is True.
+
         Parameters
         ----------
         subject : str
@@ -194,14 +394,14 @@ class RawDataset():
         fs_license_path : str
             The path to the (full) FreeSurfer license file.
             On Windows, use a raw string literal (e.g. r'C:\path\to\file').
-        nthreads : int
-            The number of threads to use for processing.
+        nthreads : int or 'auto'
+            The number of threads to use for processing. If 'auto', it is estimated from the raw BOLD headers (see `estimate_fmriprep_resources`).
         skip_bids_validation : bool, optional
             Whether to skip BIDS validation. Default is True.
         fs_recon_all : bool, optional
             Whether to run FreeSurfer's recon-all. Default is False.
-        mem_mb : int, optional
-            The amount of memory to allocate to the Docker container, in MB. Default is 5000.
+        mem_mb : int or 'auto', optional
+            The amount of memory to allocate to the Docker container, in MB. If 'auto', it is estimated from the raw BOLD headers. Default is 5000.
         task : str, optional
             The name of the task to use. Default is 'rest'. If None, all tasks are preprocessed.
         nipreps_wrapper : bool, optional
@@ -214,10 +414,19 @@ class RawDataset():
             On Windows, use a raw string literal (e.g. r'C:\path\to\file').
         sloppy : bool, optional
             Whether to use a lower rendering power. Default is True.
+        on_progress : callable, optional
+            Called with a `ProgressEvent` (node name, status, elapsed time) whenever a Nipype node starts or finishes. Default is None.
+        force : bool, optional
+            Whether to run fMRIprep even if the outputs of the subject are complete. Default is False.
+        stats_sampler : bool or callable, optional
+            Whether to record the peak memory, CPU time and bytes written of the container in the run manifest
+            (`fmriprep_logs/fmriprep_manifest_sub-XX.json`). See `submit_fmriprep`. Default is None.
 
         Returns
         -------
-        None
+        int
+            The exit code of the fMRIprep container (0 if the subject was skipped). If the container exited with 0
+            but wrote crash reports (see `fmriprep_crash_files`), 1 is returned.
 
         Raises
         ------
@@ -229,41 +438,698 @@ class RawDataset():
         https://fmriprep.org/en/stable/usage.html#command-line-arguments
         https://fmriprep.org/en/stable/outputs.html#outputs
         """
+        if not force and self.fmriprep_complete(subject, task, output_spaces):
+            print(f"fMRIprep outputs of sub-{subject} are complete, skipping. Use force = True to run it again.")
+            return 0
+        job = self.submit_fmriprep(subject, fs_license_path, nthreads, fs_recon_all = fs_recon_all, mem_mb = mem_mb, task = task, nipreps_wrapper = nipreps_wrapper, output_spaces = output_spaces, skip_bids_validation = skip_bids_validation, work_path = work_path, sloppy = sloppy, stats_sampler = stats_sampler)
+        try:
+            for line in job.follow(on_progress = on_progress):
+                print(line, end = '')
+        finally:
+            # the container runs in its own session, so an interrupt (e.g. Ctrl-C) does not reach it
+            job.cancel()
+        return self._check_fmriprep_job(job, [subject])[0]
+
+    def fmriprep_crash_files(self, subject, since = None, run_uuid = None):
+        """
+        Lists the crash reports fMRIprep wrote for a subject under `derivatives/fmriprep/sub-XX/log`.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        since : float, optional
+            Only the crash reports written after this time (in seconds since the epoch) are returned. Default is None (all).
+        run_uuid : str, optional
+            Only the crash reports of this fMRIprep invocation are returned (see `FmriprepJob.run_uuid`). Default is None (all).
+
+        Returns
+        -------
+        list of str
+            The paths to the crash reports.
+        """
+        return find_crash_files(self.fmriprep_path, subject, since, run_uuid)
+
+    def _check_fmriprep_job(self, job, subjects):
+        """
+        Returns the exit code of a finished job and the crash reports it wrote. A job that wrote crash reports counts as failed.
+
+        Crash reports are found in the log directory of the job's own fMRIprep invocation, so that other containers
+        processing the same subject at the same time (e.g. its session shards) do not count.
+        """
+        returncode = job.wait()
+        # the run identifier is printed early in the log; read what is left of it
+        job.new_log_lines()
+        if job.run_uuid is None:
+            # fMRIprep stopped before building its workflow, so it cannot have written crash reports
+            return returncode, []
+        crash_files = [path for subject in subjects for path in self.fmriprep_crash_files(subject, run_uuid = job.run_uuid)]
+        if crash_files:
+            print(f"fMRIprep crashed for {', '.join(f'sub-{subject}' for subject in subjects)}, see {', '.join(crash_files)}.")
+            if returncode == 0:
+                returncode = 1
+        return returncode, crash_files
+
+    def _fmriprep_invocation(self, subject, fs_license_path, nthreads, fs_recon_all = False, mem_mb = 5000, task = 'rest', nipreps_wrapper = True, output_spaces = 'MNI152NLin2009cAsym:res-2', skip_bids_validation = True, work_path = os.path.expanduser('~'), sloppy = False, omp_nthreads = None, session = None, run = None, anat_only = False, own_work_dir = True):
+        """
+        Builds the fMRIprep command for a given subject (or list of subjects) and prepares the output and log directories.
+
+        If `session` or `run` is given, fMRIprep is restricted to the BOLD runs of that shard of the subject with a BIDS filter file,
+        and reuses the anatomical outputs of the subject (see `FmriprepShard`), which must exist before the shard starts.
+        With `anat_only`, only the anatomical workflow of the subject is run. Either way, the shard gets its own work directory
+        (`work_path/fmriprep_work/sub-XX_ses-YY`), so that the functional shards of a subject can run at the same time,
+        unless `own_work_dir` is False, when `work_path` already is the work directory of the shard.
+
+        Returns
+        -------
+        tuple of str
+            The fMRIprep command, the path to the log file of the subject (or of the batch) and the work directory of the container.
+        """
+        shard = FmriprepShard(subject, session, run, anat_only) if session is not None or run is not None or anat_only else None
+        nthreads, mem_mb = self._resolve_resources(shard or subject, nthreads, mem_mb, task)
         data_path = self.BIDS_path
-        fmriprep_path = os.path.join(data_path, 'derivatives', 'fmriprep')
+        fmriprep_path = self.fmriprep_path
         if not os.path.exists(fmriprep_path):
             os.makedirs(fmriprep_path)
-    
-        fmrirep_command = parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path, subject, skip_bids_validation, nthreads, output_spaces, fs_recon_all, task, nipreps_wrapper, mem_mb, sloppy)
-
         log_dir = f"{data_path}/fmriprep_logs"
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
-        log_file = f"{log_dir}/fmriprep_logs_sub-{subject}.txt"
-        with open(log_file, "w") as file:
-            if platform.system() == "Windows":
-                process = sp.Popen(fmrirep_command, shell = True, stdout=file, stderr=file, universal_newlines=True)
-            else:
-                process = sp.Popen(["bash", "-c", fmrirep_command], stdout=file, stderr=file, universal_newlines=True)
 
-            while process.poll() is None:
-                time.sleep(0.1)
+        bids_filter_file = None
+        if shard is not None:
+            if not shard.anat_only:
+                bids_filter_file = os.path.join(log_dir, f'bids_filter_{shard.label}.json')
+                with open(bids_filter_file, 'w') as file:
+                    json.dump(shard.bids_filter(task), file, indent = 4)
+            if own_work_dir:
+                work_path = os.path.join(work_path, 'fmriprep_work', shard.label)
+                os.makedirs(work_path, exist_ok = True)
+
+        fmrirep_command = parse_fmriprep_command(data_path, fmriprep_path, fs_license_path, work_path, subject, nthreads, output_spaces, fs_recon_all, task, nipreps_wrapper, mem_mb, skip_bids_validation = skip_bids_validation, sloppy = sloppy, omp_nthreads = omp_nthreads, bids_filter_file = bids_filter_file,
+                                                 anat_only = anat_only, reuse_anat = shard is not None and not shard.anat_only and self._fmriprep_anat_complete(subject))
+
+        if isinstance(subject, str):
+            log_path = self._fmriprep_log_path(subject, session, run, anat_only)
+        else:
+            log_path = f"{log_dir}/fmriprep_logs_batch-{subject[0]}-{subject[-1]}.txt"
+        return fmrirep_command, log_path, work_path
+
+    def _fmriprep_log_path(self, subject, session = None, run = None, anat_only = False):
+        return f"{self.BIDS_path}/fmriprep_logs/fmriprep_logs_{FmriprepShard(subject, session, run, anat_only).label}.txt"
+
+    def _fmriprep_manifest_path(self, log_path):
+        log_dir, log_name = os.path.split(log_path)
+        return os.path.join(log_dir, log_name.replace('fmriprep_logs_', 'fmriprep_manifest_').replace('.txt', '.json'))
+
+    def fmriprep_manifest(self, subject, session = None, run = None, anat_only = False):
+        """
+        Returns the run manifest of the last fMRIprep run of a subject (exit code, wall time, peak memory, CPU time, bytes written).
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        session : str, optional
+            The session label, for a session shard. Default is None.
+        run : str, optional
+            The run label, for a run shard. Default is None.
+        anat_only : bool, optional
+            Whether to return the manifest of the anatomical shard of the subject. Default is False.
+
+        Returns
+        -------
+        dict or None
+            The manifest, or None if fMRIprep has not been run for this subject.
+        """
+        return read_manifest(self._fmriprep_manifest_path(self._fmriprep_log_path(subject, session, run, anat_only)))
+
+    def submit_fmriprep(self, subject, fs_license_path, nthreads, stats_sampler = None, sample_interval = 5, session = None, run = None, anat_only = False, **kwargs):
+        """
+        Starts the fMRIprep pipeline in a Docker container for a given subject and returns immediately.
+
+        Parameters
+        ----------
+        subject : str or list of str
+            The label of the participant to process. If a list is given, all participants are processed in a single container,
+            and the log lines of each participant are also written to its own log file.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file.
+        nthreads : int
+            The number of threads to use for processing.
+        stats_sampler : bool or callable, optional
+            Whether to sample the resource usage of the container while it runs. If True, `docker stats` is used;
+            a callable taking the job and returning a dict like `telemetry.parse_docker_stats` can be given instead. Default is None.
+        sample_interval : float, optional
+            The number of seconds between two resource samples. Default is 5.
+        session : str, optional
+            Restricts fMRIprep to the BOLD runs of one session of the subject, with a BIDS filter file and a separate work directory.
+            The anatomical outputs of the subject are reused, so they must exist (see `anat_only`). Default is None.
+        run : str, optional
+            Restricts fMRIprep to one run (of `session`, if given). Default is None.
+        anat_only : bool, optional
+            Runs the anatomical workflow of the subject only, with a separate work directory. Default is False.
+        **kwargs
+            Additional arguments, as in `docker_fmriprep`.
+
+        Returns
+        -------
+        FmriprepJob
+            A handle on the running container, with `done()`, `wait()`, `cancel()` and `returncode`.
+            When the container exits, a run manifest is written to `fmriprep_logs/fmriprep_manifest_sub-XX.json`.
+        """
+        unit = FmriprepShard(subject, session, run, anat_only) if session is not None or run is not None or anat_only else subject
+        nthreads, mem_mb = self._resolve_resources(unit, nthreads, kwargs.pop('mem_mb', 5000), kwargs.get('task', 'rest'))
+        command, log_path, work_path = self._fmriprep_invocation(subject, fs_license_path, nthreads, mem_mb = mem_mb, session = session, run = run, anat_only = anat_only, **kwargs)
+        subject_log_paths = None if isinstance(subject, str) else {i: self._fmriprep_log_path(i) for i in subject}
+        if stats_sampler is True:
+            stats_sampler = DockerStatsSampler()
+        monitor = ResourceMonitor(stats_sampler, sample_interval) if stats_sampler else None
+        return FmriprepJob(command, log_path, subject = subject, subject_log_paths = subject_log_paths, manifest_path = self._fmriprep_manifest_path(log_path),
+                           monitor = monitor, metadata = {'nthreads': nthreads, 'mem_mb': mem_mb}, work_path = work_path)
+
+    def docker_fmriprep_batch(self, subjects, fs_license_path, nthreads, mem_mb = 5000, omp_nthreads = None, on_progress = None, force = False, **kwargs):
+        """
+        Runs fMRIprep for several subjects in a single Docker container.
+
+        The container start-up, TemplateFlow initialisation and workflow construction are paid once for the whole batch,
+        and all subjects share the work directory. fMRIprep runs the subjects in parallel within the container;
+        the log lines of each subject are also written to its own `fmriprep_logs_sub-XX.txt`, so that failures can be attributed.
+        Subjects whose outputs are already complete are left out of the batch, unless `force` is True.
+
+        Parameters
+        ----------
+        subjects : list of str
+            The labels of the participants to process.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file.
+        nthreads : int or 'auto'
+            The number of threads of the whole container. If 'auto', the estimates of all subjects are added up.
+        mem_mb : int or 'auto', optional
+            The memory of the whole container, in MB. If 'auto', the estimates of all subjects are added up. Default is 5000.
+        omp_nthreads : int, optional
+            The maximum number of threads per process. By default, `nthreads` is shared equally among the subjects (at most 8 per process).
+        on_progress : callable, optional
+            Called with a `ProgressEvent` whenever a Nipype node starts or finishes. Default is None.
+        force : bool, optional
+            Whether to run fMRIprep even for subjects whose outputs are complete. Default is False.
+        **kwargs
+            Additional arguments, as in `docker_fmriprep`.
+
+        Returns
+        -------
+        int
+            The exit code of the fMRIprep container (0 if all subjects were skipped). If the container exited with 0
+            but wrote crash reports for any of the subjects (see `fmriprep_crash_files`), 1 is returned.
+        """
+        task = kwargs.get('task', 'rest')
+        subjects = list(subjects)
+        if not force:
+            complete = [subject for subject in subjects if self.fmriprep_complete(subject, task, kwargs.get('output_spaces', 'MNI152NLin2009cAsym:res-2'))]
+            if complete:
+                print(f"Skipping {len(complete)} subject(s) with complete fMRIprep outputs: {', '.join(complete)}. Use force = True to run them again.")
+            subjects = [subject for subject in subjects if subject not in complete]
+            if not subjects:
+                return 0
+        nthreads, mem_mb = self._resolve_resources(subjects, nthreads, mem_mb, task)
+        if omp_nthreads is None:
+            omp_nthreads = max(1, min(8, nthreads // len(subjects)))
+        job = self.submit_fmriprep(subjects, fs_license_path, nthreads, mem_mb = mem_mb, omp_nthreads = omp_nthreads, **kwargs)
+        try:
+            for line in job.follow(on_progress = on_progress):
+                print(line, end = '')
+        finally:
+            # the container runs in its own session, so an interrupt (e.g. Ctrl-C) does not reach it
+            job.cancel()
+        return self._check_fmriprep_job(job, subjects)[0]
+
+    async def docker_fmriprep_async(self, subject, fs_license_path, nthreads, mem_mb = 5000, force = False, **kwargs):
+        """
+        Coroutine version of `docker_fmriprep`: runs the fMRIprep container without blocking the event loop.
+
+        Several subjects can be processed concurrently from a single event loop, e.g. with
+        `asyncio.gather(*[data.docker_fmriprep_async(s, license, 4) for s in subjects])`.
+        Cancelling the coroutine stops the container. Subjects whose outputs are already complete are skipped, unless `force` is True.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant to process.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file.
+        nthreads : int or 'auto'
+            The number of threads to use for processing. If 'auto', it is estimated from the raw BOLD headers.
+        mem_mb : int or 'auto', optional
+            The amount of memory to allocate to the Docker container, in MB. If 'auto', it is estimated from the raw BOLD headers. Default is 5000.
+        force : bool, optional
+            Whether to run fMRIprep even if the outputs of the subject are complete. Default is False.
+        **kwargs
+            Additional arguments of the fMRIprep command, as in `docker_fmriprep` (e.g. `task`, `output_spaces`, `work_path`).
+            `on_progress` and `stats_sampler` are not supported; use `submit_fmriprep` to follow the log or sample resources.
+
+        Returns
+        -------
+        int
+            The exit code of the fMRIprep container (0 if the subject was skipped).
+
+        Raises
+        ------
+        TypeError
+            If `on_progress` or `stats_sampler` is given.
+        """
+        unsupported = sorted(set(kwargs) & {'on_progress', 'stats_sampler'})
+        if unsupported:
+            raise TypeError(f"docker_fmriprep_async does not support {', '.join(unsupported)}; use submit_fmriprep instead.")
+        task = kwargs.get('task', 'rest')
+        if not force and self.fmriprep_complete(subject, task, kwargs.get('output_spaces', 'MNI152NLin2009cAsym:res-2')):
+            print(f"fMRIprep outputs of sub-{subject} are complete, skipping. Use force = True to run it again.")
+            return 0
+        nthreads, mem_mb = self._resolve_resources(subject, nthreads, mem_mb, task)
+        command, log_path, _ = self._fmriprep_invocation(subject, fs_license_path, nthreads, mem_mb = mem_mb, **kwargs)
+        return await run_command_async(command, log_path)
+
+    def _raw_bold_paths(self, subject, task = None):
+        """
+        Lists the raw BOLD runs of a subject, by session.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        task : str, optional
+            The name of the task. If None, runs of all tasks are listed. Default is None.
+
+        Returns
+        -------
+        dict
+            The paths to the BOLD runs for each session label (None if the subject has no sessions).
+        """
+        subject_dir = os.path.join(self.BIDS_path, f'sub-{subject}')
+        sessions = sorted(i[4:] for i in os.listdir(subject_dir) if i.startswith('ses-'))
+        func_dirs = {session: os.path.join(subject_dir, f'ses-{session}', 'func') for session in sessions} if sessions else {None: os.path.join(subject_dir, 'func')}
+        bold_paths = {}
+        for session, func_dir in func_dirs.items():
+            if not os.path.isdir(func_dir):
+                continue
+            bold_paths[session] = sorted(os.path.join(func_dir, i) for i in os.listdir(func_dir) if i.endswith('_bold.nii.gz') and (task is None or f'_task-{task}_' in i))
+        return bold_paths
+
+    def _missing_fmriprep_runs(self, subject, task = 'rest', output_spaces = 'MNI152NLin2009cAsym:res-2'):
+        """
+        Lists the raw BOLD runs of a subject without complete fMRIprep outputs, by session.
+        """
+        bold_paths = self._raw_bold_paths(subject, task)
+        if not os.path.exists(os.path.join(self.fmriprep_path, f'sub-{subject}.html')):
+            return bold_paths
+        space_labels = get_space_labels(output_spaces)
+        missing = {}
+        for session, paths in bold_paths.items():
+            out_dir = os.path.join(self.fmriprep_path, f'sub-{subject}', f'ses-{session}' if session is not None else '', 'func')
+            for path in paths:
+                prefix = re.sub(r'_echo-[0-9]+', '', os.path.basename(path)[:-len('_bold.nii.gz')])
+                if not all(os.path.exists(os.path.join(out_dir, f'{prefix}_space-{label}_desc-preproc_bold.nii.gz')) for label in space_labels):
+                    missing.setdefault(session, []).append(path)
+        return missing
+
+    def missing_fmriprep_sessions(self, subject, task = 'rest', output_spaces = 'MNI152NLin2009cAsym:res-2'):
+        """
+        Lists the sessions of a subject whose fMRIprep outputs are incomplete.
+
+        A session is complete when the subject's fMRIprep report (`sub-XX.html`) exists and every raw BOLD run of
+        the requested task has a `desc-preproc_bold.nii.gz` output in each of the requested output spaces.
+        A subject without report is incomplete even if it has no BOLD run of the task, as its anatomical outputs are missing.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        task : str, optional
+            The name of the task. If None, all tasks are checked. Default is 'rest'.
+        output_spaces : str, optional
+            The output spaces passed to fMRIprep. Default is 'MNI152NLin2009cAsym:res-2'.
+
+        Returns
+        -------
+        list
+            The labels of the incomplete sessions (None for a subject without sessions, or without report and BOLD runs). Empty if the subject is complete.
+        """
+        missing = list(self._missing_fmriprep_runs(subject, task, output_spaces))
+        if not missing and not os.path.exists(os.path.join(self.fmriprep_path, f'sub-{subject}.html')):
+            missing = [None]
+        return missing
+
+    def get_fmriprep_shards(self, subjects, shard_by = 'session', task = 'rest', output_spaces = 'MNI152NLin2009cAsym:res-2', force = False):
+        """
+        Splits subjects into session or run shards that fMRIprep can process independently (see `FmriprepShard`).
+
+        A subject with several shards and without anatomical outputs also gets an anatomical shard (`anat_only`), listed before
+        its other shards, which must only start once it has succeeded: they reuse its outputs instead of each running the anatomical workflow.
+
+        Parameters
+        ----------
+        subjects : list of str
+            The labels of the participants.
+        shard_by : str, optional
+            'session' for one shard per session, 'run' for one shard per BOLD run. Default is 'session'.
+        task : str, optional
+            The name of the task to preprocess. If None, all tasks are preprocessed. Default is 'rest'.
+        output_spaces : str, optional
+            The output spaces passed to fMRIprep. Default is 'MNI152NLin2009cAsym:res-2'.
+        force : bool, optional
+            Whether to include shards whose outputs are already complete. Default is False.
+
+        Returns
+        -------
+        list of FmriprepShard
+            The shards.
+        """
+        if shard_by not in ('session', 'run'):
+            raise ValueError("shard_by must be 'session' or 'run'.")
+        shards = []
+        for subject in subjects:
+            bold_paths = self._raw_bold_paths(subject, task) if force else self._missing_fmriprep_runs(subject, task, output_spaces)
+            subject_shards = []
+            for session, paths in bold_paths.items():
+                if shard_by == 'session':
+                    subject_shards.append(FmriprepShard(subject, session, None))
+                    continue
+                for path in paths:
+                    run = re.search(r'_run-([a-zA-Z0-9]+)_', os.path.basename(path))
+                    shard = FmriprepShard(subject, session, run.group(1) if run else None)
+                    if shard not in subject_shards:
+                        subject_shards.append(shard)
+            # a single shard runs the anatomical workflow itself, as nothing else writes the subject's anatomy at the same time
+            if len(subject_shards) != 1 and not self._fmriprep_anat_complete(subject):
+                subject_shards.insert(0, FmriprepShard(subject, None, None, True))
+            shards.extend(subject_shards)
+        return shards
+
+    def _fmriprep_anat_complete(self, subject):
+        """
+        Checks whether the fMRIprep derivatives of a subject contain its preprocessed T1w image.
+        """
+        anat_dirs = [os.path.join(self.fmriprep_path, f'sub-{subject}', 'anat')]
+        subject_dir = os.path.join(self.fmriprep_path, f'sub-{subject}')
+        if os.path.isdir(subject_dir):
+            anat_dirs += [os.path.join(subject_dir, i, 'anat') for i in os.listdir(subject_dir) if i.startswith('ses-')]
+        return any(os.path.isdir(i) and any(j.endswith('_desc-preproc_T1w.nii.gz') for j in os.listdir(i)) for i in anat_dirs)
+
+    def fmriprep_complete(self, subject, task = 'rest', output_spaces = 'MNI152NLin2009cAsym:res-2'):
+        """
+        Checks whether fMRIprep outputs exist for all BOLD runs of a subject. See `missing_fmriprep_sessions`.
+
+        Returns
+        -------
+        bool
+            True if no session of the subject is missing outputs.
+        """
+        return len(self.missing_fmriprep_sessions(subject, task, output_spaces)) == 0
+
+    def run_fmriprep(self, subjects, fs_license_path, nthreads = 8, mem_mb = 5000, max_parallel = None, total_threads = None, total_mem_mb = None, poll_interval = 1, on_progress = None, on_finished = None, force = False, stats_sampler = None, batch_size = 1, longest_first = True, shard_by = 'subject', work_quota_mb = None, clean_work = True,
+                     max_retries = 0, retry_backoff = 60, retry_mem_factor = 1.5, **kwargs):
+        r"""
+        Runs fMRIprep for several subjects, with as many containers in parallel as the CPU and memory budget allows.
+
+        Containers are started whenever enough threads and memory are free, the longest subjects first
+        (see `estimate_fmriprep_costs`), so that long subjects do not end up alone at the end of the batch.
+        While the next subject does not fit, later subjects are only started if they leave enough threads and memory for it,
+        so that they never delay its start. Each container receives `nthreads` and `mem_mb` through the fMRIprep command line.
+        The run time of every container that succeeds is recorded (see `fmriprep_runtimes`) to improve the estimates of later batches.
+
+        Parameters
+        ----------
+        subjects : list of str
+            The labels of the participants to process. If None, all subjects of the dataset are processed.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file.
+            On Windows, use a raw string literal (e.g. r'C:\path\to\file').
+        nthreads : int or 'auto', optional
+            The number of threads to use for each subject. If 'auto', it is estimated for each subject from its raw BOLD headers. Default is 8.
+        mem_mb : int or 'auto', optional
+            The amount of memory to allocate to each Docker container, in MB. If 'auto', it is estimated for each subject from its raw BOLD headers. Default is 5000.
+        max_parallel : int, optional
+            The maximum number of containers running at the same time. If None, it is only limited by the thread and memory budget. Default is None.
+        total_threads : int, optional
+            The number of threads all running containers may use together. Default is the number of CPUs of the host.
+        total_mem_mb : int, optional
+            The memory, in MB, all running containers may use together. Default is 90% of the physical memory of the host (unlimited if it cannot be determined).
+        poll_interval : float, optional
+            The number of seconds between two checks of the running containers. Default is 1.
+        on_progress : callable, optional
+            Called with a `ProgressEvent` whenever a Nipype node of any subject starts or finishes. Default is None.
+        on_finished : callable, optional
+            Called with the subject (or `FmriprepShard`) and the exit code whenever a container exits. Default is None.
+        force : bool, optional
+            Whether to also run subjects whose fMRIprep outputs are already complete. Default is False.
+        stats_sampler : bool or callable, optional
+            Whether to record the resource usage of each container in its run manifest. See `submit_fmriprep`. Default is None.
+        batch_size : int, optional
+            The number of subjects processed by each container (see `docker_fmriprep_batch`). A batch container receives
+            `nthreads` and `mem_mb` for each of its subjects, with `--omp-nthreads` set to `nthreads`. Default is 1.
+        longest_first : bool, optional
+            Whether to start the subjects with the largest estimated cost first. If False, subjects are started in the given order. Default is True.
+        shard_by : str, optional
+            'subject' for one container per subject, 'session' or 'run' to split subjects into shards processed by separate containers
+            (see `get_fmriprep_shards`), so that the sessions of a longitudinal subject are preprocessed in parallel.
+            The anatomical workflow of a subject runs first, in its own container; the other shards of the subject start once it has succeeded,
+            and are not run if it failed.
+            Only the shards with missing outputs are run, unless `force` is True. Sharding cannot be combined with `batch_size`. Default is 'subject'.
+        work_quota_mb : int, optional
+            The maximum total size of the work directories, in MB. Every container reserves the size its work directory is expected
+            to reach (see `estimate_fmriprep_work_mb`); new containers are not started while the work directories and reservations
+            would exceed the quota, until finished containers free some space. If the kept work directories of failed containers
+            alone exceed the quota, the remaining units are not started and are listed as `not_run` in the summary.
+            If None, the size is not limited. Default is None.
+        clean_work : bool, optional
+            Whether to delete the work directory of each container that succeeded. Work directories of failed containers are kept. Default is True.
+        max_retries : int, optional
+            The number of times a failed container is started again. A container has failed if it exited with a non-zero code
+            or wrote crash reports (see `fmriprep_crash_files`). The retry reuses the work directory, so fMRIprep resumes
+            from the nodes that already finished. Default is 0.
+        retry_backoff : float, optional
+            The number of seconds to wait before the first retry; the delay doubles with every further retry. Default is 60.
+        retry_mem_factor : float, optional
+            The factor by which `mem_mb` is multiplied at every retry (up to `total_mem_mb`), as most crashes are out-of-memory errors. Default is 1.5.
+        **kwargs
+            Additional arguments passed to `docker_fmriprep` (e.g. `task`, `output_spaces`, `fs_recon_all`, `work_path`).
+            Each container works in its own directory `work_path/fmriprep_work/sub-XX`.
+
+        Returns
+        -------
+        dict
+            The exit code of the last fMRIprep container for each subject (or `FmriprepShard`) that was run
+            (1 if it exited with 0 but wrote crash reports). A summary of the failures is printed at the end and written to
+            `fmriprep_logs/fmriprep_batch_summary.json`.
+        """
+        if subjects is None:
+            subjects = self.subjects
+        returncodes = _run_fmriprep_units({None: self}, {None: subjects}, fs_license_path, nthreads = nthreads, mem_mb = mem_mb, max_parallel = max_parallel,
+                                          total_threads = total_threads, total_mem_mb = total_mem_mb, poll_interval = poll_interval, on_progress = on_progress,
+                                          on_finished = None if on_finished is None else lambda key, returncode: on_finished(key[1], returncode),
+                                          force = force, stats_sampler = stats_sampler, batch_size = batch_size, longest_first = longest_first, shard_by = shard_by,
+                                          work_quota_mb = work_quota_mb, clean_work = clean_work, max_retries = max_retries, retry_backoff = retry_backoff,
+                                          retry_mem_factor = retry_mem_factor, **kwargs)
+        return {unit: returncode for (name, unit), returncode in returncodes.items()}
+
+    def _write_fmriprep_summary(self, returncodes, failures, attempts, not_run = None):
+        """
+        Prints a summary of a `run_fmriprep` batch and writes it to `fmriprep_logs/fmriprep_batch_summary.json`.
+        `not_run` lists the units that were not started because the work directory quota was exhausted.
+        """
+        retried = [unit_label(unit) for batch, n in attempts.items() if n > 1 for unit in batch]
+        summary = {
+            'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'n_succeeded': len(returncodes) - len(failures),
+            'n_failed': len(failures),
+            'n_not_run': len(not_run or []),
+            'retried': retried,
+            'failed': {unit_label(unit): failure for unit, failure in failures.items()},
+            'not_run': [unit_label(unit) for unit in not_run or []],
+        }
+        print(f"fMRIprep batch summary: {summary['n_succeeded']} succeeded, {summary['n_failed']} failed, {len(retried)} retried"
+              + (f", {summary['n_not_run']} not run ({', '.join(summary['not_run'])})." if summary['not_run'] else '.'))
+        for label, failure in summary['failed'].items():
+            print(f"  {label}: exit code {failure['returncode']} after {failure['attempts']} attempt(s), log {failure['log_path']}"
+                  + (f", crash reports {', '.join(failure['crash_files'])}" if failure['crash_files'] else ''))
+        log_dir = os.path.join(self.BIDS_path, 'fmriprep_logs')
+        os.makedirs(log_dir, exist_ok = True)
+        with open(os.path.join(log_dir, 'fmriprep_batch_summary.json'), 'w') as file:
+            json.dump(summary, file, indent = 4)
+
+    def export_fmriprep_job_array(self, subjects, fs_license_path, apptainer_image, scheduler = 'slurm', nthreads = 8, mem_mb = 5000, walltime = '24:00:00', max_parallel = None,
+                                  task = 'rest', output_spaces = 'MNI152NLin2009cAsym:res-2', fs_recon_all = False, skip_bids_validation = True, sloppy = False,
+                                  work_path = None, setup = '', script_dir = None, force = False):
+        """
+        Writes a SLURM or PBS job-array script running fMRIprep with Apptainer, one array task per subject.
+
+        The fMRIprep command is built by `parse_fmriprep_command`, with the same output directory (`derivatives/fmriprep`)
+        and logs (`fmriprep_logs/fmriprep_logs_sub-XX.txt`) as `docker_fmriprep`. Submit the script with `sbatch` or `qsub`,
+        or test it with `hpc.run_job_array_locally`.
+
+        Parameters
+        ----------
+        subjects : list of str
+            The labels of the participants to process. If None, all subjects of the dataset are processed.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file on the cluster.
+        apptainer_image : str
+            The path to the fMRIprep Apptainer image on the cluster (e.g. built with `apptainer build fmriprep.sif docker://nipreps/fmriprep`).
+        scheduler : str, optional
+            'slurm' or 'pbs'. Default is 'slurm'.
+        nthreads : int or 'auto', optional
+            The number of CPUs of each task. If 'auto', the largest estimate among the subjects is used (see `estimate_fmriprep_resources`). Default is 8.
+        mem_mb : int or 'auto', optional
+            The memory given to fMRIprep in each task, in MB. If 'auto', the largest estimate among the subjects is used. Default is 5000.
+        walltime : str, optional
+            The maximum run time of each task (HH:MM:SS). Default is '24:00:00'.
+        max_parallel : int, optional
+            The maximum number of tasks running at the same time. Default is None.
+        task : str, optional
+            The name of the task to preprocess. If None, all tasks are preprocessed. Default is 'rest'.
+        output_spaces : str, optional
+            The output spaces. Default is 'MNI152NLin2009cAsym:res-2'.
+        fs_recon_all : bool, optional
+            Whether to run FreeSurfer's recon-all. Default is False.
+        skip_bids_validation : bool, optional
+            Whether to skip BIDS validation. Default is True.
+        sloppy : bool, optional
+            Whether to use a lower rendering power. Default is False.
+        work_path : str, optional
+            The root of the work directories; each task uses its own `sub-XX` subdirectory. Default is `$TMPDIR/fmriprep_work` on the compute node.
+        setup : str, optional
+            Shell lines run before fMRIprep in every task (e.g. 'module load apptainer'). Default is ''.
+        script_dir : str, optional
+            The directory of the script and of the subject list. Default is `code/fmriprep` in the BIDS dataset.
+        force : bool, optional
+            Whether to include subjects whose fMRIprep outputs are already complete. Default is False.
+
+        Returns
+        -------
+        str
+            The path to the job-array script.
+        """
+        if subjects is None:
+            subjects = self.subjects
+        if not force:
+            subjects = [subject for subject in subjects if not self.fmriprep_complete(subject, task, output_spaces)]
+        if len(subjects) == 0:
+            raise ValueError("No subject left to preprocess.")
+        if nthreads == 'auto' or mem_mb == 'auto':
+            estimates = np.array([self.estimate_fmriprep_resources(subject, task) for subject in subjects])
+            nthreads = int(estimates[:, 0].max()) if nthreads == 'auto' else nthreads
+            mem_mb = int(estimates[:, 1].max()) if mem_mb == 'auto' else mem_mb
+        if work_path is None:
+            work_path = '${TMPDIR:-/tmp}/fmriprep_work'
+        work_path = f'{work_path}/sub-$SUBJECT'
+        if not os.path.exists(self.fmriprep_path):
+            os.makedirs(self.fmriprep_path)
+        command = parse_fmriprep_command(self.BIDS_path, self.fmriprep_path, fs_license_path, work_path, '$SUBJECT', nthreads, output_spaces, fs_recon_all, task, False, mem_mb,
+                                         skip_bids_validation = skip_bids_validation, sloppy = sloppy, apptainer_image = apptainer_image)
+        script_dir = os.path.join(self.BIDS_path, 'code', 'fmriprep') if script_dir is None else script_dir
+        return write_job_array_script(command, [str(subject) for subject in subjects], script_dir, os.path.join(self.BIDS_path, 'fmriprep_logs'), scheduler = scheduler,
+                                      nthreads = nthreads, mem_mb = mem_mb, walltime = walltime, max_parallel = max_parallel, setup = setup, work_path = work_path)
+
+    def run_pipeline(self, subjects, fs_license_path, n_workers = 2, executor = None, conn_kwargs = None, **kwargs):
+        r"""
+        Runs fMRIprep for several subjects and computes the connectivity matrix of each subject as soon as its fMRIprep outputs are complete.
+
+        Preprocessing is scheduled by `run_fmriprep`; parcellation, signal cleaning and connectivity
+        (`FmriPreppedDataSet.get_conn_matrix` with `save = True`) run in a separate pool of workers while
+        the other subjects are still being preprocessed. Subjects whose outputs are already complete go to the workers right away.
+
+        Parameters
+        ----------
+        subjects : list of str
+            The labels of the participants to process. If None, all subjects of the dataset are processed.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file.
+            On Windows, use a raw string literal (e.g. r'C:\path\to\file').
+        n_workers : int, optional
+            The number of processes computing connectivity matrices. Their CPUs are not part of the fMRIprep budget,
+            so `total_threads` may be lowered accordingly. Default is 2.
+        executor : concurrent.futures.Executor, optional
+            The pool running the connectivity computations. If None, a `ProcessPoolExecutor` with `n_workers` processes is used. Default is None.
+        conn_kwargs : dict, optional
+            Arguments of `FmriPreppedDataSet.get_conn_matrix` (e.g. `parcellation`, `n_parcels`, `gsr`, `output_space`).
+            The task defaults to the one passed to fMRIprep, or 'rest' if all tasks are preprocessed. Default is None.
+        **kwargs
+            Arguments of `run_fmriprep` (e.g. `nthreads`, `mem_mb`, `total_threads`, `task`, `output_spaces`).
+
+        Returns
+        -------
+        tuple of dict
+            The exit code of each fMRIprep container (as returned by `run_fmriprep`), and the path to the saved connectivity matrix
+            of each subject (or the exception raised while computing it).
+        """
+        if subjects is None:
+            subjects = self.subjects
+        conn_kwargs = dict(conn_kwargs or {})
+        task = kwargs.get('task', 'rest')
+        # fMRIprep preprocesses all tasks with task = None, the connectivity matrices are computed for one task
+        conn_kwargs.setdefault('task', task if task is not None else 'rest')
+        spaces = kwargs.get('output_spaces', 'MNI152NLin2009cAsym:res-2')
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers = n_workers)
+        futures = {}
+
+        def submit_downstream(subject):
+            if subject not in futures and self.fmriprep_complete(subject, task, spaces):
+                print(f"fMRIprep outputs of sub-{subject} are complete, computing its connectivity matrix.")
+                futures[subject] = executor.submit(_compute_conn_matrix, self.BIDS_path, subject, conn_kwargs)
+
+        def on_finished(unit, returncode):
+            if returncode == 0:
+                submit_downstream(unit.subject if isinstance(unit, FmriprepShard) else unit)
+
+        try:
+            if not kwargs.get('force', False):
+                for subject in subjects:
+                    submit_downstream(subject)
+            returncodes = self.run_fmriprep(subjects, fs_license_path, on_finished = on_finished, **kwargs)
+            conn_paths = {}
+            for subject, future in futures.items():
+                try:
+                    conn_paths[subject] = future.result()
+                except Exception as e:
+                    print(f"Computing the connectivity matrix of sub-{subject} failed: {e!r}")
+                    conn_paths[subject] = e
+        finally:
+            if own_executor:
+                executor.shutdown()
+        return returncodes, conn_paths
 
-        with open(log_file, "r") as file:
-            print(file.read())
-    
     @property
     def participant_data(self):
+        """
+        The participant table, with typed columns (see `participants.read_participants`).
+        """
         if self._participant_data is None:
-            self._participant_data = pd.read_csv(self.participant_data_path, sep = '\t')
+            self._participant_data = read_participants(self.participant_data_path)
         return self._participant_data
 
     @property
     def subjects(self):
         if self._subjects is None:
-            self._subjects = self._participant_data['participant_id'].values
-            self._subjects = np.array([i.replace('sub-', '') for i in self._subjects])
+            self._subjects = self.participant_data['participant_id'].str.replace('^sub-', '', regex = True).to_numpy(dtype = str)
         return self._subjects
+
+    def select(self, **conditions):
+        """
+        Returns the subjects whose participant data meet all the conditions, e.g. `data.select(age__gt = 60, group = 'patient')`.
+
+        Parameters
+        ----------
+        **conditions
+            `column = value` for equality, or `column__lookup = value` with the lookups `eq`, `ne`, `gt`, `ge`, `lt`, `le`,
+            `in`, `isna` and `contains` (see `participants.filter_participants`).
+
+        Returns
+        -------
+        numpy.ndarray
+            The labels of the selected subjects, which can be passed to `run_fmriprep` and the other batch methods.
+        """
+        selected = filter_participants(self.participant_data, **conditions)
+        return selected['participant_id'].str.replace('^sub-', '', regex = True).to_numpy(dtype = str)
     
     @property
     def data_description(self):
@@ -282,48 +1148,198 @@ class RawDataset():
 
 
 
+class SubjectConnPaths(dict):
+    """
+    The path to the saved connectivity matrix of each subject of an `FmriPreppedDataSet`.
+
+    A subject is looked up in `clean_data/sub-XX/func` the first time it is accessed, so that opening a dataset
+    does not list the directories of every subject. Iterating only covers the subjects accessed or computed so far.
+    """
+
+    def __init__(self, dataset):
+        super().__init__()
+        self._dataset = dataset
+
+    def __missing__(self, subject):
+        output_dir = os.path.join(self._dataset.data_path, 'clean_data', f'sub-{subject}', 'func')
+        if os.path.isdir(output_dir):
+            conn_mat_paths = sorted(f'{output_dir}/{i}' for i in os.listdir(output_dir) if "conn-matrix" in i)
+            if len(conn_mat_paths) != 0:
+                self[subject] = conn_mat_paths[0]
+                return conn_mat_paths[0]
+        raise KeyError(subject)
+
+    def __contains__(self, subject):
+        try:
+            self[subject]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, subject, default = None):
+        return self[subject] if subject in self else default
+
+
 class FmriPreppedDataSet(RawDataset):
 
     def __init__(self, BIDS_path):
         super().__init__(BIDS_path)
-        self.data_path = self.BIDS_path + '/derivatives'
-        self.data_path = self._find_sub_dirs()
+        # the derivatives directory, the index and the connectivity matrices are only looked up when first used
+        self._data_path = None
         self.default_confounds_path = os.path.join(os.path.dirname(__file__), "default_confounds.txt")
-        self.subject_conn_paths = {}
-        for subject in self.subjects:
-            output_dir =os.path.join(self.data_path,'clean_data', f'sub-{subject}', 'func')
-            if os.path.exists(output_dir):
-                conn_mat_paths = [f'{output_dir}/{i}' for i in os.listdir(output_dir) if "conn-matrix" in i]
-                if len(conn_mat_paths) != 0:
-                    self.subject_conn_paths[subject] = conn_mat_paths[0]
+        self._index = None
+        self._runs = None
+        self.subject_conn_paths = SubjectConnPaths(self)
     def __repr__(self):
         return f'Subjects={self.subjects},\n Data_Path={self.data_path})'
+
+    @property
+    def data_path(self):
+        """
+        The directory containing the subject derivatives, found on first access (see `_find_sub_dirs`).
+        """
+        if self._data_path is None:
+            self._data_path = self._find_sub_dirs()
+        return self._data_path
+
+    @data_path.setter
+    def data_path(self, data_path):
+        self._data_path = data_path
+
+    @property
+    def index(self):
+        """
+        The persistent index of the derivatives (`DerivativesIndex`), stored in `.neuroconn_index.sqlite` in the derivatives directory.
+        """
+        if self._index is None:
+            self._index = DerivativesIndex(self.data_path)
+        return self._index
+
+    @property
+    def runs(self):
+        """
+        The table of all functional derivatives, with one row per file and one column per BIDS entity
+        (`sub`, `ses`, `task`, `run`, `space`, `res`, `desc`, `suffix`, `extension`, ...) and the `path`.
+
+        It is built on first access with a single pass over the derivatives (see `refresh_runs`), and can be filtered with `select_runs`,
+        e.g. `data.select_runs(task = 'rest', desc = 'preproc', suffix = 'bold', space = 'MNI152NLin2009cAsym', res = '2')`.
+        """
+        if self._runs is None:
+            self._runs = self.index.table()
+        return self._runs
+
+    def refresh_runs(self):
+        """
+        Rebuilds `runs` after new derivatives were written.
+        """
+        self._runs = self.index.table()
+        return self._runs
+
+    def select_runs(self, **entities):
+        """
+        Selects the rows of `runs` with exactly the given entities (see `derivatives.filter_runs`).
+
+        Parameters
+        ----------
+        **entities
+            The value of each entity; a list selects any of its values, None selects the files without the entity.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The selected rows.
+        """
+        return filter_runs(self.runs, **entities)
+
+    def acquisition_metadata(self, subject = None, **entities):
+        """
+        Returns the repetition time, slice timing and number of volumes of the preprocessed BOLD series, for all runs at once.
+
+        Metadata are read from the JSON sidecars (the NIfTI header only if a sidecar lacks the repetition time) and cached in the
+        derivatives index, so that later calls do not open the files again.
+
+        Parameters
+        ----------
+        subject : str, optional
+            The label of the participant. If None, all subjects. Default is None.
+        **entities
+            Exact values of BIDS entities of the runs, e.g. `task = 'rest'` (see `select_runs`).
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per preprocessed BOLD series, with its run entities, `space`, `res`, `path`, `repetition_time`,
+            `slice_timing`, `n_volumes` and `source` ('sidecar' or 'header').
+        """
+        runs = self.runs if subject is None else self.index.table(subject)
+        bold = filter_runs(runs, desc = 'preproc', suffix = 'bold', extension = '.nii.gz', **entities)
+        bold = bold[RUN_ENTITIES + ['space', 'res', 'path']]
+        return bold.merge(self.index.metadata(list(bold['path'])), on = 'path')
+
+    def watch(self, on_run_ready = None, backend = 'auto', interval = 10, settle_time = 30, start = True):
+        """
+        Watches the derivatives while fMRIprep is writing them, and reports every run whose BOLD series and confounds are complete.
+
+        The derivatives index is updated as files appear (with inotify if the `inotify_simple` package is installed, by polling otherwise),
+        so that `runs` and the per-subject methods see the new outputs without crawling the whole tree again.
+
+        Parameters
+        ----------
+        on_run_ready : callable, optional
+            Called from the watcher thread with a `RunReadyEvent` (subject, session, task, run, space, res, bold_path, confounds_path)
+            for every run that becomes ready, e.g. to parcellate it right away: the index of the dataset may be used from that thread.
+            Exceptions raised by the callback are printed and do not stop the watcher. Default is None.
+        backend : str or object, optional
+            'auto', 'inotify' or 'poll'. Default is 'auto'.
+        interval : float, optional
+            The polling interval, in seconds. Default is 10.
+        settle_time : float, optional
+            The number of seconds a file must be left unmodified to be considered complete. Default is 30.
+        start : bool, optional
+            Whether to start watching in a background thread. If False, call `poll()` or `run()` on the watcher. Default is True.
+
+        Returns
+        -------
+        DerivativesWatcher
+            The watcher; call `stop()` to stop it.
+        """
+        def run_ready(event):
+            self._runs = None
+            if on_run_ready is not None:
+                on_run_ready(event)
+
+        watcher = DerivativesWatcher(self.data_path, run_ready, backend = backend, interval = interval, settle_time = settle_time, index_path = self.index.index_path)
+        return watcher.start() if start else watcher
+
+    def _space_entities(self, ts_runs, output_space = None):
+        """
+        Returns the `space` and `res` entities of an output space, e.g. 'MNI152NLin2009cAsym:res-2'.
+
+        If `output_space` is None and the preprocessed runs `ts_runs` are in several spaces, the default output space of `docker_fmriprep`
+        is used if present, otherwise the first space; so that every run is processed once.
+        """
+        if output_space is None:
+            pairs = sorted(set(zip(ts_runs['space'].fillna(''), ts_runs['res'].fillna(''))))
+            if len(pairs) == 0:
+                return {}
+            space, res = ('MNI152NLin2009cAsym', '2') if ('MNI152NLin2009cAsym', '2') in pairs else pairs[0]
+            if len(pairs) > 1:
+                print(f"Several output spaces found, using space-{space}{f'_res-{res}' if res else ''}. Pass output_space to choose another one.")
+            return {'space': space or None, 'res': res or None}
+        label = output_spaces.get(output_space, output_space.replace(':', '_'))
+        space, _, res = label.partition('_res-')
+        return {'space': space, 'res': res or None}
     
     def _find_sub_dirs(self):
         """
-        Finds the subdirectory containing the subject data.
+        Finds the subdirectory containing the subject data (see `derivatives.find_fmriprep_root`).
 
         Returns
         -------
         str
             The path to the subdirectory containing the subject data.
         """
-        path_not_found = True
-        while path_not_found:
-            try:
-                subdirs = os.listdir(self.data_path)
-            except FileNotFoundError as e:
-                if e.filename == self.data_path and e.strerror == 'No such file or directory':
-                    raise FileNotFoundError("The data have not been preprocessed with fmriprep: no 'derivatives' directory found.")
-                else:
-                    raise e
-            for subdir in subdirs:
-                if any(subdir.startswith('sub-') for subdir in subdirs):
-                        path_not_found = False
-                else:
-                    if os.path.isdir(os.path.join(self.data_path, subdir)):
-                        self.data_path = os.path.join(self.data_path, subdir)
-        return self.data_path
+        return find_fmriprep_root(self.BIDS_path + '/derivatives')
     
     def get_ts_paths(self, subject, task, output_space = None): # needs to be adapted to multiple sessions
         #numpy-style docstring
@@ -333,29 +1349,46 @@ class FmriPreppedDataSet(RawDataset):
         subject : str
             The subject ID.
         task : str
-            The ID of the task to preprocess. Default is 'rest'.
+            The ID of the task to preprocess (matched exactly: 'rest' does not select 'restpre'). Default is 'rest'.
+        output_space : str, optional
+            The output space, e.g. 'MNI152NLin2009cAsym:res-2'. If None, a single space is picked (see `_space_entities`). Default is None.
 
         Returns
         -------
         ts_paths : list
-            A list of paths to the time series files.
+            A list of paths to the time series files, sorted by session and run.
         """
-        if output_space == None:
-            output_space = ''
-        else:
-            output_space = output_spaces[output_space]
-        subject_dir = os.path.join(self.data_path, f'sub-{subject}')
-        session_names = self.get_sessions(subject)
-        ts_paths = []
-        if len(session_names) != 0:
-            for session_name in session_names:
-                session_dir = os.path.join(subject_dir, f'ses-{session_name}', 'func')
-                if os.path.exists(session_dir):
-                    ts_paths.extend([f'{session_dir}/{i}' for i in os.listdir(session_dir) if task in i and i.endswith(f'{output_space}_desc-preproc_bold.nii.gz')])
-        else:
-            subject_dir = os.path.join(subject_dir, 'func')
-            ts_paths = [f'{subject_dir}/{i}' for i in os.listdir(subject_dir) if task in i and i.endswith(f'{output_space}_desc-preproc_bold.nii.gz')] 
-        return ts_paths
+        return list(self._select_bold(self.index.table(subject), task, output_space)['path'])
+
+    def _select_bold(self, subject_runs, task, output_space = None):
+        """
+        Selects the preprocessed BOLD series of a task in one output space from the run table of a subject.
+        """
+        ts_runs = filter_runs(subject_runs, task = task, desc = 'preproc', suffix = 'bold', extension = '.nii.gz')
+        return filter_runs(ts_runs, **self._space_entities(ts_runs, output_space))
+
+    def run_manifest(self, subject, task = 'rest', output_space = None):
+        """
+        Resolves all the files of each run of a subject in one pass: BOLD series, confounds, brain mask, JSON sidecar and repetition time.
+
+        Parameters
+        ----------
+        subject : str
+            The label of the participant.
+        task : str, optional
+            The name of the task. Default is 'rest'.
+        output_space : str, optional
+            The output space, e.g. 'MNI152NLin2009cAsym:res-2'. If None, a single space is picked (see `get_ts_paths`). Default is None.
+
+        Returns
+        -------
+        RunManifest
+            The runs of the subject; each BOLD series is paired with the confounds of the same run.
+        """
+        subject_runs = self.index.table(subject)
+        bold = self._select_bold(subject_runs, task, output_space)
+        repetition_times = list(self.index.metadata(list(bold['path']), n_volumes = False)['repetition_time'])
+        return RunManifest.from_table(subject, subject_runs, bold, repetition_times)
     
     def get_sessions(self, subject):
         """
@@ -371,13 +1404,7 @@ class FmriPreppedDataSet(RawDataset):
         list of str
             A list of session names for the given subject.
         """
-        subject_dir = f'{self.data_path}/sub-{subject}'
-        subdirs = os.listdir(subject_dir)
-        session_names = []
-        for subdir in subdirs:
-            if subdir.startswith('ses-'):
-                session_names.append(subdir[4:])
-        return session_names
+        return self.index.sessions(subject)
     
     def _impute_nans_confounds(self, dataframe, pick_confounds = None):
         """
@@ -393,14 +1420,11 @@ class FmriPreppedDataSet(RawDataset):
         df_no_nans : pandas.DataFrame
             The dataframe with the confounds without NaNs.
         """
-        imputer = SimpleImputer(strategy='mean')
         if pick_confounds is None:
             pick_confounds = np.loadtxt(self.default_confounds_path, dtype = 'str')
         if isinstance(pick_confounds, (list, np.ndarray)):
-            df_no_nans = pd.DataFrame(imputer.fit_transform(dataframe), columns=dataframe.columns)[pick_confounds]
-        else:
-            df_no_nans = pd.DataFrame(imputer.fit_transform(dataframe), columns=dataframe.columns)
-        return df_no_nans
+            dataframe = dataframe[list(pick_confounds)]
+        return impute_confounds([dataframe])[0]
     
     def get_confounds(self, subject, task, no_nans = True, pick_confounds = None):
         """
@@ -422,42 +1446,26 @@ class FmriPreppedDataSet(RawDataset):
         list
             A list of confounds.
         """
-        if pick_confounds == None:
+        confound_files = self.index.files(subject, task = task, desc = 'confounds', suffix = 'timeseries', extension = '.tsv')
+        return self._load_confounds(confound_files, no_nans, pick_confounds)
+
+    def _load_confounds(self, confound_files, no_nans = True, pick_confounds = None):
+        """
+        Reads confounds files and keeps the confounds of `pick_confounds` (a file with one confound per line; the default confounds if None).
+        """
+        if pick_confounds is None:
             pick_confounds = np.loadtxt(self.default_confounds_path, dtype = 'str')
         else:
             pick_confounds = np.loadtxt(pick_confounds, dtype = 'str')
-        subject_dir = os.path.join(self.data_path, f'sub-{subject}')
-        session_names = self.get_sessions(subject)
-
-        if len(session_names) != 0:
-            confound_paths = []
-            confound_list = []
-            for session_name in session_names:
-                session_dir = os.path.join(subject_dir, f'ses-{session_name}', 'func')
-                if os.path.exists(session_dir):
-                    confound_files = [os.path.join(session_dir, f) for f in os.listdir(session_dir) if task in f and f.endswith('confounds_timeseries.tsv')]
-                    confound_paths.extend(confound_files)
-                    
-            if no_nans == True:
-                for confounds_path in confound_paths:
-                    confounds = pd.read_csv(confounds_path, sep = '\t')
-                    confounds = self._impute_nans_confounds(confounds)
-                    confound_list.append(confounds)
-            else:
-                for confounds_path in confound_paths:
-                    confounds = pd.read_csv(confounds_path, sep = '\t')[pick_confounds]
-                    confound_list.append(confounds)
-        else:
-            func_dir = os.path.join(subject_dir, "func")
-            confound_files = [os.path.join(func_dir, f) for f in os.listdir(func_dir) if task in f and f.endswith('confounds_timeseries.tsv')]
-            if no_nans == True:
-                confound_list = [self._impute_nans_confounds(pd.read_csv(i, sep = '\t'), pick_confounds) for i in confound_files]
-            else:
-                confound_list = [pd.read_csv(i, sep = '\t') for i in confound_files]
-
-        return confound_list
+        # only the picked columns are read, from a columnar copy of each TSV kept in the derivatives directory
+        cache_dir = os.path.join(self.data_path, CONFOUNDS_CACHE_NAME)
+        confounds = [read_confounds(i, pick_confounds, cache_dir) for i in confound_files]
+        if no_nans == True:
+            # all the runs are imputed together, on the picked columns only
+            return impute_confounds(confounds)
+        return confounds
     
-    def parcellate(self, subject, parcellation = 'schaefer',task ="rest", n_parcels = 1000, gsr = False, output_space = None): # adapt to multiple sessions
+    def parcellate(self, subject, parcellation = 'schaefer',task ="rest", n_parcels = 1000, gsr = False, output_space = None, run_manifest = None):
         """
         Parameters
         ----------
@@ -471,21 +1479,29 @@ class FmriPreppedDataSet(RawDataset):
             number of parcels to use
         gsr : bool  
             whether to use global signal regression
+        output_space : str, optional
+            The output space, e.g. 'MNI152NLin2009cAsym:res-2'. Default is None.
+        run_manifest : RunManifest, optional
+            The runs to parcellate, as returned by `run_manifest`. If None, it is built from `task` and `output_space`. Default is None.
             
         Returns
         -------
         parc_ts_list : list
             list of parcellated time series
         """
+        if run_manifest is None:
+            run_manifest = self.run_manifest(subject, task, output_space)
+        missing = [run.bold_path for run in run_manifest if run.confounds_path is None]
+        if missing:
+            raise FileNotFoundError(f"No confounds found for {', '.join(missing)}.")
         atlas = None
         if parcellation == 'schaefer':
             atlas = datasets.fetch_atlas_schaefer_2018(n_rois=n_parcels, yeo_networks=7, resolution_mm=1, base_url= None, resume=True, verbose=1)
         masker =  NiftiLabelsMasker(labels_img=atlas.maps, standardize=True, memory='nilearn_cache', verbose=5)
 
         parc_ts_list = []
-        subject_ts_paths = self.get_ts_paths(subject, task, output_space = output_space)
-        confounds = self.get_confounds(subject, task)
-        for subject_ts, subject_confounds in zip(subject_ts_paths, confounds):
+        confounds = self._load_confounds(run_manifest.confounds_paths)
+        for subject_ts, subject_confounds in zip(run_manifest.bold_paths, confounds):
             if gsr == False:
                 parc_ts = masker.fit_transform(subject_ts, confounds = subject_confounds.drop("global_signal", axis = 1))
                 parc_ts_list.append(parc_ts)
@@ -520,10 +1536,10 @@ class FmriPreppedDataSet(RawDataset):
         np.ndarray
             The cleaned time series of shape (n_sessions, n_parcels, n_volumes).
         """
-        parc_ts_list = self.parcellate(subject, parcellation, task, n_parcels, gsr, output_space)
+        run_manifest = self.run_manifest(subject, task, output_space)
+        parc_ts_list = self.parcellate(subject, parcellation, task, n_parcels, gsr, output_space, run_manifest = run_manifest)
         clean_ts_array =[]
-        bold_tr = self._bold_tr(subject, task)
-        for parc_ts in parc_ts_list:
+        for parc_ts, bold_tr in zip(parc_ts_list, run_manifest.repetition_times):
             clean_ts = signal.clean(parc_ts, t_r = bold_tr, low_pass=0.08, high_pass=0.01, standardize='zscore_sample', detrend=True)
             print("Shape of clean_ts: ", clean_ts.shape)
             clean_ts_array.append(clean_ts[10:]) # discarding first 10 volumes
@@ -601,4 +1617,254 @@ class FmriPreppedDataSet(RawDataset):
             self.subject_conn_paths[subject] = save_to
 
             np.save(save_to, conn_matrix)
-        return conn_matrix
\ No newline at end of file
+        return conn_matrix
+
+
+class DatasetCollection():
+    """
+    Several fMRIprep-preprocessed datasets (e.g. cohorts with their own BIDS root) queried and processed together.
+
+    Subjects are identified by (dataset, subject) pairs, so that the same subject label in two cohorts does not collide.
+
+    Parameters
+    ----------
+    datasets : list
+        The datasets, as `FmriPreppedDataSet` objects or paths to BIDS roots.
+    names : list of str, optional
+        The name of each dataset, used in the `dataset` column of the tables. By default, the `Name` of the dataset description,
+        or the name of the BIDS directory if it has none; repeated names get a numeric suffix.
+    """
+
+    def __init__(self, datasets, names = None):
+        self.datasets = {}
+        datasets = [FmriPreppedDataSet(dataset) if isinstance(dataset, str) else dataset for dataset in datasets]
+        if names is None:
+            names = [self._default_name(dataset) for dataset in datasets]
+        elif len(names) != len(datasets):
+            raise ValueError("names must have one name per dataset.")
+        for name, dataset in zip(names, datasets):
+            unique_name, i = name, 2
+            while unique_name in self.datasets:
+                unique_name, i = f'{name}-{i}', i + 1
+            self.datasets[unique_name] = dataset
+
+    @staticmethod
+    def _default_name(dataset):
+        try:
+            return dataset.name
+        except (FileNotFoundError, KeyError, ValueError):
+            return os.path.basename(os.path.normpath(dataset.BIDS_path))
+
+    def __getitem__(self, name):
+        return self.datasets[name]
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __repr__(self):
+        return f'DatasetCollection({", ".join(f"{name}: {dataset.BIDS_path}" for name, dataset in self.datasets.items())})'
+
+    @property
+    def subjects(self):
+        """
+        The (dataset, subject) pairs of all datasets.
+        """
+        return [(name, subject) for name, dataset in self.datasets.items() for subject in dataset.subjects]
+
+    def _merge(self, tables):
+        """
+        Stacks one table per dataset into a single table, with the name of the dataset in a first `dataset` column.
+        """
+        tables = [table.assign(dataset = name) for name, table in tables.items()]
+        if len(tables) == 0:
+            return pd.DataFrame(columns = ['dataset'])
+        merged = pd.concat(tables, ignore_index = True)
+        return merged[['dataset'] + [column for column in merged.columns if column != 'dataset']]
+
+    @property
+    def runs(self):
+        """
+        The run tables (`FmriPreppedDataSet.runs`) of all datasets in one table, with a `dataset` column.
+        """
+        return self._merge({name: dataset.runs for name, dataset in self.datasets.items()})
+
+    def select_runs(self, **entities):
+        """
+        Selects the rows of `runs` with exactly the given entities (see `derivatives.filter_runs`); `dataset` can be used as an entity.
+        """
+        return filter_runs(self.runs, **entities)
+
+    def acquisition_metadata(self, **entities):
+        """
+        The acquisition metadata (`FmriPreppedDataSet.acquisition_metadata`) of all datasets in one table, with a `dataset` column.
+        """
+        return self._merge({name: dataset.acquisition_metadata(**entities) for name, dataset in self.datasets.items()})
+
+    def run_fmriprep(self, subjects, fs_license_path, nthreads = 8, mem_mb = 5000, max_parallel = None, total_threads = None, total_mem_mb = None, poll_interval = 1, on_progress = None, on_finished = None, force = False, stats_sampler = None, batch_size = 1, longest_first = True, shard_by = 'subject', work_quota_mb = None, clean_work = True,
+                     max_retries = 0, retry_backoff = 60, retry_mem_factor = 1.5, **kwargs):
+        r"""
+        Runs fMRIprep for the subjects of all datasets, with a single CPU, memory and work directory budget.
+
+        The units of all datasets are queued together, the longest first, so that containers of the next dataset start as soon as
+        resources are free instead of after the last subject of the previous dataset. The run times recorded in any dataset
+        calibrate the cost estimates of all of them (see `RawDataset.estimate_fmriprep_costs`). Each dataset writes its own
+        run times and batch summary.
+
+        Parameters
+        ----------
+        subjects : list of tuple
+            The (dataset, subject) pairs to process. If None, all subjects of all datasets. Default is None.
+        fs_license_path : str
+            The path to the (full) FreeSurfer license file.
+            On Windows, use a raw string literal (e.g. r'C:\path\to\file').
+        on_finished : callable, optional
+            Called with the (dataset, subject or `FmriprepShard`) pair and the exit code whenever a container exits. Default is None.
+        **kwargs
+            The other arguments of `RawDataset.run_fmriprep` (e.g. `nthreads`, `mem_mb`, `total_threads`, `shard_by`, `work_quota_mb`)
+            and of `docker_fmriprep` (e.g. `task`, `output_spaces`, `work_path`). Work directories are prefixed with the dataset name.
+
+        Returns
+        -------
+        dict
+            The exit code of the last fMRIprep container of each (dataset, subject or `FmriprepShard`) pair that was run.
+        """
+        if subjects is None:
+            subjects = self.subjects
+        by_dataset = {}
+        for name, subject in subjects:
+            by_dataset.setdefault(name, []).append(subject)
+        return _run_fmriprep_units({name: self.datasets[name] for name in by_dataset}, by_dataset, fs_license_path, nthreads = nthreads, mem_mb = mem_mb,
+                                   max_parallel = max_parallel, total_threads = total_threads, total_mem_mb = total_mem_mb, poll_interval = poll_interval,
+                                   on_progress = on_progress, on_finished = on_finished, force = force, stats_sampler = stats_sampler, batch_size = batch_size,
+                                   longest_first = longest_first, shard_by = shard_by, work_quota_mb = work_quota_mb, clean_work = clean_work,
+                                   max_retries = max_retries, retry_backoff = retry_backoff, retry_mem_factor = retry_mem_factor, **kwargs)
+
+    def get_conn_matrices(self, subjects = None, n_workers = 2, executor = None, **conn_kwargs):
+        """
+        Computes and saves the connectivity matrices of the subjects of all datasets, in a single pool of workers.
+
+        All subjects are queued at once, so that workers do not wait for the last subjects of a small dataset before starting the next dataset.
+
+        Parameters
+        ----------
+        subjects : list of tuple, optional
+            The (dataset, subject) pairs to process. If None, all subjects of all datasets. Default is None.
+        n_workers : int, optional
+            The number of processes. Default is 2.
+        executor : concurrent.futures.Executor, optional
+            The pool running the computations. If None, a `ProcessPoolExecutor` with `n_workers` processes is used. Default is None.
+        **conn_kwargs
+            Arguments of `FmriPreppedDataSet.get_conn_matrix` (e.g. `task`, `parcellation`, `n_parcels`, `gsr`, `output_space`).
+
+        Returns
+        -------
+        dict
+            The path to the saved connectivity matrix of each (dataset, subject) pair, or the exception raised while computing it.
+        """
+        if subjects is None:
+            subjects = self.subjects
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers = n_workers)
+        try:
+            futures = {(name, subject): executor.submit(_compute_conn_matrix, self.datasets[name].BIDS_path, subject, conn_kwargs) for name, subject in subjects}
+            conn_paths = {}
+            for key, future in futures.items():
+                try:
+                    conn_paths[key] = future.result()
+                except Exception as e:
+                    print(f"Computing the connectivity matrix of sub-{key[1]} of {key[0]} failed: {e!r}")
+                    conn_paths[key] = e
+        finally:
+            if own_executor:
+                executor.shutdown()
+        return conn_paths
+
+def _compute_conn_matrix(BIDS_path, subject, conn_kwargs):
+    """
+    Computes and saves the connectivity matrix of a subject; runs in a worker of `RawDataset.run_pipeline`.
+
+    Returns
+    -------
+    str
+        The path to the saved connectivity matrix.
+    """
+    fmriprepped_data = FmriPreppedDataSet(BIDS_path)
+    fmriprepped_data.get_conn_matrix(subject, save = True, **conn_kwargs)
+    return fmriprepped_data.subject_conn_paths[subject]
+
+
+def _estimate_fmriprep_costs(datasets, keys, task = 'rest'):
+    """
+    Estimates the cost of (dataset name, unit) pairs (see `RawDataset.estimate_fmriprep_costs`).
+
+    The run times recorded in any of the datasets calibrate the header costs of all of them, so that units of different
+    datasets can be compared.
+    """
+    header_costs = {(name, unit_label(unit)): datasets[name]._header_cost(unit, task) for name, unit in keys}
+    past_runtimes, past_costs = {}, {}
+    for name, dataset in datasets.items():
+        for label, entry in dataset.fmriprep_runtimes().items():
+            if entry.get('task') == task:
+                past_runtimes[(name, label)] = entry['wall_time']
+                past_costs[(name, label)] = entry['cost']
+    costs = combine_costs(header_costs, past_runtimes, past_costs)
+    return {(name, unit): costs[(name, unit_label(unit))] for name, unit in keys}
+
+def _run_fmriprep_units(datasets, subjects, fs_license_path, nthreads, mem_mb, max_parallel, total_threads, total_mem_mb, poll_interval, on_progress, on_finished,
+                        force, stats_sampler, batch_size, longest_first, shard_by, work_quota_mb, clean_work, max_retries, retry_backoff, retry_mem_factor, **kwargs):
+    """
+    Runs fMRIprep for the subjects of one or several datasets with a single resource budget (see `RawDataset.run_fmriprep`).
+
+    Units of work are identified by (dataset name, unit) pairs; a batch container only holds subjects of the same dataset.
+    The name of a single dataset is None, and is then left out of the messages and of the work directory labels.
+
+    Parameters
+    ----------
+    datasets : dict
+        The `RawDataset` of each dataset name.
+    subjects : dict
+        The labels of the participants to process in each dataset.
+
+    The other parameters are those of `RawDataset.run_fmriprep`, except that `on_finished` is called with the (dataset name, unit) pair.
+
+    Returns
+    -------
+    dict
+        The exit code of the last fMRIprep container of each (dataset name, unit) pair that was run.
+    """
+    task = kwargs.get('task', 'rest')
+    spaces = kwargs.get('output_spaces', 'MNI152NLin2009cAsym:res-2')
+    if shard_by != 'subject' and batch_size != 1:
+        raise ValueError("Shards cannot be batched: use batch_size = 1 with shard_by = 'session' or 'run'.")
+    units = []
+    for name, dataset in datasets.items():
+        if shard_by != 'subject':
+            dataset_units = dataset.get_fmriprep_shards(subjects[name], shard_by, task, spaces, force)
+        elif not force:
+            complete = [subject for subject in subjects[name] if dataset.fmriprep_complete(subject, task, spaces)]
+            if complete:
+                print(f"Skipping {len(complete)} subject(s) with complete fMRIprep outputs{'' if name is None else f' in {name}'}: {', '.join(complete)}.")
+            dataset_units = [subject for subject in subjects[name] if subject not in complete]
+        else:
+            dataset_units = list(subjects[name])
+        units += [(name, unit) for unit in dataset_units]
+
+    total_threads = host_cpu_count() if total_threads is None else total_threads
+    if total_mem_mb is None and host_memory_mb() is not None:
+        total_mem_mb = int(HOST_MEMORY_FRACTION * host_memory_mb())
+    if stats_sampler is True:
+        stats_sampler = DockerStatsSampler()
+    work_root = kwargs.pop('work_path', os.path.expanduser('~'))
+    work_dirs = WorkDirManager(os.path.join(work_root, 'fmriprep_work'), work_quota_mb, clean_on_success = clean_work)
+    scheduler = FmriprepScheduler(datasets, fs_license_path, ResourceBudget(total_threads, total_mem_mb, max_parallel), work_dirs,
+                                  on_progress = on_progress, on_finished = on_finished, stats_sampler = stats_sampler, max_retries = max_retries,
+                                  retry_backoff = retry_backoff, retry_mem_factor = retry_mem_factor, poll_interval = poll_interval, submit_kwargs = kwargs)
+    scheduler.plan(units, nthreads, mem_mb, batch_size, costs = _estimate_fmriprep_costs(datasets, units, task) if longest_first else None)
+    if nthreads == 'auto' or mem_mb == 'auto':
+        sizes = np.array(list(scheduler.resources.values()))
+        if len(sizes):
+            print(f"Estimated resources per {shard_by}: nthreads {sizes[:, 0].min()}-{sizes[:, 0].max()}, mem_mb {sizes[:, 1].min()}-{sizes[:, 1].max()}.")
+    returncodes = scheduler.run()
+    scheduler.write_summaries()
+    return returncodes
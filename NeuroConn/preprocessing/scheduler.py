@@ -0,0 +1,788 @@
+import os
+import re
+import shutil
+import time
+from collections import namedtuple
+import numpy as np
+
+FMRIPREP_BASE_MEM_MB = 4000
+# fMRIprep keeps a few float32 copies of a BOLD run in memory while resampling it
+FMRIPREP_RUN_COPIES = 4
+# MB of BOLD data per thread; fMRIprep does not scale much beyond 8 threads per subject
+FMRIPREP_MB_PER_THREAD = 250
+FMRIPREP_MAX_THREADS = 8
+# threads of a container without BOLD runs, i.e. the anatomical workflow only
+FMRIPREP_ANAT_THREADS = 4
+# rough size of the work directory of a container: the anatomical workflow and templates, plus many intermediate float32 copies of each BOLD run
+FMRIPREP_WORK_BASE_MB = 5000
+FMRIPREP_WORK_RUN_COPIES = 30
+# share of the host memory given to containers, the rest is left to the system and to this process
+HOST_MEMORY_FRACTION = 0.9
+
+
+def host_cpu_count():
+    """
+    Returns the number of CPUs available to the current process.
+
+    Returns
+    -------
+    int
+        The number of usable CPUs.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def host_memory_mb():
+    """
+    Returns the total physical memory of the host, in MB.
+
+    Returns
+    -------
+    int or None
+        The total memory in MB, or None if it cannot be determined on this system.
+    """
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 2)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_fmriprep_resources(bold_shapes, max_threads = FMRIPREP_MAX_THREADS):
+    """
+    Picks the number of threads and the memory of an fMRIprep container from the BOLD runs it will process.
+
+    The memory grows with the largest run, which fMRIprep holds several times in memory while resampling it;
+    the number of threads grows with the total amount of BOLD data. Without BOLD runs (the anatomical workflow only),
+    the container gets `FMRIPREP_ANAT_THREADS` threads and the base memory.
+
+    Parameters
+    ----------
+    bold_shapes : list of tuple
+        The shapes (x, y, z, volumes) of the BOLD runs, e.g. from the NIfTI headers.
+    max_threads : int, optional
+        The maximum number of threads. Default is 8.
+
+    Returns
+    -------
+    tuple of int
+        The (nthreads, mem_mb) of the container.
+    """
+    run_mb = [np.prod(shape, dtype = float) * 4 / 1024 ** 2 for shape in bold_shapes]
+    if not run_mb:
+        return min(max_threads, FMRIPREP_ANAT_THREADS), FMRIPREP_BASE_MEM_MB
+    mem_mb = FMRIPREP_BASE_MEM_MB + FMRIPREP_RUN_COPIES * max(run_mb)
+    mem_mb = int(np.ceil(mem_mb / 500) * 500)
+    nthreads = int(min(max_threads, max(2, np.ceil(sum(run_mb) / FMRIPREP_MB_PER_THREAD))))
+    return nthreads, mem_mb
+
+def estimate_work_dir_mb(bold_shapes):
+    """
+    Estimates the largest size the work directory of an fMRIprep container reaches, from the BOLD runs it will process.
+
+    Parameters
+    ----------
+    bold_shapes : list of tuple
+        The shapes (x, y, z, volumes) of the BOLD runs, e.g. from the NIfTI headers.
+
+    Returns
+    -------
+    int
+        The size in MB.
+    """
+    run_mb = sum(np.prod(shape, dtype = float) * 4 / 1024 ** 2 for shape in bold_shapes)
+    return int(FMRIPREP_WORK_BASE_MB + FMRIPREP_WORK_RUN_COPIES * run_mb)
+
+def combine_costs(header_costs, past_runtimes, past_costs = None):
+    """
+    Turns header-based cost estimates into run times, using the past run times of some of the units.
+
+    Units with a past run time keep it; the others get their header cost scaled by the median
+    run time per unit of header cost of the past runs. Without any past run time, the header costs are returned as they are.
+
+    Parameters
+    ----------
+    header_costs : dict
+        The cost of each unit estimated from the BOLD headers (e.g. volumes x voxels).
+    past_runtimes : dict
+        The wall time, in seconds, of units that were run before, including units that are not in `header_costs`.
+    past_costs : dict, optional
+        The header costs of the units of `past_runtimes` that are not in `header_costs`. Default is None.
+
+    Returns
+    -------
+    dict
+        The estimated cost of each unit of `header_costs`.
+    """
+    costs = {**(past_costs or {}), **header_costs}
+    rates = [past_runtimes[unit] / costs[unit] for unit in past_runtimes if costs.get(unit, 0) > 0]
+    if not rates:
+        return dict(header_costs)
+    rate = float(np.median(rates))
+    return {unit: past_runtimes.get(unit, cost * rate) for unit, cost in header_costs.items()}
+
+
+class FmriprepShard(namedtuple('FmriprepShard', ['subject', 'session', 'run', 'anat_only'], defaults = (False,))):
+    """
+    A part of a subject that fMRIprep can process on its own: the anatomical workflow, one session, or one run of a session.
+
+    `session` and `run` are None when the shard is not restricted to a session or a run. With `anat_only`, the shard runs
+    the anatomical workflow of the subject (`--anat-only`); the functional shards of the subject then reuse its outputs,
+    so that the anatomy is processed once and not by every shard at the same time.
+    """
+    __slots__ = ()
+
+    @property
+    def label(self):
+        label = f'sub-{self.subject}'
+        if self.anat_only:
+            return label + '_anat'
+        if self.session is not None:
+            label += f'_ses-{self.session}'
+        if self.run is not None:
+            label += f'_run-{self.run}'
+        return label
+
+    def bids_filter(self, task = None):
+        """
+        Returns the content of the `--bids-filter-file` that restricts fMRIprep to this shard.
+
+        Only the functional data are filtered, so the anatomical workflow still uses all the sessions of the subject.
+
+        Parameters
+        ----------
+        task : str, optional
+            The name of the task to preprocess. Default is None (all tasks).
+
+        Returns
+        -------
+        dict
+            The BIDS filters.
+        """
+        bold = {}
+        if self.session is not None:
+            bold['session'] = self.session
+        if task is not None:
+            bold['task'] = task
+        if self.run is not None:
+            bold['run'] = int(self.run) if str(self.run).isdigit() else self.run
+        filters = {'bold': bold, 'sbref': dict(bold)}
+        if self.session is not None:
+            filters['fmap'] = {'session': self.session}
+        return filters
+
+
+def unit_label(unit):
+    """
+    Returns the label of a unit of work of `run_fmriprep`: 'sub-XX' for a subject, `FmriprepShard.label` for a shard.
+    """
+    return unit.label if isinstance(unit, FmriprepShard) else f'sub-{unit}'
+
+
+class ResourceBudget():
+    """
+    Keeps track of the CPU and memory used by concurrently running fMRIPrep containers.
+
+    Parameters
+    ----------
+    total_threads : int
+        The total number of threads that running containers may use together.
+    total_mem_mb : int, optional
+        The total memory, in MB, that running containers may use together. If None, memory is not limited. Default is None.
+    max_parallel : int, optional
+        The maximum number of containers running at the same time. If None, only threads and memory are limited. Default is None.
+    """
+
+    def __init__(self, total_threads, total_mem_mb = None, max_parallel = None):
+        if total_threads is None or total_threads < 1:
+            raise ValueError("total_threads must be a positive integer.")
+        if max_parallel is not None and max_parallel < 1:
+            raise ValueError("max_parallel must be a positive integer.")
+        self.total_threads = total_threads
+        self.total_mem_mb = total_mem_mb
+        self.max_parallel = max_parallel
+        self.used_threads = 0
+        self.used_mem_mb = 0
+        self.n_running = 0
+
+    def clamp(self, nthreads, mem_mb):
+        """
+        Shrinks a request so that it fits into an empty budget.
+
+        Parameters
+        ----------
+        nthreads : int
+            The number of threads requested.
+        mem_mb : int
+            The memory requested, in MB.
+
+        Returns
+        -------
+        tuple of int
+            The (nthreads, mem_mb) that can actually be granted.
+        """
+        nthreads = min(nthreads, self.total_threads)
+        if self.total_mem_mb is not None:
+            mem_mb = min(mem_mb, self.total_mem_mb)
+        return nthreads, mem_mb
+
+    def fits(self, nthreads, mem_mb, reserved = None):
+        """
+        Checks whether a container with the given resources can be started now.
+
+        Parameters
+        ----------
+        nthreads : int
+            The number of threads requested.
+        mem_mb : int
+            The memory requested, in MB.
+        reserved : tuple of int, optional
+            The (nthreads, mem_mb) of a container that is waiting for resources. The request only fits if the budget could still
+            hold that container, so that starting it now does not delay the waiting one. Default is None.
+
+        Returns
+        -------
+        bool
+            True if the request fits into the remaining budget.
+        """
+        n_containers = 1
+        if reserved is not None:
+            nthreads, mem_mb, n_containers = nthreads + reserved[0], mem_mb + reserved[1], 2
+        if self.max_parallel is not None and self.n_running + n_containers > self.max_parallel:
+            return False
+        if self.used_threads + nthreads > self.total_threads:
+            return False
+        if self.total_mem_mb is not None and self.used_mem_mb + mem_mb > self.total_mem_mb:
+            return False
+        return True
+
+    def acquire(self, nthreads, mem_mb):
+        self.used_threads += nthreads
+        self.used_mem_mb += mem_mb
+        self.n_running += 1
+
+    def release(self, nthreads, mem_mb):
+        self.used_threads -= nthreads
+        self.used_mem_mb -= mem_mb
+        self.n_running -= 1
+
+    def __repr__(self):
+        return f'ResourceBudget(threads={self.used_threads}/{self.total_threads}, mem_mb={self.used_mem_mb}/{self.total_mem_mb}, running={self.n_running})'
+
+
+def directory_size_mb(path):
+    """
+    Returns the total size of the files under a directory, in MB.
+
+    Parameters
+    ----------
+    path : str
+        The directory.
+
+    Returns
+    -------
+    float
+        The size in MB (0 if the directory does not exist).
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks = False):
+                        total += entry.stat(follow_symlinks = False).st_size
+                except FileNotFoundError:
+                    continue
+    return total / 1024 ** 2
+
+
+class WorkDirManager():
+    """
+    Gives every fMRIprep container its own work directory under a common root, and removes it once the container succeeded.
+
+    Work directories of failed containers are kept for debugging. With a size cap, `has_room` tells the scheduler
+    to pause new launches while the work directories take more space than allowed. A container reserves the size its
+    work directory is expected to reach when it starts, so that containers started together cannot overshoot the cap
+    before they have written anything.
+
+    Parameters
+    ----------
+    root : str
+        The directory under which the work directories are created.
+    max_total_mb : int, optional
+        The maximum total size of the work directories, in MB. If None, the size is not limited. Default is None.
+    clean_on_success : bool, optional
+        Whether to delete the work directory of a container that exited with code 0. Default is True.
+    check_interval : float, optional
+        The minimum number of seconds between two measurements of the size of `root`, which is slow for large trees. Default is 60.
+    """
+
+    def __init__(self, root, max_total_mb = None, clean_on_success = True, check_interval = 60):
+        self.root = root
+        self.max_total_mb = max_total_mb
+        self.clean_on_success = clean_on_success
+        self.check_interval = check_interval
+        self._sizes = {}
+        self._measured_at = None
+        self._reserved = {}
+
+    def path(self, label, reserve_mb = 0):
+        """
+        Creates and returns the work directory of a container.
+
+        Parameters
+        ----------
+        label : str
+            The label of the container, e.g. 'sub-01' or 'sub-01_ses-2'.
+        reserve_mb : float, optional
+            The size the work directory is expected to reach, in MB (see `estimate_work_dir_mb`). Until `release` is called,
+            the directory counts with at least this size. Default is 0.
+
+        Returns
+        -------
+        str
+            The path to the work directory.
+        """
+        path = os.path.join(self.root, label)
+        os.makedirs(path, exist_ok = True)
+        self._reserved[label] = reserve_mb
+        return path
+
+    def release(self, label, success):
+        """
+        Drops the reservation of a container, and removes its work directory if it succeeded; keeps it otherwise.
+
+        Parameters
+        ----------
+        label : str
+            The label of the container.
+        success : bool
+            Whether the container exited successfully.
+
+        Returns
+        -------
+        bool
+            True if the work directory was removed.
+        """
+        self._reserved.pop(label, None)
+        path = os.path.join(self.root, label)
+        if not success:
+            if os.path.exists(path):
+                print(f"Keeping the work directory of the failed run: {path}")
+            return False
+        if not self.clean_on_success:
+            return False
+        failed = []
+
+        def on_error(function, failed_path, exc_info):
+            failed.append(failed_path)
+
+        shutil.rmtree(path, onerror = on_error)
+        self._measured_at = None
+        if failed:
+            print(f"Could not remove {len(failed)} file(s) of the work directory {path}, e.g. {failed[0]}. Files the container wrote as root "
+                  "have to be removed as root, or the container has to run with your user ID (e.g. docker run -u $(id -u):$(id -g)).")
+            return False
+        return True
+
+    def _measure(self):
+        now = time.time()
+        if self._measured_at is None or now - self._measured_at >= self.check_interval:
+            try:
+                with os.scandir(self.root) as entries:
+                    children = [entry for entry in entries if entry.is_dir(follow_symlinks = False)]
+            except FileNotFoundError:
+                children = []
+            self._sizes = {entry.name: directory_size_mb(entry.path) for entry in children}
+            self._measured_at = now
+        return self._sizes
+
+    def usage_mb(self):
+        """
+        Returns the total size of the work directories, in MB, measured at most every `check_interval` seconds.
+        """
+        return sum(self._measure().values())
+
+    def committed_mb(self):
+        """
+        Returns the size of the work directories in MB, counting the directory of each running container with at least its reserved size.
+        """
+        sizes = self._measure()
+        return sum(max(sizes.get(label, 0), self._reserved.get(label, 0)) for label in set(sizes) | set(self._reserved))
+
+    def has_room(self, reserve_mb = 0):
+        """
+        Checks whether a container reserving `reserve_mb` may be started without exceeding the size cap.
+
+        When no container is running, a container may be started as long as the work directories are below the cap,
+        even if its reservation does not fit, since nothing else could free space.
+
+        Parameters
+        ----------
+        reserve_mb : float, optional
+            The size the work directory of the new container is expected to reach, in MB. Default is 0.
+
+        Returns
+        -------
+        bool
+            True if a new container may be started.
+        """
+        if self.max_total_mb is None:
+            return True
+        if not self._reserved:
+            return self.usage_mb() < self.max_total_mb
+        return self.committed_mb() + reserve_mb <= self.max_total_mb
+
+
+FmriprepLaunch = namedtuple('FmriprepLaunch', ['batch', 'label', 'work_label', 'job', 'nthreads', 'mem_mb'])
+
+
+class FmriprepScheduler():
+    """
+    Runs the fMRIprep units of one or several datasets in containers that share a resource budget and a work directory quota.
+
+    Units of work are identified by (dataset name, unit) pairs, where a unit is a subject label or a `FmriprepShard`.
+    The name of a single dataset is None, and is then left out of the messages and of the work directory labels.
+    The work is split in steps that can be used on their own: `plan` orders the units and groups them in batches,
+    `launch_ready` starts the pending batches that can start now, and `check_running` handles the containers that exited,
+    queuing failed batches again for a retry. `run` repeats the last two until every batch is done.
+
+    Parameters
+    ----------
+    datasets : dict
+        The `RawDataset` of each dataset name.
+    fs_license_path : str
+        The path to the FreeSurfer license file.
+    budget : ResourceBudget
+        The threads and memory that running containers may use together.
+    work_dirs : WorkDirManager
+        The work directories of the containers.
+    on_progress : callable, optional
+        Called with each new fMRIprep log line. Default is None.
+    on_finished : callable, optional
+        Called with the (dataset name, unit) pair and the exit code once a unit is done. Default is None.
+    stats_sampler : callable, optional
+        Measures the resources used by a running container (see `RawDataset.submit_fmriprep`). Default is None.
+    max_retries : int, optional
+        The number of times a failed batch is started again. Default is 0.
+    retry_backoff : float, optional
+        The number of seconds to wait before the first retry, doubled for each further retry. Default is 60.
+    retry_mem_factor : float, optional
+        The factor applied to the memory of a batch at each retry. Default is 1.5.
+    poll_interval : float, optional
+        The number of seconds between two checks of the running containers. Default is 1.
+    submit_kwargs : dict, optional
+        Additional keyword arguments passed to `RawDataset.submit_fmriprep`. Default is None.
+    """
+
+    def __init__(self, datasets, fs_license_path, budget, work_dirs, on_progress = None, on_finished = None, stats_sampler = None,
+                 max_retries = 0, retry_backoff = 60, retry_mem_factor = 1.5, poll_interval = 1, submit_kwargs = None):
+        self.datasets = datasets
+        self.fs_license_path = fs_license_path
+        self.budget = budget
+        self.work_dirs = work_dirs
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.stats_sampler = stats_sampler
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_mem_factor = retry_mem_factor
+        self.poll_interval = poll_interval
+        self.submit_kwargs = {} if submit_kwargs is None else dict(submit_kwargs)
+        self.task = self.submit_kwargs.get('task', 'rest')
+        self.pending = []
+        self.running = []
+        self.resources = {}
+        self.work_estimates = {}
+        self.requires = {}
+        self.returncodes = {}
+        self.failures = {}
+        self.attempts = {}
+        self.not_run = []
+        self._not_before = {}
+        self._paused = False
+
+    def label(self, key):
+        """
+        Returns the label of a (dataset name, unit) pair in messages.
+        """
+        return unit_label(key[1]) if key[0] is None else f'{key[0]}: {unit_label(key[1])}'
+
+    def plan(self, units, nthreads, mem_mb, batch_size = 1, costs = None):
+        """
+        Orders the units, groups them in batches and resolves the resources of each unit.
+
+        Batches never mix datasets and keep the rank of their first unit. The functional shards of a subject wait for its
+        anatomical shard, if it is planned too.
+
+        Parameters
+        ----------
+        units : list of tuple
+            The (dataset name, unit) pairs to run.
+        nthreads : int or 'auto'
+            The number of threads of a unit (see `RawDataset._resolve_resources`).
+        mem_mb : int or 'auto'
+            The memory of a unit, in MB.
+        batch_size : int, optional
+            The number of subjects of the same dataset run in one container. Default is 1.
+        costs : dict, optional
+            The estimated cost of each unit. If given, the most expensive units are started first; otherwise units keep their order.
+            Default is None.
+
+        Returns
+        -------
+        list of list
+            The batches, in launch order.
+        """
+        if costs is not None:
+            costs = dict(costs)
+            # the anatomical shard of a subject holds up all its other shards, so it goes first
+            for name, unit in units:
+                if isinstance(unit, FmriprepShard) and unit.anat_only:
+                    costs[(name, unit)] = sum(cost for (other_name, other), cost in costs.items()
+                                              if other_name == name and isinstance(other, FmriprepShard) and other.subject == unit.subject)
+            units = sorted(units, key = costs.get, reverse = True)
+        planned = set(units)
+        for name, unit in units:
+            if isinstance(unit, FmriprepShard) and not unit.anat_only and (name, FmriprepShard(unit.subject, None, None, True)) in planned:
+                self.requires[(name, unit)] = (name, FmriprepShard(unit.subject, None, None, True))
+            self.resources[(name, unit)] = self.datasets[name]._resolve_resources(unit, nthreads, mem_mb, self.task)
+            if self.work_dirs.max_total_mb is not None:
+                self.work_estimates[(name, unit)] = self.datasets[name].estimate_fmriprep_work_mb(unit, self.task)
+        batches = []
+        open_batches = {}
+        for key in units:
+            batch = open_batches.get(key[0])
+            if batch is None or len(batch) == batch_size:
+                batch = open_batches[key[0]] = []
+                batches.append(batch)
+            batch.append(key)
+        self.pending += batches
+        return batches
+
+    def launch_ready(self):
+        """
+        Starts the pending batches that can start now, in order.
+
+        A batch waits for its retry backoff, for the anatomical shard it requires, for room in the work directory quota
+        and for resources. The resources of the first batch that does not fit are held back from the batches behind it,
+        so that smaller batches cannot delay it forever.
+
+        Returns
+        -------
+        list of FmriprepLaunch
+            The containers started.
+        """
+        waiting = None
+        started = []
+        for batch in list(self.pending):
+            if not self._check_ready(batch):
+                continue
+            work_mb = sum(self.work_estimates.get(key, 0) for key in batch)
+            if not self._check_work_room(work_mb):
+                break
+            nthreads, mem_mb = self.budget.clamp(sum(self.resources[key][0] for key in batch), sum(self.resources[key][1] for key in batch))
+            if not self.budget.fits(nthreads, mem_mb, reserved = waiting):
+                waiting = waiting or (nthreads, mem_mb)
+                continue
+            started.append(self.launch(batch, nthreads, mem_mb, work_mb))
+        return started
+
+    def _check_ready(self, batch):
+        # a batch whose anatomical shard failed is given up with the same exit code
+        if time.time() < self._not_before.get(tuple(batch), 0):
+            return False
+        required = self.requires.get(batch[0])
+        if required is None:
+            return True
+        if required not in self.returncodes:
+            return False
+        if self.returncodes[required] != 0:
+            self.pending.remove(batch)
+            print(f"Skipping {self.label(batch[0])}, as the anatomical workflow of sub-{batch[0][1].subject} failed.")
+            self.failures[batch[0]] = dict(self.failures[required], attempts = 0, crash_files = [])
+            self._finish(batch[0], self.returncodes[required])
+            return False
+        return True
+
+    def _check_work_room(self, work_mb):
+        # while the quota is exceeded launches pause; when no running container can free space, the pending batches are given up
+        if self.work_dirs.has_room(work_mb):
+            self._paused = False
+            return True
+        if not self.running:
+            self.not_run = [key for batch in self.pending for key in batch]
+            print(f"The work directories in {self.work_dirs.root} take {self.work_dirs.usage_mb():.0f} MB, more than work_quota_mb = {self.work_dirs.max_total_mb}, "
+                  f"and no running container can free space. Not starting the {len(self.not_run)} remaining unit(s); remove the work directories of failed runs.")
+            self.pending = []
+        elif not self._paused:
+            print(f"Work directories take {self.work_dirs.usage_mb():.0f} MB ({self.work_dirs.committed_mb():.0f} MB with the space reserved by running containers), "
+                  "pausing new containers until space is freed.")
+            self._paused = True
+        return False
+
+    def work_label(self, batch):
+        """
+        Returns the name of the work directory of a batch.
+        """
+        units = [unit for _, unit in batch]
+        if isinstance(units[0], FmriprepShard):
+            label = units[0].label
+        elif len(units) == 1:
+            label = f'sub-{units[0]}'
+        else:
+            label = f'batch-{units[0]}-{units[-1]}'
+        if batch[0][0] is not None:
+            # the same subject label may exist in several datasets
+            label = re.sub(r'[^\w.-]', '_', batch[0][0]) + '_' + label
+        return label
+
+    def launch(self, batch, nthreads, mem_mb, work_mb = 0):
+        """
+        Starts the container of a pending batch.
+
+        Parameters
+        ----------
+        batch : list of tuple
+            The (dataset name, unit) pairs of the batch.
+        nthreads : int
+            The number of threads of the container.
+        mem_mb : int
+            The memory of the container, in MB.
+        work_mb : float, optional
+            The size reserved for its work directory, in MB. Default is 0.
+
+        Returns
+        -------
+        FmriprepLaunch
+            The started container.
+        """
+        self.pending.remove(batch)
+        dataset = self.datasets[batch[0][0]]
+        units = [unit for _, unit in batch]
+        label = ', '.join(self.label(key) for key in batch)
+        work_label = self.work_label(batch)
+        print(f"Starting fMRIprep for {label} ({self.budget}).")
+        kwargs = dict(self.submit_kwargs, mem_mb = mem_mb, stats_sampler = self.stats_sampler, work_path = self.work_dirs.path(work_label, work_mb))
+        if isinstance(units[0], FmriprepShard):
+            shard = units[0]
+            job = dataset.submit_fmriprep(shard.subject, self.fs_license_path, nthreads, session = shard.session, run = shard.run,
+                                          anat_only = shard.anat_only, own_work_dir = False, **kwargs)
+        elif len(units) == 1:
+            job = dataset.submit_fmriprep(units[0], self.fs_license_path, nthreads, **kwargs)
+        else:
+            job = dataset.submit_fmriprep(units, self.fs_license_path, nthreads, omp_nthreads = min(max(self.resources[key][0] for key in batch), nthreads), **kwargs)
+        self.budget.acquire(nthreads, mem_mb)
+        self.attempts[tuple(batch)] = self.attempts.get(tuple(batch), 0) + 1
+        launch = FmriprepLaunch(batch, label, work_label, job, nthreads, mem_mb)
+        self.running.append(launch)
+        return launch
+
+    def check_running(self):
+        """
+        Reads the new log lines of the running containers and handles those that exited (see `complete`).
+
+        Returns
+        -------
+        list of FmriprepLaunch
+            The containers that exited.
+        """
+        exited = []
+        for launch in list(self.running):
+            launch.job.new_log_lines(on_progress = self.on_progress)
+            if launch.job.done():
+                self.complete(launch)
+                exited.append(launch)
+        return exited
+
+    def complete(self, launch):
+        """
+        Handles a container that exited: frees its resources and its work directory, then either queues its batch again
+        for a retry, with more memory and after a backoff, or records the exit code of its units.
+
+        Parameters
+        ----------
+        launch : FmriprepLaunch
+            The container that exited.
+
+        Returns
+        -------
+        int
+            The exit code of the container.
+        """
+        batch = launch.batch
+        dataset = self.datasets[batch[0][0]]
+        units = [unit for _, unit in batch]
+        subjects = sorted({unit.subject if isinstance(unit, FmriprepShard) else unit for unit in units})
+        returncode, crash_files = dataset._check_fmriprep_job(launch.job, subjects)
+        self.budget.release(launch.nthreads, launch.mem_mb)
+        self.work_dirs.release(launch.work_label, returncode == 0)
+        self.running.remove(launch)
+        print(f"fMRIprep finished for {launch.label} with exit code {returncode}.")
+        attempt = self.attempts[tuple(batch)]
+        if returncode != 0 and attempt <= self.max_retries:
+            self.retry(batch)
+            return returncode
+        if returncode == 0 and attempt == 1:
+            # a retry resumes from the work directory, so only first attempts tell how long a unit takes
+            dataset._record_fmriprep_runtime(units, launch.job.wall_time, self.task)
+        for key in batch:
+            if returncode != 0:
+                self.failures[key] = {'returncode': returncode, 'attempts': attempt, 'mem_mb': launch.mem_mb, 'log_path': launch.job.log_path, 'crash_files': crash_files}
+            self._finish(key, returncode)
+        return returncode
+
+    def retry(self, batch):
+        """
+        Queues a failed batch again, with `retry_mem_factor` times more memory, after `retry_backoff` seconds doubled at each attempt.
+        """
+        attempt = self.attempts[tuple(batch)]
+        delay = self.retry_backoff * 2 ** (attempt - 1)
+        for key in batch:
+            self.resources[key] = (self.resources[key][0], int(self.resources[key][1] * self.retry_mem_factor))
+        label = ', '.join(self.label(key) for key in batch)
+        print(f"Retrying {label} in {delay:.0f} s with mem_mb {sum(self.resources[key][1] for key in batch)} (attempt {attempt + 1} of {self.max_retries + 1}).")
+        self._not_before[tuple(batch)] = time.time() + delay
+        self.pending.append(batch)
+
+    def _finish(self, key, returncode):
+        self.returncodes[key] = returncode
+        if self.on_finished is not None:
+            self.on_finished(key, returncode)
+
+    def run(self):
+        """
+        Starts and checks containers until every pending batch is done.
+
+        Returns
+        -------
+        dict
+            The exit code of the last container of each (dataset name, unit) pair that was run.
+        """
+        try:
+            while self.pending or self.running:
+                self.launch_ready()
+                self.check_running()
+                if self.pending or self.running:
+                    time.sleep(self.poll_interval)
+        finally:
+            # containers run in their own session, so an interrupt (e.g. Ctrl-C) or an error does not stop them by itself
+            for launch in self.running:
+                launch.job.cancel()
+        return self.returncodes
+
+    def write_summaries(self):
+        """
+        Writes the summary of each dataset, which only holds its own units (see `RawDataset._write_fmriprep_summary`).
+        """
+        for name, dataset in self.datasets.items():
+            dataset._write_fmriprep_summary({unit: returncode for (other, unit), returncode in self.returncodes.items() if other == name},
+                                            {unit: failure for (other, unit), failure in self.failures.items() if other == name},
+                                            {tuple(unit for _, unit in batch): n for batch, n in self.attempts.items() if batch[0][0] == name},
+                                            [unit for other, unit in self.not_run if other == name])
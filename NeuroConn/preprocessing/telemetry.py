@@ -0,0 +1,203 @@
+import json
+import os
+import re
+import subprocess as sp
+import threading
+import time
+
+SIZE_UNITS = {
+    'b': 1,
+    'kb': 1e3, 'mb': 1e6, 'gb': 1e9, 'tb': 1e12,
+    'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3, 'tib': 1024 ** 4,
+}
+
+def parse_size(size):
+    """
+    Converts a size as printed by `docker stats` (e.g. '1.5GiB', '300kB') to bytes.
+
+    Parameters
+    ----------
+    size : str
+        The size with its unit.
+
+    Returns
+    -------
+    float
+        The size in bytes.
+    """
+    match = re.match(r'\s*([\d.]+)\s*([a-zA-Z]*)', size)
+    if match is None:
+        raise ValueError(f"Cannot parse size '{size}'.")
+    value, unit = match.groups()
+    return float(value) * SIZE_UNITS.get(unit.lower() or 'b', 1)
+
+def parse_docker_stats(stats):
+    """
+    Extracts the resource usage from one `docker stats --format "{{json .}}"` record.
+
+    Parameters
+    ----------
+    stats : dict
+        The decoded JSON record.
+
+    Returns
+    -------
+    dict
+        The memory in use (`mem_mb`), the CPU usage in percent of one CPU (`cpu_percent`)
+        and the number of bytes written to block devices since the container started (`block_write_bytes`).
+    """
+    return {
+        'mem_mb': parse_size(stats['MemUsage'].split('/')[0]) / 1024 ** 2,
+        'cpu_percent': float(stats['CPUPerc'].strip().rstrip('%') or 0),
+        'block_write_bytes': parse_size(stats['BlockIO'].split('/')[1]),
+    }
+
+
+class DockerStatsSampler():
+    """
+    Samples the resource usage of the container of an fMRIprep job with `docker stats`.
+
+    The container is found among the running containers by the bind mount of the job's work directory (`FmriprepJob.work_path`),
+    which is different for every container, also for the shards of a subject or equal subject labels of different datasets.
+    This works both for `docker run` and for the `fmriprep-docker` wrapper.
+    Any callable taking an `FmriprepJob` and returning a dict like `parse_docker_stats` (or None) can be used instead,
+    e.g. a fake sampler in tests.
+    """
+
+    def __init__(self):
+        self._containers = {}
+
+    def __call__(self, job):
+        container = self._find_container(job)
+        if container is None:
+            return None
+        out = _docker(['stats', '--no-stream', '--format', '{{json .}}', container])
+        if out is None or not out.strip():
+            self._containers.pop(job.work_path, None)
+            return None
+        return parse_docker_stats(json.loads(out.splitlines()[0]))
+
+    def _find_container(self, job):
+        if job.work_path is None:
+            return None
+        if job.work_path in self._containers:
+            return self._containers[job.work_path]
+        containers = _docker(['ps', '--quiet', '--no-trunc'])
+        if not containers or not containers.split():
+            return None
+        out = _docker(['inspect', '--format', '{{.Id}}{{range .Mounts}}\t{{.Source}}{{end}}'] + containers.split())
+        if out is None:
+            return None
+        work_path = os.path.realpath(job.work_path)
+        for line in out.splitlines():
+            container, *sources = line.split('\t')
+            if any(os.path.realpath(source) == work_path for source in sources):
+                self._containers[job.work_path] = container
+                return container
+        return None
+
+def _docker(args):
+    # the output of a docker command, or None if it failed or docker is not installed
+    try:
+        out = sp.run(['docker'] + args, stdout = sp.PIPE, stderr = sp.DEVNULL, universal_newlines = True)
+    except OSError:
+        return None
+    return out.stdout if out.returncode == 0 else None
+
+
+class ResourceMonitor():
+    """
+    Accumulates resource samples of a running container into peak memory, CPU time and bytes written.
+
+    Samples are taken from a background thread (see `start`), so that slow `docker` calls do not hold up the code polling the job.
+
+    Parameters
+    ----------
+    sampler : callable
+        Called with the job, returns a dict with `mem_mb`, `cpu_percent` and `block_write_bytes`, or None if no sample is available.
+    interval : float, optional
+        The minimum number of seconds between two samples. Default is 5.
+    """
+
+    def __init__(self, sampler, interval = 5):
+        self.sampler = sampler
+        self.interval = interval
+        self.peak_rss_mb = 0
+        self.cpu_seconds = 0
+        self.bytes_written = 0
+        self.n_samples = 0
+        self._last_sample_time = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, job):
+        """
+        Samples the job every `interval` seconds from a background thread, until `stop` is called.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, args = (job,), daemon = True)
+        self._thread.start()
+
+    def _run(self, job):
+        while not self._stop.is_set():
+            try:
+                self.sample(job, force = True)
+            except Exception as e:
+                print(f"Stopping the resource sampling of {job}: {e!r}")
+                return
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        """
+        Stops the background sampling started by `start` and waits for the last sample.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def sample(self, job, force = False):
+        """
+        Takes a sample, unless the previous one is more recent than `interval`.
+        """
+        now = time.time()
+        if not force and self._last_sample_time is not None and now - self._last_sample_time < self.interval:
+            return
+        stats = self.sampler(job)
+        if stats is None:
+            return
+        if self._last_sample_time is not None:
+            self.cpu_seconds += stats['cpu_percent'] / 100 * (now - self._last_sample_time)
+        self._last_sample_time = now
+        self.peak_rss_mb = max(self.peak_rss_mb, stats['mem_mb'])
+        self.bytes_written = max(self.bytes_written, stats['block_write_bytes'])
+        self.n_samples += 1
+
+    def summary(self):
+        return {
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'cpu_seconds': round(self.cpu_seconds, 1),
+            'bytes_written': int(self.bytes_written),
+            'n_samples': self.n_samples,
+        }
+
+
+def read_manifest(manifest_path):
+    """
+    Reads a run manifest written by an fMRIprep job.
+
+    Parameters
+    ----------
+    manifest_path : str
+        The path to the manifest.
+
+    Returns
+    -------
+    dict or None
+        The manifest, or None if it does not exist.
+    """
+    try:
+        with open(manifest_path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
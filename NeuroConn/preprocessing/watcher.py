@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+from collections import namedtuple
+import pandas as pd
+from .derivatives import DerivativesIndex, pair_runs
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+RunReadyEvent = namedtuple('RunReadyEvent', ['subject', 'session', 'task', 'run', 'space', 'res', 'bold_path', 'confounds_path'])
+RunReadyEvent.__doc__ = """
+A preprocessed BOLD series whose confounds are also written, so that the run can be parcellated.
+
+Fields are the BIDS entities of the run (None when the file name does not have them) and the paths of the BOLD series and of the confounds.
+"""
+
+
+class PollingBackend():
+    """
+    Change detection by periodic polling: every call to `wait` lets the watcher refresh all subjects.
+
+    Thanks to the modification times kept in the index, a refresh only lists the directories that changed.
+
+    Parameters
+    ----------
+    interval : float, optional
+        The number of seconds between two refreshes. Default is 10.
+    """
+
+    def __init__(self, interval = 10):
+        self.interval = interval
+
+    def wait(self, timeout = None):
+        """
+        Waits for `interval` seconds (at most `timeout`) and returns None, meaning that any subject may have changed.
+        """
+        time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyBackend():
+    """
+    Change detection with Linux inotify (requires the `inotify_simple` package).
+
+    The derivatives directory, the subject, session and `func` directories are watched; directories created later are added as they appear.
+    Does not work on network file systems for changes made by other hosts; use `PollingBackend` there.
+
+    Parameters
+    ----------
+    root : str
+        The fMRIprep derivatives directory.
+    """
+
+    def __init__(self, root):
+        if inotify_simple is None:
+            raise ImportError("InotifyBackend requires the inotify_simple package (pip install inotify_simple).")
+        flags = inotify_simple.flags
+        self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE
+        self.root = os.path.abspath(root)
+        self._inotify = inotify_simple.INotify()
+        self._watches = {}
+        self._add_tree(self.root)
+
+    def _add_tree(self, path):
+        # only the levels that lead to func directories: root, sub-XX, ses-YY, func
+        relative = os.path.relpath(path, self.root)
+        parts = [] if relative == '.' else relative.split(os.sep)
+        if parts and not parts[0].startswith('sub-'):
+            return
+        if len(parts) > 3 or (len(parts) >= 2 and parts[-1] != 'func' and not parts[-1].startswith('ses-')):
+            return
+        try:
+            self._watches[self._inotify.add_watch(path, self.mask)] = path
+            with os.scandir(path) as entries:
+                subdirs = [entry.path for entry in entries if entry.is_dir()]
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        for subdir in subdirs:
+            self._add_tree(subdir)
+
+    def wait(self, timeout = None):
+        """
+        Waits for file system events (at most `timeout` seconds) and returns the labels of the subjects that changed.
+        """
+        events = self._inotify.read(timeout = None if timeout is None else int(timeout * 1000))
+        subjects = set()
+        for event in events:
+            directory = self._watches.get(event.wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & inotify_simple.flags.ISDIR and event.mask & (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO):
+                self._add_tree(path)
+            parts = os.path.relpath(path, self.root).split(os.sep)
+            if parts[0].startswith('sub-'):
+                subjects.add(parts[0][4:])
+        return subjects
+
+    def close(self):
+        self._inotify.close()
+
+
+def make_backend(backend, root, interval = 10):
+    """
+    Creates a change-detection backend: 'inotify', 'poll', or 'auto' (inotify if available, polling otherwise).
+    An object with `wait(timeout)` and `close()` methods can also be given and is returned as it is.
+    """
+    if backend == 'auto':
+        backend = 'inotify' if inotify_simple is not None and hasattr(os, 'uname') and os.uname().sysname == 'Linux' else 'poll'
+    if backend == 'inotify':
+        return InotifyBackend(root)
+    if backend == 'poll':
+        return PollingBackend(interval)
+    if isinstance(backend, str):
+        raise ValueError("backend must be 'auto', 'inotify', 'poll' or a backend object.")
+    return backend
+
+
+def _stat_files(paths):
+    # the index does not keep file modification times, so the files of a candidate run are stat'ed here
+    try:
+        return tuple((stat.st_mtime, stat.st_size) for stat in map(os.stat, paths))
+    except FileNotFoundError:
+        return None
+
+
+class DerivativesWatcher():
+    """
+    Keeps the derivatives index up to date while fMRIprep writes new outputs, and reports the runs that become ready.
+
+    A run is ready when its preprocessed BOLD series and its confounds exist, their modification times and sizes did not change
+    between two polls, and neither has been modified for `settle_time` seconds, so that files still being written are not reported.
+    Each BOLD series is reported once.
+
+    Parameters
+    ----------
+    root : str
+        The fMRIprep derivatives directory.
+    on_run_ready : callable, optional
+        Called with a `RunReadyEvent` for every run that becomes ready. Exceptions it raises are printed and do not stop the watcher. Default is None.
+    backend : str or object, optional
+        'auto', 'inotify', 'poll' or a backend object (see `make_backend`). Default is 'auto'.
+    interval : float, optional
+        The polling interval of the polling backend, and the longest time between two checks of runs that are not settled yet. Default is 10.
+    settle_time : float, optional
+        The number of seconds a file must be left unmodified to be considered complete. Default is 30.
+    index_path : str, optional
+        The path to the SQLite index, see `DerivativesIndex`. Default is None.
+    report_existing : bool, optional
+        Whether to also report the runs that were already complete when the watcher started. Default is False.
+    """
+
+    def __init__(self, root, on_run_ready = None, backend = 'auto', interval = 10, settle_time = 30, index_path = None, report_existing = False):
+        self.root = root
+        self.on_run_ready = on_run_ready
+        self.backend = backend
+        self.interval = interval
+        self.settle_time = settle_time
+        self.index_path = index_path
+        self.report_existing = report_existing
+        self._index = None
+        self._backend = None
+        self._reported = None
+        self._unsettled = set()
+        self._stats = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _setup(self):
+        # the SQLite connection belongs to the thread that polls, so the index is opened on the first poll
+        self._index = DerivativesIndex(self.root, self.index_path)
+        self._backend = make_backend(self.backend, self.root, self.interval)
+        self._index.refresh_all()
+        if self._reported is None:
+            self._reported = set()
+            # the first stats of the runs already written, which the first poll compares with
+            now = time.time()
+            for pair in pair_runs(self._index.table(refresh = False)).itertuples():
+                stats = _stat_files((pair.bold_path, pair.confounds_path))
+                if stats is None:
+                    continue
+                if not self.report_existing and now - max(mtime for mtime, size in stats) >= self.settle_time:
+                    self._reported.add(pair.bold_path)
+                else:
+                    self._stats[pair.bold_path] = stats
+        self._unsettled = set(self._index.subjects())
+
+    def poll(self, timeout = None):
+        """
+        Waits for changes (at most `timeout` seconds), updates the index and reports the runs that became ready.
+
+        Returns
+        -------
+        list of RunReadyEvent
+            The runs that became ready.
+        """
+        if self._index is None:
+            self._setup()
+        changed = self._backend.wait(self.interval if timeout is None else timeout)
+        if changed is None:
+            self._index.refresh_all()
+            subjects = set(self._index.subjects())
+        else:
+            for subject in changed:
+                self._index.refresh(subject)
+            subjects = set(changed) | self._unsettled
+        events = []
+        now = time.time()
+        self._unsettled = set()
+        for subject in sorted(subjects):
+            for pair in pair_runs(self._index.table(subject, refresh = False)).itertuples():
+                if pair.bold_path in self._reported:
+                    continue
+                # the modification time of the func directory does not change when a file grows, so the files are stat'ed at every poll
+                stats = _stat_files((pair.bold_path, pair.confounds_path))
+                previous = self._stats.get(pair.bold_path)
+                if stats is None or stats != previous or now - max(mtime for mtime, size in stats) < self.settle_time:
+                    self._stats[pair.bold_path] = stats
+                    self._unsettled.add(subject)
+                    continue
+                del self._stats[pair.bold_path]
+                self._reported.add(pair.bold_path)
+                entities = [None if pd.isna(value) else value for value in (pair.sub, pair.ses, pair.task, pair.run, pair.space, pair.res)]
+                event = RunReadyEvent(*entities, pair.bold_path, pair.confounds_path)
+                events.append(event)
+                if self.on_run_ready is not None:
+                    # a failing callback must not stop the watcher thread
+                    try:
+                        self.on_run_ready(event)
+                    except Exception as e:
+                        print(f"on_run_ready failed for {pair.bold_path}: {e!r}")
+        return events
+
+    def run(self, duration = None):
+        """
+        Polls until `stop` is called or for `duration` seconds.
+        """
+        deadline = None if duration is None else time.time() + duration
+        while not self._stop.is_set() and (deadline is None or time.time() < deadline):
+            self.poll(self.interval if deadline is None else max(0, min(self.interval, deadline - time.time())))
+        self._close()
+
+    def start(self):
+        """
+        Starts polling in a background thread. Returns the watcher.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target = self.run, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the background thread started by `start`.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _close(self):
+        if self._backend is not None:
+            self._backend.close()
+        if self._index is not None:
+            self._index.close()
+        self._index = None
+        self._backend = None
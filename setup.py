@@ -25,6 +25,10 @@ setup(
         'gdown',
         'fmriprep-docker', 
     ],
+    extras_require={
+        'watch': ['inotify_simple'],
+        'parquet': ['pyarrow'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Science/Research',
@@ -1,8 +1,24 @@
 import numpy as np
 import os
-from NeuroConn.preprocessing.preprocessing import RawDataset, FmriPreppedDataSet
+import nibabel as nib
+from NeuroConn.preprocessing.preprocessing import RawDataset, FmriPreppedDataSet, DatasetCollection, get_space_labels
 from NeuroConn.data.example_datasets import fetch_example_data
 from NeuroConn.gradient.gradient import get_gradients
+from NeuroConn.preprocessing.scheduler import ResourceBudget, FmriprepShard, FmriprepScheduler, WorkDirManager, combine_costs
+from NeuroConn.preprocessing.jobs import parse_progress_event, parse_log_subject, FmriprepJob, run_command_async
+from NeuroConn.preprocessing import telemetry
+from NeuroConn.preprocessing.telemetry import parse_docker_stats, DockerStatsSampler, ResourceMonitor
+from NeuroConn.preprocessing.hpc import write_job_array_script, run_job_array_locally
+from NeuroConn.preprocessing.derivatives import parse_bids_entities, filter_runs, read_sidecar, find_fmriprep_root, pair_runs, DerivativesIndex, RunManifest, read_bold_metadata
+from NeuroConn.preprocessing.watcher import DerivativesWatcher, PollingBackend
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import pandas as pd
+from NeuroConn.preprocessing.participants import filter_participants
+from NeuroConn.preprocessing.confounds import read_confounds, impute_confounds
 
 example_data = fetch_example_data('https://drive.google.com/file/d/1XjF5wDJXHzMyfoAjQE6NW2xcj9PulZzH/view?usp=share_link')
 
@@ -57,4 +73,483 @@ def test_get_gradients_aligned():
     gradients = get_gradients(example_data, '52', n_components = 10, task = "rest", aligned = True)
     assert len(gradients.shape) == 3, "Aligned gradients should be a 3D array"
     assert gradients.shape[1] == 1000, "Second dimension should be 1000 (n_parcels)"
-    assert gradients.shape[2] == 10, "Third dimension should be 10 (n_components)"
\ No newline at end of file
+    assert gradients.shape[2] == 10, "Third dimension should be 10 (n_components)"
+
+def test_resource_budget():
+    budget = ResourceBudget(total_threads = 8, total_mem_mb = 12000, max_parallel = 3)
+    assert budget.clamp(16, 20000) == (8, 12000)
+    budget.acquire(4, 5000)
+    assert budget.fits(4, 5000), "A second job should fit into the budget"
+    budget.acquire(4, 5000)
+    assert not budget.fits(1, 1000), "No threads should be left"
+    budget.release(4, 5000)
+    assert not budget.fits(4, 8000), "Not enough memory should be left"
+    assert not budget.fits(2, 1000, reserved = (4, 5000)), "A waiting container should keep its threads"
+    assert budget.fits(2, 1000, reserved = (2, 1000))
+
+def test_work_dir_manager(tmp_path):
+    work_dirs = WorkDirManager(str(tmp_path), max_total_mb = 10, check_interval = 0)
+    first = work_dirs.path('sub-01', reserve_mb = 6)
+    assert work_dirs.has_room(reserve_mb = 4)
+    assert not work_dirs.has_room(reserve_mb = 5), "Reserved space should count before anything is written"
+    with open(os.path.join(first, 'work.bin'), 'wb') as file:
+        file.write(b'0' * 8 * 1024 ** 2)
+    assert not work_dirs.has_room(reserve_mb = 3), "A directory should count with its size once it outgrows its reservation"
+    assert not work_dirs.release('sub-01', success = False)
+    assert os.path.exists(first), "The work directory of a failed run should be kept"
+    assert work_dirs.has_room(reserve_mb = 5), "With nothing running, a container may start while below the cap"
+    second = work_dirs.path('sub-02', reserve_mb = 1)
+    assert not work_dirs.has_room(reserve_mb = 2)
+    assert work_dirs.release('sub-02', success = True)
+    assert not os.path.exists(second)
+
+def test_combine_costs():
+    costs = combine_costs({'sub-01': 10, 'sub-02': 20}, {'sub-02': 210, 'sub-03': 45}, {'sub-03': 5})
+    assert costs == {'sub-01': 97.5, 'sub-02': 210}, "Past runs of other subjects should calibrate the header costs"
+
+def test_fmriprep_shards(tmp_path, monkeypatch):
+    for session in ['1', '2']:
+        func_dir = tmp_path / 'sub-01' / f'ses-{session}' / 'func'
+        func_dir.mkdir(parents = True)
+        nib.save(nib.Nifti1Image(np.zeros((2, 2, 2, 5), dtype = np.float32), np.eye(4)), str(func_dir / f'sub-01_ses-{session}_task-rest_bold.nii.gz'))
+    raw_data = RawDataset(str(tmp_path))
+    shards = raw_data.get_fmriprep_shards(['01'], 'session')
+    assert shards == [FmriprepShard('01', None, None, True), FmriprepShard('01', '1', None), FmriprepShard('01', '2', None)], "The anatomical shard should come first"
+    assert shards[1].bids_filter('rest') == {'bold': {'session': '1', 'task': 'rest'}, 'sbref': {'session': '1', 'task': 'rest'}, 'fmap': {'session': '1'}}
+
+    events = []
+    def submit_fmriprep(self, subject, fs_license_path, nthreads, session = None, run = None, anat_only = False, **kwargs):
+        shard = FmriprepShard(subject, session, run, anat_only)
+        events.append(('start', shard))
+        return FmriprepJob('exit 1' if anat_failing and anat_only else 'sleep 0.2', str(tmp_path / f'{shard.label}.txt'), subject = subject)
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', submit_fmriprep)
+    run_kwargs = dict(nthreads = 1, mem_mb = 1000, total_threads = 4, total_mem_mb = 8000, poll_interval = 0.05, shard_by = 'session',
+                      work_path = str(tmp_path / 'work'), on_finished = lambda shard, returncode: events.append(('end', shard)))
+    anat_failing = False
+    raw_data.run_fmriprep(['01'], 'license.txt', **run_kwargs)
+    assert events[:2] == [('start', shards[0]), ('end', shards[0])], "The anatomical shard should finish before the other shards start"
+    assert set(events[2:]) == {('start', shards[1]), ('start', shards[2]), ('end', shards[1]), ('end', shards[2])}
+
+    events.clear()
+    anat_failing = True
+    returncodes = raw_data.run_fmriprep(['01'], 'license.txt', **run_kwargs)
+    assert [event for event in events if event[0] == 'start'] == [('start', shards[0])], "Shards should not start if the anatomy failed"
+    assert all(returncode == 1 for returncode in returncodes.values())
+
+def test_fmriprep_scheduler_steps(tmp_path, monkeypatch):
+    for subject in ['01', '02']:
+        write_raw_bold(tmp_path, subject)
+    raw_data = RawDataset(str(tmp_path))
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', lambda self, subject, fs_license_path, nthreads, **kwargs: FmriprepJob('exit 1', str(tmp_path / f'sub-{subject}.txt'), subject = subject))
+    scheduler = FmriprepScheduler({None: raw_data}, 'license.txt', ResourceBudget(2, 1600), WorkDirManager(str(tmp_path / 'work')),
+                                  max_retries = 1, retry_backoff = 0, poll_interval = 0.05)
+    batches = scheduler.plan([(None, '01'), (None, '02')], 1, 1000, costs = {(None, '01'): 1, (None, '02'): 2})
+    assert batches == [[(None, '02')], [(None, '01')]], "The most expensive unit should be planned first"
+
+    started = scheduler.launch_ready()
+    assert [launch.batch for launch in started] == [[(None, '02')]], "Only one unit fits into the memory budget"
+    started[0].job.wait()
+    assert scheduler.complete(started[0]) == 1
+    assert scheduler.returncodes == {} and scheduler.pending[-1] == [(None, '02')], "A failed unit should be queued again"
+    assert scheduler.resources[(None, '02')] == (1, 1500)
+
+    started = scheduler.launch_ready()
+    assert [launch.batch for launch in started] == [[(None, '01')]]
+    assert scheduler.budget.used_mem_mb == 1000 and scheduler.pending == [[(None, '02')]], "The retry should wait for its memory"
+    assert scheduler.run() == {(None, '01'): 1, (None, '02'): 1}
+    assert all(failure['attempts'] == 2 for failure in scheduler.failures.values()), "Each unit should be given up after its retry"
+
+def write_raw_bold(root, subject, session = None, task = 'rest'):
+    func_dir = root / f'sub-{subject}' / (f'ses-{session}' if session is not None else '') / 'func'
+    func_dir.mkdir(parents = True, exist_ok = True)
+    prefix = f'sub-{subject}' + (f'_ses-{session}' if session is not None else '')
+    nib.save(nib.Nifti1Image(np.zeros((2, 2, 2, 5), dtype = np.float32), np.eye(4)), str(func_dir / f'{prefix}_task-{task}_bold.nii.gz'))
+
+def test_fmriprep_retries(tmp_path, monkeypatch):
+    for subject in ['01', '02']:
+        write_raw_bold(tmp_path, subject)
+    raw_data = RawDataset(str(tmp_path))
+    calls = []
+    def submit_fmriprep(self, subject, fs_license_path, nthreads, mem_mb = 5000, **kwargs):
+        calls.append((subject, mem_mb, time.time()))
+        failing = subject == '01' or len([call for call in calls if call[0] == subject]) == 1
+        return FmriprepJob('exit 1' if failing else 'true', str(tmp_path / f'sub-{subject}_{len(calls)}.txt'), subject = subject)
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', submit_fmriprep)
+    returncodes = raw_data.run_fmriprep(['01', '02'], 'license.txt', nthreads = 1, mem_mb = 1000, total_threads = 2, total_mem_mb = 1600, poll_interval = 0.02,
+                                        max_retries = 2, retry_backoff = 0.1, work_path = str(tmp_path / 'work'))
+    assert returncodes == {'01': 1, '02': 0}
+    failing = [call for call in calls if call[0] == '01']
+    assert [mem_mb for _, mem_mb, _ in failing] == [1000, 1500, 1600], "Memory should grow at each retry, up to total_mem_mb"
+    assert failing[1][2] - failing[0][2] >= 0.1 and failing[2][2] - failing[1][2] >= 0.2, "The backoff should double at each retry"
+    assert [mem_mb for subject, mem_mb, _ in calls if subject == '02'] == [1000, 1500]
+
+    with open(tmp_path / 'fmriprep_logs' / 'fmriprep_batch_summary.json') as file:
+        summary = json.load(file)
+    assert summary['n_succeeded'] == 1 and summary['n_failed'] == 1 and summary['n_not_run'] == 0
+    assert sorted(summary['retried']) == ['sub-01', 'sub-02']
+    assert summary['failed']['sub-01']['returncode'] == 1 and summary['failed']['sub-01']['attempts'] == 3 and summary['failed']['sub-01']['mem_mb'] == 1600
+    assert summary['failed']['sub-01']['log_path'].endswith('.txt')
+
+def test_run_pipeline(tmp_path, monkeypatch):
+    fmriprep_dir = tmp_path / 'derivatives' / 'fmriprep'
+    def write_outputs(subject):
+        func_dir = fmriprep_dir / f'sub-{subject}' / 'func'
+        func_dir.mkdir(parents = True)
+        (func_dir / f'sub-{subject}_task-rest_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz').touch()
+        (fmriprep_dir / f'sub-{subject}.html').touch()
+    for subject in ['01', '02', '03']:
+        write_raw_bold(tmp_path, subject)
+    write_outputs('01')
+    raw_data = RawDataset(str(tmp_path))
+    events = []
+    def submit_fmriprep(self, subject, fs_license_path, nthreads, **kwargs):
+        events.append(('fmriprep', subject))
+        if subject == '03':
+            write_outputs(subject)
+        return FmriprepJob('exit 1' if subject == '02' else 'sleep 0.2', str(tmp_path / f'sub-{subject}.txt'), subject = subject)
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, BIDS_path, subject, conn_kwargs):
+            events.append(('conn', subject))
+            return super().submit(fn, BIDS_path, subject, conn_kwargs)
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', submit_fmriprep)
+    monkeypatch.setattr('NeuroConn.preprocessing.preprocessing._compute_conn_matrix', lambda BIDS_path, subject, conn_kwargs: f'{subject}.csv')
+    with RecordingExecutor(max_workers = 1) as executor:
+        returncodes, conn_paths = raw_data.run_pipeline(['01', '02', '03'], 'license.txt', executor = executor, nthreads = 1, mem_mb = 1000, total_threads = 1,
+                                                        poll_interval = 0.02, work_path = str(tmp_path / 'work'))
+    assert returncodes == {'02': 1, '03': 0}, "Complete subjects should not be preprocessed again"
+    assert events[0] == ('conn', '01'), "A complete subject should be dispatched before fMRIprep starts"
+    assert ('conn', '02') not in events, "A failed subject should never be dispatched"
+    assert conn_paths == {'01': '01.csv', '03': '03.csv'}
+
+def test_docker_fmriprep_batch(tmp_path, monkeypatch):
+    for subject in ['01', '02']:
+        write_raw_bold(tmp_path, subject)
+    func_dir = tmp_path / 'derivatives' / 'fmriprep' / 'sub-01' / 'func'
+    func_dir.mkdir(parents = True)
+    (func_dir / 'sub-01_task-rest_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz').touch()
+    (tmp_path / 'derivatives' / 'fmriprep' / 'sub-01.html').touch()
+    raw_data = RawDataset(str(tmp_path))
+    submitted = []
+    def submit_fmriprep(self, subjects, fs_license_path, nthreads, **kwargs):
+        submitted.append(subjects)
+        return FmriprepJob('exit 1', str(tmp_path / 'batch.txt'))
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', submit_fmriprep)
+    assert raw_data.docker_fmriprep_batch(['01', '02'], 'license.txt', 2, mem_mb = 1000) == 1, "The exit code of the container should be returned"
+    assert submitted == [['02']], "Complete subjects should be left out of the batch"
+    assert raw_data.docker_fmriprep_batch(['01'], 'license.txt', 2, mem_mb = 1000) == 0 and len(submitted) == 1
+
+def test_get_space_labels():
+    assert get_space_labels('MNI152NLin2009cAsym:res-2 anat fsaverage:den-10k func') == ['MNI152NLin2009cAsym_res-2', 'T1w']
+    assert get_space_labels('MNI152NLin6Asym:res-3') == ['MNI152NLin6Asym_res-3'], "Unknown spaces should keep their label"
+
+def test_fmriprep_complete(tmp_path):
+    spaces = 'MNI152NLin2009cAsym:res-2 anat'
+    write_raw_bold(tmp_path, '01')
+    raw_data = RawDataset(str(tmp_path))
+    fmriprep_dir = tmp_path / 'derivatives' / 'fmriprep'
+    func_dir = fmriprep_dir / 'sub-01' / 'func'
+    func_dir.mkdir(parents = True)
+    for label in ['MNI152NLin2009cAsym_res-2', 'T1w']:
+        (func_dir / f'sub-01_task-rest_space-{label}_desc-preproc_bold.nii.gz').touch()
+    (fmriprep_dir / 'sub-01.html').touch()
+    assert raw_data.fmriprep_complete('01', output_spaces = spaces)
+    assert raw_data.missing_fmriprep_sessions('01', output_spaces = spaces) == []
+
+    (func_dir / 'sub-01_task-rest_space-T1w_desc-preproc_bold.nii.gz').unlink()
+    assert raw_data.missing_fmriprep_sessions('01', output_spaces = spaces) == [None], "A missing output space should make the subject incomplete"
+    assert raw_data.fmriprep_complete('01', output_spaces = 'MNI152NLin2009cAsym:res-2'), "Spaces that were not requested should not be checked"
+
+    (fmriprep_dir / 'sub-01.html').unlink()
+    assert not raw_data.fmriprep_complete('01', output_spaces = 'MNI152NLin2009cAsym:res-2'), "A subject without report should be incomplete"
+    assert not raw_data.fmriprep_complete('01', task = 'nback', output_spaces = 'MNI152NLin2009cAsym:res-2')
+
+    for session in ['1', '2']:
+        write_raw_bold(tmp_path, '02', session)
+    (fmriprep_dir / 'sub-02.html').touch()
+    ses_dir = fmriprep_dir / 'sub-02' / 'ses-1' / 'func'
+    ses_dir.mkdir(parents = True)
+    (ses_dir / 'sub-02_ses-1_task-rest_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz').touch()
+    assert raw_data.missing_fmriprep_sessions('02') == ['2'], "Only the session without outputs should be missing"
+
+def test_work_quota_exhausted(tmp_path, monkeypatch):
+    for subject in ['01', '02']:
+        write_raw_bold(tmp_path, subject)
+    kept = tmp_path / 'work' / 'fmriprep_work' / 'sub-00'
+    kept.mkdir(parents = True)
+    (kept / 'failed.bin').write_bytes(b'0' * 2 * 1024 ** 2)
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', lambda *args, **kwargs: pytest.fail("No container should start"))
+    returncodes = RawDataset(str(tmp_path)).run_fmriprep(['01', '02'], 'license.txt', nthreads = 1, mem_mb = 1000, total_threads = 4, total_mem_mb = 8000,
+                                                         work_path = str(tmp_path / 'work'), work_quota_mb = 1)
+    assert returncodes == {}
+    summary = json.loads((tmp_path / 'fmriprep_logs' / 'fmriprep_batch_summary.json').read_text())
+    assert sorted(summary['not_run']) == ['sub-01', 'sub-02'], "Units left when the quota is exhausted should be reported, not dropped"
+
+def test_parse_progress_event():
+    setup = parse_progress_event('230101-12:00:00,123 nipype.workflow INFO:\t [Node] Setting-up "fmriprep_wf.single_subject_52_wf.n4" in "/work/n4".')
+    executing = parse_progress_event('\t [Node] Executing "n4" <niworkflows.interfaces.fixes.FixN4BiasFieldCorrection>')
+    finished = parse_progress_event('\t [Node] Finished "n4", elapsed time 12.5s.')
+    assert setup == ('n4', 'setup', None), "Node names should not depend on the message"
+    assert executing == ('n4', 'started', None)
+    assert finished == ('n4', 'finished', 12.5)
+    assert parse_progress_event('fMRIPrep finished successfully!') is None
+
+def test_parse_log_subject():
+    assert parse_log_subject('[Node] Setting-up "fmriprep_23_1_wf.single_subject_01_wf.anat_preproc_wf.n4" in "/work".') == '01'
+    assert parse_log_subject('[Node] Setting-up "fmriprep_24_1_wf.sub_02_wf.anat_fit_wf.n4" in "/work".') == '02'
+    assert parse_log_subject('Saving crash info to /out/sub-03/log/crash.txt') == '03'
+    assert parse_log_subject('[Node] Finished "n4", elapsed time 12.5s.') is None
+
+def test_fmriprep_job_subject_logs(tmp_path):
+    (tmp_path / 'fmriprep.txt').write_text('[Node] Setting-up "fmriprep_24_1_wf.sub_01_wf.anat_fit_wf.n4" in "/work".\n'
+                                           '[Node] Executing "n4" <FixN4BiasFieldCorrection>\n'
+                                           '[Node] Setting-up "fmriprep_24_1_wf.sub_02_wf.anat_fit_wf.skull_strip" in "/work".\n'
+                                           '[Node] Finished "n4", elapsed time 12.5s.\n')
+    subject_log_paths = {'01': str(tmp_path / 'sub-01.txt'), '02': str(tmp_path / 'sub-02.txt')}
+    job = FmriprepJob(f'cat {tmp_path / "fmriprep.txt"}', str(tmp_path / 'log.txt'), subject = ['01', '02'], subject_log_paths = subject_log_paths)
+    job.wait(timeout = 10)
+    assert len((tmp_path / 'sub-01.txt').read_text().splitlines()) == 3, "Messages with short node names should go to the subject that set the node up"
+    assert len((tmp_path / 'sub-02.txt').read_text().splitlines()) == 1
+
+def test_fmriprep_job(tmp_path):
+    job = FmriprepJob('echo first; echo second', str(tmp_path / 'log.txt'), subject = '01')
+    assert job.wait(timeout = 10) == 0
+    assert job.done()
+    assert job.new_log_lines() == ['first\n', 'second\n']
+    assert job.new_log_lines() == [], "Log lines should only be returned once"
+
+def test_fmriprep_job_cancel(tmp_path):
+    job = FmriprepJob('sleep 30', str(tmp_path / 'log.txt'))
+    assert not job.done(), "The job should still be running"
+    job.cancel()
+    assert job.done() and job.cancelled
+    assert job.returncode != 0
+
+def test_check_fmriprep_job(tmp_path):
+    raw_data = RawDataset(str(tmp_path))
+    log_dir = tmp_path / 'derivatives' / 'fmriprep' / 'sub-01' / 'log' / '20240101-120000_aaaa'
+    log_dir.mkdir(parents = True)
+    (log_dir / 'crash-20240101-120500-n4.txt').write_text('Traceback')
+    crashed = FmriprepJob('echo "  * Run identifier: 20240101-120000_aaaa."', str(tmp_path / 'crashed.txt'), subject = '01')
+    sibling = FmriprepJob('echo "  * Run identifier: 20240101-120001_bbbb."', str(tmp_path / 'sibling.txt'), subject = '01')
+    assert raw_data._check_fmriprep_job(crashed, ['01']) == (1, [str(log_dir / 'crash-20240101-120500-n4.txt')])
+    assert raw_data._check_fmriprep_job(sibling, ['01']) == (0, []), "Crash reports of another invocation should not count"
+
+def test_run_command_async(tmp_path):
+    log_path = tmp_path / 'log.txt'
+    assert asyncio.run(run_command_async('echo done; exit 3', str(log_path))) == 3
+    assert log_path.read_text() == 'done\n'
+    raw_data = RawDataset(str(tmp_path))
+    with pytest.raises(TypeError):
+        asyncio.run(raw_data.docker_fmriprep_async('01', 'license.txt', 1, on_progress = print))
+
+def test_parse_docker_stats():
+    stats = parse_docker_stats({'BlockIO': '12.3MB / 4.5GB', 'CPUPerc': '250.00%', 'MemUsage': '1.5GiB / 15.6GiB'})
+    assert stats['mem_mb'] == 1536
+    assert stats['cpu_percent'] == 250
+    assert stats['block_write_bytes'] == 4.5e9
+
+def test_docker_stats_sampler(tmp_path, monkeypatch):
+    calls = []
+    def docker(args):
+        calls.append(args[0])
+        if args[0] == 'ps':
+            return 'aaa\nbbb\n'
+        if args[0] == 'inspect':
+            return f'aaa\t{tmp_path}/data\t{tmp_path}/work/sub-01_ses-1\nbbb\t{tmp_path}/data\t{tmp_path}/work/sub-01_ses-2\n'
+        return '{"BlockIO": "0B / 1MB", "CPUPerc": "100%", "MemUsage": "2GiB / 8GiB"}\n' if args[-1] == 'bbb' else None
+    monkeypatch.setattr(telemetry, '_docker', docker)
+    job = FmriprepJob('sleep 0.5', str(tmp_path / 'log.txt'), subject = '01', manifest_path = str(tmp_path / 'manifest.json'),
+                      monitor = ResourceMonitor(DockerStatsSampler(), interval = 0.1), work_path = str(tmp_path / 'work' / 'sub-01_ses-2'))
+    assert not job.done(), "Polling the job should not sample the container"
+    job.wait()
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert manifest['peak_rss_mb'] == 2048, "The container should be found by its work directory, not by the participant label"
+    assert manifest['n_samples'] >= 2 and calls.count('ps') == 1
+
+def test_run_job_array_locally(tmp_path):
+    for scheduler in ['slurm', 'pbs']:
+        done_dir = tmp_path / scheduler
+        done_dir.mkdir()
+        script_path = write_job_array_script(f'touch {done_dir}/done-$SUBJECT', ['01', '02', '03'], str(tmp_path / 'code'), str(tmp_path / 'logs'),
+                                             scheduler = scheduler, max_parallel = 2, job_name = f'fmriprep_{scheduler}')
+        assert '1-3%2' in open(script_path).read()
+        assert run_job_array_locally(script_path, max_parallel = 2, poll_interval = 0.05) == {1: 0, 2: 0, 3: 0}
+        assert sorted(os.listdir(done_dir)) == ['done-01', 'done-02', 'done-03'], "Every array task should run with its own subject"
+
+def test_parse_bids_entities():
+    entities = parse_bids_entities('/data/sub-01/ses-2/func/sub-01_ses-2_task-restpre_run-1_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz')
+    assert entities['sub'] == '01' and entities['ses'] == '2' and entities['task'] == 'restpre'
+    assert entities['space'] == 'MNI152NLin2009cAsym' and entities['res'] == '2'
+    assert entities['suffix'] == 'bold' and entities['extension'] == '.nii.gz'
+
+def test_filter_runs():
+    runs = pd.DataFrame([parse_bids_entities(name) for name in ['sub-01_task-rest_space-T1w_desc-preproc_bold.nii.gz',
+                                                                 'sub-01_task-restpre_space-T1w_desc-preproc_bold.nii.gz',
+                                                                 'sub-01_task-rest_space-MNI152NLin2009cAsym_res-2_desc-preproc_bold.nii.gz']])
+    assert len(filter_runs(runs, task = 'rest')) == 2, "task-restpre should not match task = 'rest'"
+    assert len(filter_runs(runs, task = 'rest', space = 'T1w', res = None)) == 1
+    assert len(filter_runs(runs, space = ['T1w', 'MNI152NLin2009cAsym'])) == 3
+
+def write_run(func_dir, prefix, spaces = ('T1w',), confounds = True):
+    func_dir.mkdir(parents = True, exist_ok = True)
+    for space in spaces:
+        (func_dir / f'{prefix}_space-{space}_desc-preproc_bold.nii.gz').write_bytes(b'bold')
+    if confounds:
+        (func_dir / f'{prefix}_desc-confounds_timeseries.tsv').write_text('global_signal\n1\n')
+
+def test_pair_runs(tmp_path):
+    write_run(tmp_path / 'sub-01' / 'func', 'sub-01_task-rest', spaces = ('T1w', 'MNI152NLin2009cAsym'))
+    write_run(tmp_path / 'sub-01' / 'ses-1' / 'func', 'sub-01_ses-1_task-rest_run-1')
+    write_run(tmp_path / 'sub-01' / 'ses-1' / 'func', 'sub-01_ses-1_task-rest_run-2', confounds = False)
+    index = DerivativesIndex(str(tmp_path), index_path = ':memory:')
+    pairs = pair_runs(index.table())
+    index.close()
+    assert len(pairs) == 3, "A BOLD series without confounds should not be paired"
+    assert all(row.confounds_path == row.bold_path.split('_space-')[0] + '_desc-confounds_timeseries.tsv' for row in pairs.itertuples())
+    assert pairs['ses'].isna().sum() == 2, "Runs without a session should match confounds without a session"
+
+def test_run_manifest(tmp_path):
+    func_dir = tmp_path / 'derivatives' / 'fmriprep' / 'sub-01' / 'func'
+    write_run(func_dir, 'sub-01_task-rest_run-1', spaces = ('T1w', 'MNI152NLin2009cAsym'))
+    write_run(func_dir, 'sub-01_task-rest_run-2', confounds = False)
+    for prefix in ['sub-01_task-rest_run-1', 'sub-01_task-rest_run-2']:
+        for space in ['MNI152NLin2009cAsym', 'T1w']:
+            (func_dir / f'{prefix}_space-{space}_desc-brain_mask.nii.gz').write_bytes(b'mask')
+    (func_dir / 'sub-01_task-rest_run-1_space-T1w_desc-preproc_bold.json').write_text('{"RepetitionTime": 2}')
+    dataset = FmriPreppedDataSet(str(tmp_path))
+    table = dataset.index.table('01')
+    bold = filter_runs(table, space = 'T1w', desc = 'preproc', suffix = 'bold', extension = '.nii.gz')
+    manifest = RunManifest.from_table('01', table, bold, [2.0, 2.0])
+    assert [run.run for run in manifest] == ['1', '2'] and manifest.repetition_times == [2.0, 2.0]
+    assert all(run.mask_path == run.bold_path.replace('desc-preproc_bold', 'desc-brain_mask') for run in manifest), "Masks should be paired by run and space"
+    assert manifest.runs[0].sidecar_path == str(func_dir / 'sub-01_task-rest_run-1_space-T1w_desc-preproc_bold.json')
+    assert manifest.runs[1].sidecar_path is None
+    assert manifest.confounds_paths == [str(func_dir / 'sub-01_task-rest_run-1_desc-confounds_timeseries.tsv'), None]
+    with pytest.raises(FileNotFoundError, match = 'run-2'):
+        dataset.parcellate('01', run_manifest = manifest)
+
+def test_derivatives_index_refresh(tmp_path):
+    write_run(tmp_path / 'sub-01' / 'ses-1' / 'func', 'sub-01_ses-1_task-rest')
+    index = DerivativesIndex(str(tmp_path), index_path = ':memory:')
+    assert index.sessions('01') == ['1']
+    changes = index._connection.total_changes
+    for _ in range(5):
+        index.sessions('01')
+    assert index._connection.total_changes == changes, "Refreshing an unchanged subject should not write to the index"
+    write_run(tmp_path / 'sub-01' / 'ses-2' / 'func', 'sub-01_ses-2_task-rest')
+    assert index.sessions('01') == ['1', '2'] and len(index.files('01', suffix = 'bold')) == 2
+    index.close()
+
+def test_derivatives_watcher(tmp_path):
+    write_run(tmp_path / 'sub-01' / 'func', 'sub-01_task-rest_run-1')
+    watcher = DerivativesWatcher(str(tmp_path), backend = PollingBackend(interval = 0), settle_time = 0, index_path = ':memory:')
+    assert watcher.poll(0) == [], "Runs written before the watcher started should not be reported"
+    write_run(tmp_path / 'sub-01' / 'func', 'sub-01_task-rest_run-2')
+    assert watcher.poll(0) == [], "A run should only be reported once its files are unchanged between two polls"
+    with open(tmp_path / 'sub-01' / 'func' / 'sub-01_task-rest_run-2_desc-confounds_timeseries.tsv', 'a') as file:
+        file.write('2\n')
+    assert watcher.poll(0) == [], "A file still growing should delay the run"
+    events = watcher.poll(0)
+    assert [(event.subject, event.run, event.space) for event in events] == [('01', '2', 'T1w')]
+    assert watcher.poll(0) == [], "A run should be reported once"
+    watcher._close()
+
+def test_watch_callback_uses_dataset(tmp_path):
+    fmriprep_dir = tmp_path / 'derivatives' / 'fmriprep'
+    write_run(fmriprep_dir / 'sub-01' / 'func', 'sub-01_task-rest_run-1')
+    dataset = FmriPreppedDataSet(str(tmp_path))
+    assert len(dataset.get_ts_paths('01', 'rest')) == 1
+    ts_paths = []
+    def on_run_ready(event):
+        if event.run == '1':
+            raise RuntimeError("a failing callback should not stop the watcher")
+        ts_paths.append(dataset.get_ts_paths(event.subject, event.task))
+    watcher = dataset.watch(on_run_ready, backend = 'poll', interval = 0.05, settle_time = 0, start = False)
+    watcher.report_existing = True
+    watcher.start()
+    write_run(fmriprep_dir / 'sub-01' / 'func', 'sub-01_task-rest_run-2')
+    deadline = time.time() + 10
+    while not ts_paths and time.time() < deadline:
+        time.sleep(0.05)
+    watcher.stop()
+    assert len(ts_paths) == 1 and len(ts_paths[0]) == 2, "The dataset index should be usable from the watcher thread"
+
+def test_dataset_collection(tmp_path, monkeypatch):
+    for cohort in ['a', 'b']:
+        write_run(tmp_path / cohort / 'derivatives' / 'fmriprep' / 'sub-01' / 'func', 'sub-01_task-rest', spaces = ('T1w', 'MNI152NLin2009cAsym'))
+        (tmp_path / cohort / 'sub-01' / 'func').mkdir(parents = True)
+        nib.save(nib.Nifti1Image(np.zeros((2, 2, 2, 5), dtype = np.float32), np.eye(4)), str(tmp_path / cohort / 'sub-01' / 'func' / 'sub-01_task-rest_bold.nii.gz'))
+    collection = DatasetCollection([str(tmp_path / 'a'), str(tmp_path / 'b')], names = ['a', 'b'])
+    runs = collection.runs
+    assert list(runs.columns[:2]) == ['dataset', 'sub'] and sorted(set(runs['dataset'])) == ['a', 'b']
+    assert len(collection.select_runs(sub = '01', desc = 'preproc', suffix = 'bold')) == 4, "The same subject label should be kept in both datasets"
+    selected = collection.select_runs(dataset = 'b', space = 'T1w')
+    assert len(selected) == 1 and selected['path'].iloc[0].startswith(str(tmp_path / 'b'))
+
+    events = []
+    def submit_fmriprep(self, subject, fs_license_path, nthreads, **kwargs):
+        events.append(('start', self.BIDS_path))
+        return FmriprepJob('sleep 0.2', os.path.join(self.BIDS_path, 'fmriprep.txt'), subject = subject)
+    monkeypatch.setattr(RawDataset, 'submit_fmriprep', submit_fmriprep)
+    returncodes = collection.run_fmriprep([('a', '01'), ('b', '01')], 'license.txt', nthreads = 2, mem_mb = 1000, total_threads = 4, total_mem_mb = 8000,
+                                          poll_interval = 0.05, force = True, work_path = str(tmp_path / 'work'),
+                                          on_finished = lambda key, returncode: events.append(('end', key)))
+    assert returncodes == {('a', '01'): 0, ('b', '01'): 0}
+    assert [event[0] for event in events] == ['start', 'start', 'end', 'end'], "Both datasets should share one budget and run at the same time"
+
+def test_read_sidecar(tmp_path):
+    func_dir = tmp_path / 'sub-01' / 'ses-1' / 'func'
+    func_dir.mkdir(parents = True)
+    (tmp_path / 'task-rest_bold.json').write_text(json.dumps({'RepetitionTime': 2.0, 'TaskName': 'rest'}))
+    (tmp_path / 'task-motor_bold.json').write_text(json.dumps({'RepetitionTime': 3.0}))
+    (func_dir / 'sub-01_ses-1_task-rest_bold.json').write_text(json.dumps({'RepetitionTime': 0.8}))
+    metadata = read_sidecar(str(func_dir / 'sub-01_ses-1_task-rest_bold.nii.gz'), root = str(tmp_path))
+    assert metadata == {'RepetitionTime': 0.8, 'TaskName': 'rest'}, "The run sidecar should override the inherited one"
+
+def test_read_bold_metadata(tmp_path):
+    (tmp_path / 'sub-01_task-rest_bold.nii.gz').write_bytes(b'not a NIfTI file')
+    (tmp_path / 'sub-01_task-rest_bold.json').write_text(json.dumps({'RepetitionTime': 0.8}))
+    metadata = read_bold_metadata(str(tmp_path / 'sub-01_task-rest_bold.nii.gz'), n_volumes = False)
+    assert metadata['repetition_time'] == 0.8 and metadata['n_volumes'] is None, "The header should not be read when the sidecar has the repetition time"
+    image = nib.Nifti1Image(np.zeros((2, 2, 2, 7), dtype = np.float32), np.eye(4))
+    image.header.set_zooms((1, 1, 1, 2.5))
+    nib.save(image, str(tmp_path / 'sub-01_task-motor_bold.nii.gz'))
+    metadata = read_bold_metadata(str(tmp_path / 'sub-01_task-motor_bold.nii.gz'), n_volumes = False)
+    assert (metadata['repetition_time'], metadata['n_volumes'], metadata['source']) == (2.5, 7, 'header')
+
+def test_find_fmriprep_root(tmp_path):
+    (tmp_path / 'freesurfer' / 'sub-01').mkdir(parents = True)
+    fmriprep_dir = tmp_path / 'pipelines' / 'fmriprep-23.1'
+    (fmriprep_dir / 'sub-01').mkdir(parents = True)
+    (fmriprep_dir / 'dataset_description.json').write_text(json.dumps({'GeneratedBy': [{'Name': 'fMRIPrep'}]}))
+    assert find_fmriprep_root(str(tmp_path)) == str(fmriprep_dir)
+    assert (tmp_path / '.neuroconn_root').read_text() == os.path.join('pipelines', 'fmriprep-23.1')
+
+def test_filter_participants():
+    table = pd.DataFrame({'participant_id': ['sub-01', 'sub-02', 'sub-03'], 'age': [65, 40, None], 'group': ['patient', 'control', 'patient']})
+    assert list(filter_participants(table, age__gt = 60, group = 'patient')['participant_id']) == ['sub-01']
+    assert list(filter_participants(table, group__in = ['control'])['participant_id']) == ['sub-02']
+    assert list(filter_participants(table, age__isna = True)['participant_id']) == ['sub-03']
+
+def test_read_confounds(tmp_path):
+    confounds_path = tmp_path / 'sub-01_task-rest_desc-confounds_timeseries.tsv'
+    confounds_path.write_text('trans_x\ttrans_x_derivative1\tc_comp_cor_00\n0.1\tn/a\t1.0\n0.3\t0.2\t2.0\n')
+    first = read_confounds(str(confounds_path), ['trans_x_derivative1', 'trans_x'], str(tmp_path / 'cache'))
+    cached = read_confounds(str(confounds_path), ['trans_x_derivative1', 'trans_x'], str(tmp_path / 'cache'))
+    assert list(cached.columns) == ['trans_x_derivative1', 'trans_x'], "Only the requested confounds should be read"
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+    pd.testing.assert_frame_equal(first, cached)
+    assert np.isnan(cached['trans_x_derivative1'][0])
+    func_dir = tmp_path / 'sub-01' / 'ses-1' / 'func'
+    func_dir.mkdir(parents = True)
+    (func_dir / confounds_path.name).write_text(confounds_path.read_text())
+    read_confounds(str(func_dir / confounds_path.name))
+    assert os.listdir(func_dir) == [confounds_path.name], "The default cache should be outside the subject directories"
+    assert len(os.listdir(tmp_path / '.neuroconn_confounds')) == 1
+
+def test_impute_confounds():
+    run_1 = pd.DataFrame({'trans_x': [0.1, 0.3, 0.5], 'trans_x_derivative1': [np.nan, 0.2, 0.4]})
+    run_2 = pd.DataFrame({'trans_x': [1.0, np.nan], 'trans_x_derivative1': [np.nan, 3.0]})
+    imputed = impute_confounds([run_1, run_2])
+    assert np.allclose(imputed[0]['trans_x_derivative1'], [0.3, 0.2, 0.4]), "NaNs should be replaced by the mean of their run"
+    assert imputed[1].to_numpy().tolist() == [[1.0, 3.0], [1.0, 3.0]]